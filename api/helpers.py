@@ -1,6 +1,44 @@
 import graphene
 
+from graphene.utils.str_converters import to_snake_case
+
+from graphql.language import ast
+
 
 class ErrorType(graphene.ObjectType):
     message = graphene.String()
     code = graphene.Int()
+
+
+def iter_fields(info, selection_set):
+    'Yield the fields of a selection set, including the fields of its fragments.'
+
+    for selection in selection_set.selections:
+        if isinstance(selection, ast.FragmentSpread):
+            yield from iter_fields(info, info.fragments[selection.name.value].selection_set)
+        elif isinstance(selection, ast.InlineFragment):
+            yield from iter_fields(info, selection.selection_set)
+        else:
+            yield selection
+
+
+def get_selected_fields(info, *path):
+    """Return the names (in snake case) of the fields selected below the resolved field and the given path of field
+    names, e.g. get_selected_fields(info, 'edges', 'node') for the nodes of a connection.
+    Resolvers use it to load only the columns which are queried."""
+
+    selection_sets = [field.selection_set for field in info.field_asts if field.selection_set]
+
+    for name in path:
+        selection_sets = [
+            field.selection_set
+            for selection_set in selection_sets
+            for field in iter_fields(info, selection_set)
+            if field.name.value == name and field.selection_set
+        ]
+
+    return {
+        to_snake_case(field.name.value)
+        for selection_set in selection_sets
+        for field in iter_fields(info, selection_set)
+    }
@@ -3,22 +3,25 @@ import graphene
 # import user.schema
 import sharepoint.schema
 import oauth.schema
+import file.schema
 
 
 class Query(
     # user.schema.Query,
     sharepoint.schema.Query,
     oauth.schema.Query,
+    file.schema.Query,
     graphene.ObjectType
 ):
     pass
 
 
-# class Mutation(
-#     user.schema.Mutation,
-#     graphene.ObjectType
-# ):
-#     pass
+class Mutation(
+    # user.schema.Mutation,
+    file.schema.Mutation,
+    graphene.ObjectType
+):
+    pass
 
 
-schema = graphene.Schema(query=Query)
+schema = graphene.Schema(query=Query, mutation=Mutation)
@@ -0,0 +1,165 @@
+# This file maintains the DocumentAccess table, the precomputed read permissions of documents.
+# Who may read a document follows from its owner and its shares (with users, or with groups and thereby with their
+# members). Resolving this on every request would join documents, shares and group memberships; instead, the
+# permissions are expanded into one row per (user, document) whenever an owner, a share or a group changes (see the
+# receivers in file.models). A permission check is then a single lookup of the unique (user, document) index.
+# The rows carry the creation time of their document, so that the documents query pages on their own index.
+#
+# The rows of a document are recomputed as a whole, so a user who may read a document for several reasons keeps
+# reading it when one of them is removed. rebuild_document_access recomputes all rows, e.g. after a bulk import.
+
+from django.db import transaction
+from django.db.models import Q
+
+from user.models import UserGroup
+
+from .models import Document, DocumentAccess, DocumentShare
+
+
+def get_grants(document_ids):
+    'Return the set of (document id, user id) pairs of the users who may read the documents.'
+
+    grants = set(Document.objects.filter(pk__in=document_ids).values_list('id', 'owner_id'))
+    user_shares = DocumentShare.objects.filter(document__in=document_ids, user__isnull=False)
+    grants.update(user_shares.values_list('document_id', 'user_id'))
+
+    group_shares = DocumentShare.objects.filter(document__in=document_ids, group__isnull=False)
+    documents_by_group = {}
+    for document_id, group_id in group_shares.values_list('document_id', 'group_id'):
+        documents_by_group.setdefault(group_id, []).append(document_id)
+
+    memberships = UserGroup.members.through.objects.filter(usergroup__in=documents_by_group)
+    for group_id, user_id in memberships.values_list('usergroup_id', 'user_id'):
+        grants.update((document_id, user_id) for document_id in documents_by_group[group_id])
+
+    return grants
+
+
+def refresh_access(document_ids):
+    'Recompute the DocumentAccess rows of the documents.'
+
+    document_ids = list(document_ids)
+
+    if not document_ids:
+        return
+
+    with transaction.atomic():
+        existing = {}
+        outdated = []
+        grants = get_grants(document_ids)
+        created = dict(Document.objects.filter(pk__in=document_ids).values_list('id', 'created_at'))
+
+        for pk, document_id, user_id, created_at in DocumentAccess.objects.filter(
+            document__in=document_ids
+        ).values_list('pk', 'document_id', 'user_id', 'created_at'):
+            existing[(document_id, user_id)] = pk
+
+            # E.g. after the creation time of the document was changed with update().
+            if document_id in created and created_at != created[document_id]:
+                outdated.append(document_id)
+
+        revoked = [pk for grant, pk in existing.items() if grant not in grants]
+        if revoked:
+            DocumentAccess.objects.filter(pk__in=revoked).delete()
+
+        for document_id in set(outdated):
+            DocumentAccess.objects.filter(document=document_id).update(created_at=created[document_id])
+
+        DocumentAccess.objects.bulk_create(
+            [
+                DocumentAccess(document_id=document_id, user_id=user_id, created_at=created[document_id])
+                for document_id, user_id in grants - set(existing)
+            ],
+            ignore_conflicts=True
+        )
+
+
+def grant_owner(document):
+    'Let the owner of a new document read it.'
+
+    DocumentAccess.objects.bulk_create(
+        [DocumentAccess(document=document, user_id=document.owner_id, created_at=document.created_at)],
+        ignore_conflicts=True
+    )
+
+
+def get_readable_documents(user):
+    'Return the documents the user may read.'
+
+    if user.is_admin:
+        return Document.objects.all()
+
+    return Document.objects.filter(access__user=user)
+
+
+def get_readable_page(user, limit, after=None):
+    """Return the documents the user may read, newest first, following the document whose (created_at, id) is after.
+    Slice the result to at most limit documents. For users other than admins, these are selected on the
+    (user, created_at, document) index of DocumentAccess."""
+
+    if user.is_admin:
+        documents = Document.objects.all()
+
+        if after:
+            documents = documents.filter(Q(created_at__lt=after[0]) | Q(created_at=after[0], id__lt=after[1]))
+
+        return documents.order_by('-created_at', '-id')
+
+    access = DocumentAccess.objects.filter(user=user)
+
+    if after:
+        access = access.filter(Q(created_at__lt=after[0]) | Q(created_at=after[0], document_id__lt=after[1]))
+
+    page = access.order_by('-created_at', '-document_id').values('document_id')[:limit]
+    return Document.objects.filter(pk__in=page).order_by('-created_at', '-id')
+
+
+# Results of permission checks are memoized on the user object, which lives as long as the request.
+def _get_memo(user):
+    return user.__dict__.setdefault('_readable_documents', {})
+
+
+def remember_readable(user, document_ids):
+    'Memoize that the user may read the documents, e.g. the ones of a list which was filtered by permission.'
+
+    _get_memo(user).update(dict.fromkeys(document_ids, True))
+
+
+def can_read(user, document_id):
+    'Return whether the user may read the document.'
+
+    if user.is_anonymous:
+        return False
+
+    if user.is_admin:
+        return True
+
+    memo = _get_memo(user)
+
+    if document_id not in memo:
+        memo[document_id] = DocumentAccess.objects.filter(user=user, document=document_id).exists()
+
+    return memo[document_id]
+
+
+def filter_readable(user, document_ids):
+    'Return the subset of the documents the user may read, checking all documents not memoized in one query.'
+
+    if user.is_anonymous:
+        return set()
+
+    if user.is_admin:
+        return set(document_ids)
+
+    memo = _get_memo(user)
+    unknown = [document_id for document_id in document_ids if document_id not in memo]
+
+    if unknown:
+        readable = set(
+            DocumentAccess.objects.filter(user=user, document__in=unknown).values_list('document_id', flat=True)
+        )
+
+        for document_id in unknown:
+            memo[document_id] = document_id in readable
+
+    return {document_id for document_id in document_ids if memo[document_id]}
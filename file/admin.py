@@ -1,6 +1,44 @@
 from django.contrib import admin
 
-from .models import Document
+from .models import Document, DocumentDerivative, DocumentShare, DocumentVersion, FileBlob, StorageUsage
 
 
-admin.site.register(Document)
+class DocumentDerivativeInline(admin.TabularInline):
+    model = DocumentDerivative
+    fields = ('kind', 'size', 'file', 'content_type', 'width', 'height')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+class DocumentVersionInline(admin.TabularInline):
+    model = DocumentVersion
+    fields = ('number', 'kind', 'size', 'stored_size', 'filename', 'created_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+class DocumentShareInline(admin.TabularInline):
+    model = DocumentShare
+    fields = ('user', 'group')
+    extra = 0
+
+
+class DocumentAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'owner', 'mime_type', 'processing_status', 'created_at')
+    list_filter = ('processing_status',)
+    readonly_fields = ('checksum', 'mime_type', 'page_count', 'processing_error', 'processed_at')
+    inlines = [DocumentShareInline, DocumentVersionInline, DocumentDerivativeInline]
+
+
+admin.site.register(Document, DocumentAdmin)
+admin.site.register(FileBlob)
+
+
+class StorageUsageAdmin(admin.ModelAdmin):
+    list_display = ('user', 'bytes_used', 'file_count', 'quota', 'reconciled_at')
+    readonly_fields = ('bytes_used', 'file_count', 'reconciled_at')
+
+
+admin.site.register(StorageUsage, StorageUsageAdmin)
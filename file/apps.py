@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class FileConfig(AppConfig):
     name = 'file'
+
+    def ready(self):
+        from .responses import check_serve_mode
+
+        # A serve mode that does not match the storage would fail every download, so it fails the start instead.
+        check_serve_mode()
@@ -0,0 +1,110 @@
+# This file streams ZIP archives of several documents (see file.views.ArchiveDownload).
+# The archive is written by zipfile to an unseekable buffer, which is emptied after every chunk: zipfile then writes
+# the sizes and checksums of the entries in data descriptors after their data, so no temporary file is needed and
+# the memory used does not depend on the size of the archive. The first bytes are sent as soon as the first chunk of
+# the first file was read. Archives become ZIP64 archives where needed (entries or archives larger than 4 GiB, or
+# more than 65535 entries).
+
+import os
+import zipfile
+
+from django.http import StreamingHttpResponse
+
+from .responses import CHUNK_SIZE, get_content_disposition
+
+# Files of these types are compressed already, so they are stored instead of being deflated again.
+STORED_TYPES = (
+    'application/gzip', 'application/pdf', 'application/zip', 'image/gif', 'image/jpeg', 'image/png', 'image/webp'
+)
+STORED_EXTENSIONS = ('.7z', '.docx', '.gz', '.jpeg', '.jpg', '.mp3', '.mp4', '.pdf', '.png', '.pptx', '.xlsx', '.zip')
+
+
+class StreamBuffer:
+    'A write-only file for zipfile, whose content is taken out by the generator after each write.'
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return b''.join(chunks)
+
+
+def get_archive_names(documents):
+    'Return a unique name within the archive for each document, numbering documents with the same filename.'
+
+    names = []
+    used = set()
+
+    for document in documents:
+        filename = document.filename or os.path.basename(document.file.name)
+        filename = filename.replace('/', '_').replace('\\', '_') or str(document.pk)
+
+        name, number = filename, 1
+        while name.lower() in used:
+            number += 1
+            base, extension = os.path.splitext(filename)
+            name = '{} ({}){}'.format(base, number, extension)
+
+        used.add(name.lower())
+        names.append(name)
+
+    return names
+
+
+def get_compress_type(document, name):
+    if document.mime_type in STORED_TYPES or os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+
+    return zipfile.ZIP_DEFLATED
+
+
+def write_archive(documents):
+    buffer = StreamBuffer()
+
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+        for document, name in zip(documents, get_archive_names(documents)):
+            storage, file_name = document.file.storage, document.file.name
+            modified = storage.get_modified_time(file_name)
+
+            info = zipfile.ZipInfo(name, date_time=max(modified.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+            info.compress_type = get_compress_type(document, name)
+            info.external_attr = 0o644 << 16
+            # The size decides whether the entry needs ZIP64 headers, which have to be written before its data.
+            info.file_size = storage.size(file_name)
+
+            with storage.open(file_name, 'rb') as source, archive.open(info, 'w') as target:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                    target.write(chunk)
+                    yield buffer.take()
+
+            # The data descriptor, written when the entry is closed.
+            yield buffer.take()
+
+    # The central directory, written when the archive is closed.
+    yield buffer.take()
+
+
+def stream_archive(documents):
+    'Yield the bytes of a ZIP archive of the documents.'
+
+    # Chunks are empty while deflate buffers the data.
+    return filter(None, write_archive(documents))
+
+
+class ArchiveResponse(StreamingHttpResponse):
+    """
+    Streams a ZIP archive of documents. Under ASGI, file.asgi.DocumentASGIHandler iterates it in its thread pool, as
+    reading and compressing the files would block the event loop.
+    """
+
+    def __init__(self, documents, filename='documents.zip'):
+        super().__init__(stream_archive(documents), content_type='application/zip')
+        self['Content-Disposition'] = get_content_disposition(filename)
@@ -0,0 +1,108 @@
+# This file implements the ASGI handler of the project (see francy/asgi.py), which sends documents asynchronously.
+# Django 3.1 iterates streaming responses synchronously within the event loop, so every read of a downloaded file
+# would block all other requests of the process. The permission check still runs in the (sync) view, then the file
+# is sent by the event loop: reads are done by a small shared thread pool and each download only waits for the
+# client between them, so one process can serve thousands of slow clients. Downloads are aborted as soon as the client
+# disconnects, so that no thread keeps reading (or compressing) the rest of the file.
+
+import asyncio
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+
+from .archives import ArchiveResponse
+from .responses import FileRangeResponse
+from .versions import VersionResponse
+
+_executor = None
+
+# The receive callable of the current request, as Django passes none to send_response.
+_receive = contextvars.ContextVar('receive')
+
+
+def get_executor():
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.USERDATA_ASYNC_READ_THREADS,
+            thread_name_prefix='userdata-read'
+        )
+
+    return _executor
+
+
+class DocumentASGIHandler(ASGIHandler):
+    async def __call__(self, scope, receive, send):
+        _receive.set(receive)
+        await super().__call__(scope, receive, send)
+
+    async def send_response(self, response, send):
+        path = response.get_path() if isinstance(response, FileRangeResponse) else None
+
+        if path is not None:
+            chunks = response.async_chunks(path, get_executor())
+        elif isinstance(response, (ArchiveResponse, FileRangeResponse, VersionResponse)):
+            # Archives, versions and files of an object storage (which are read by requests to it).
+            chunks = iterate_in_executor(response)
+        else:
+            return await super().send_response(response, send)
+
+        response_headers = []
+        for header, value in response.items():
+            response_headers.append((header.encode('ascii'), value.encode('latin1')))
+        for cookie in response.cookies.values():
+            response_headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+
+        disconnect = asyncio.ensure_future(wait_for_disconnect(_receive.get()))
+
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': response_headers,
+            })
+
+            # The ASGI server applies back pressure: send() waits while the client does not receive the data.
+            async for chunk in chunks:
+                if disconnect.done():
+                    break
+
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True,
+                })
+            else:
+                await send({'type': 'http.response.body'})
+        finally:
+            disconnect.cancel()
+            await chunks.aclose()
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+async def wait_for_disconnect(receive):
+    'Return when the client disconnected. The request body has been read already.'
+
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def iterate_in_executor(response):
+    'Yield the chunks of a streaming response, which are produced in the thread pool (e.g. by reading files).'
+
+    loop = asyncio.get_event_loop()
+    iterator = iter(response)
+
+    while True:
+        chunk = await loop.run_in_executor(get_executor(), next, iterator, None)
+
+        if chunk is None:
+            break
+
+        yield chunk
@@ -0,0 +1,56 @@
+# This file implements the content-addressed storage of document files (see USERDATA_CONTENT_ADDRESSED).
+# Every distinct file is stored once under its SHA-256 and described by a FileBlob, which counts the documents
+# referring to it. The file is deleted when the last document referring to it is deleted.
+
+from django.db import transaction
+
+from .models import Document, FileBlob
+from .storage import create_blob_path
+
+
+def get_storage():
+    return Document._meta.get_field('file').storage
+
+
+def acquire_blob(checksum, size, content=None, path=None):
+    """Return the blob of the checksum with one more reference, storing the file if it is not stored yet.
+    The file is given as content (a Django File) or as the path of a local file (e.g. of an upload), which is moved."""
+
+    with transaction.atomic():
+        FileBlob.objects.get_or_create(checksum=checksum, defaults={'size': size})
+
+        # Lock the blob, so that it is not deleted by a concurrent release.
+        blob = FileBlob.objects.select_for_update().get(checksum=checksum)
+
+        get_storage().save_blob(blob.name, content=content, path=path)
+
+        blob.references += 1
+        blob.save(update_fields=['references'])
+
+    return blob
+
+
+def release_blob(checksum):
+    'Remove a reference to a blob. The blob and its file are deleted after the last reference is removed.'
+
+    with transaction.atomic():
+        blob = FileBlob.objects.select_for_update().filter(checksum=checksum).first()
+
+        if blob is None:
+            return
+
+        blob.references -= 1
+
+        if blob.references > 0:
+            blob.save(update_fields=['references'])
+            return
+
+        blob.delete()
+
+        # Only delete the file if the blob is gone, as another transaction could acquire it otherwise.
+        transaction.on_commit(lambda: delete_unreferenced_file(checksum))
+
+
+def delete_unreferenced_file(checksum):
+    if not FileBlob.objects.filter(checksum=checksum).exists():
+        get_storage().delete(create_blob_path(checksum))
@@ -0,0 +1,324 @@
+# This file implements the processing of uploaded documents, run by the process_documents command.
+# For each new file, the MIME type is detected from its content and thumbnails and previews are rendered at the sizes
+# of FILE_THUMBNAIL_SIZES and FILE_PREVIEW_SIZES: images are scaled by Pillow, the first page of PDFs is rendered by
+# poppler's pdftoppm (FILE_PDFTOPPM), which is optional. PDF previews are skipped if it is not installed.
+#
+# The versions recorded when the file of a document was replaced are stored as deltas afterwards (see file.versions).
+# Documents are claimed like the mails of the outbox (see mailing.outbox), so that several workers can run at once.
+# Only the files are processed in parallel, by a pool of threads; the database is updated from the worker's thread.
+
+import hashlib
+import io
+import mimetypes
+import os
+import shutil
+import subprocess
+import tempfile
+import uuid
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from PIL import Image
+
+from .models import Document, DocumentDerivative
+from .versions import encode_pending_versions
+
+# Leading bytes of the file formats which are detected. Text files are detected by decoding the head of the file.
+SIGNATURES = (
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'BM', 'image/bmp'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+)
+
+HEAD_SIZE = 4096
+
+IMAGE_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/tiff', 'image/bmp', 'image/webp')
+
+
+class ProcessingResult:
+    'The metadata and rendered derivatives of a file, see render_derivatives.'
+
+    def __init__(self, checksum, mime_type, page_count=None, derivatives=()):
+        self.checksum = checksum
+        self.mime_type = mime_type
+        self.page_count = page_count
+        self.derivatives = derivatives
+
+
+def sniff_mime_type(head, filename=None):
+    'Return the MIME type of a file, detected from its first bytes.'
+
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+
+    for signature, mime_type in SIGNATURES:
+        if head.startswith(signature):
+            # Office documents are zip files, which are told apart by their extension.
+            if mime_type == 'application/zip' and filename:
+                return mimetypes.guess_type(filename)[0] or mime_type
+
+            return mime_type
+
+    if b'\x00' in head:
+        return 'application/octet-stream'
+
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # The head may end within a multibyte character.
+        if len(head) < HEAD_SIZE or e.start < len(head) - 3:
+            return 'application/octet-stream'
+
+    return 'text/plain'
+
+
+def render_image(image, size):
+    'Return the image fitted into a square of the given size, as JPEG data, or PNG if it is transparent.'
+
+    image = image.copy()
+    image.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+
+    output = io.BytesIO()
+
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image.convert('RGBA').save(output, 'PNG', optimize=True)
+        return 'image/png', image.size, output.getvalue()
+
+    image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+    return 'image/jpeg', image.size, output.getvalue()
+
+
+def get_sizes():
+    return (
+        [(DocumentDerivative.THUMBNAIL, size) for size in settings.FILE_THUMBNAIL_SIZES] +
+        [(DocumentDerivative.PREVIEW, size) for size in settings.FILE_PREVIEW_SIZES]
+    )
+
+
+def render_derivatives(image):
+    'Return a tuple (kind, size, (content type, (width, height), data)) for each derivative of the image.'
+
+    sizes = get_sizes()
+    largest = max(size for kind, size in sizes)
+
+    # JPEG files are decoded at the smallest scale which is still larger than the largest derivative.
+    image.draft('RGB', (largest, largest))
+    image.load()
+
+    return [(kind, size, render_image(image, size)) for kind, size in sizes]
+
+
+def render_pdf_page(path):
+    'Render the first page of a PDF file with pdftoppm. Returns the page as an image, or None if it is not installed.'
+
+    command = shutil.which(settings.FILE_PDFTOPPM)
+
+    if command is None:
+        return None
+
+    largest = max(size for kind, size in get_sizes())
+
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'page')
+
+        subprocess.run(
+            [command, '-f', '1', '-l', '1', '-singlefile', '-png', '-scale-to', str(largest), path, output],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=settings.FILE_PROCESSING_TIMEOUT
+        )
+
+        with Image.open(output + '.png') as image:
+            image.load()
+            return image
+
+
+def get_pdf_page_count(path):
+    'Return the number of pages of a PDF file from pdfinfo, or None if it is not installed.'
+
+    command = shutil.which(settings.FILE_PDFINFO)
+
+    if command is None:
+        return None
+
+    result = subprocess.run(
+        [command, path],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=settings.FILE_PROCESSING_TIMEOUT
+    )
+
+    for line in result.stdout.decode('utf-8', 'replace').splitlines():
+        key, _, value = line.partition(':')
+
+        if key == 'Pages':
+            return int(value)
+
+    return None
+
+
+def local_path(storage, name):
+    'Return the local path of a stored file, and whether it is a temporary copy which has to be deleted.'
+
+    try:
+        return storage.path(name), False
+    except NotImplementedError:
+        pass
+
+    with storage.open(name, 'rb') as source, tempfile.NamedTemporaryFile(delete=False) as target:
+        shutil.copyfileobj(source, target)
+
+    return target.name, True
+
+
+def process_file(storage, name, filename=None):
+    'Return the ProcessingResult of a stored file. Does not access the database, so it can run in any thread.'
+
+    checksum = hashlib.sha256()
+
+    with storage.open(name, 'rb') as f:
+        head = f.read(HEAD_SIZE)
+        checksum.update(head)
+
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(chunk)
+
+    mime_type = sniff_mime_type(head, filename)
+    result = ProcessingResult(checksum.hexdigest(), mime_type)
+
+    if mime_type in IMAGE_TYPES:
+        with storage.open(name, 'rb') as f, Image.open(f) as image:
+            result.page_count = getattr(image, 'n_frames', 1)
+            result.derivatives = render_derivatives(image)
+    elif mime_type == 'application/pdf':
+        path, temporary = local_path(storage, name)
+
+        try:
+            result.page_count = get_pdf_page_count(path)
+            page = render_pdf_page(path)
+
+            if page is not None:
+                result.derivatives = render_derivatives(page)
+        finally:
+            if temporary:
+                os.remove(path)
+
+    return result
+
+
+def claim_batch(batch_size):
+    'Claim up to batch_size pending documents, so that no other worker processes them while the claim lasts.'
+
+    now = timezone.now()
+    token = uuid.uuid4()
+
+    claimable = Document.objects.filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now),
+        processing_status=Document.PENDING
+    )
+
+    ids = list(claimable.order_by('id').values_list('id', flat=True)[:batch_size])
+
+    # Another worker may have claimed some of the documents in the meantime, therefore the filter is repeated.
+    claimable.filter(id__in=ids).update(
+        claim_token=token,
+        claimed_until=now + timedelta(seconds=settings.FILE_PROCESSING_CLAIM_DURATION)
+    )
+
+    return list(Document.objects.filter(claim_token=token).order_by('id'))
+
+
+def complete(document, result):
+    'Store the derivatives and metadata of a processed document, replacing previous derivatives.'
+
+    derivatives = []
+
+    for kind, size, (content_type, (width, height), data) in result.derivatives:
+        derivative = DocumentDerivative(
+            document=document,
+            kind=kind,
+            size=size,
+            content_type=content_type,
+            width=width,
+            height=height,
+            checksum=hashlib.sha256(data).hexdigest()
+        )
+
+        extension = '.png' if content_type == 'image/png' else '.jpg'
+        derivative.file.save('{}-{}{}'.format(kind, size, extension), ContentFile(data), save=False)
+        derivatives.append(derivative)
+
+    with transaction.atomic():
+        # The file may have been replaced during the processing, the claim token tells.
+        updated = Document.objects.filter(pk=document.pk, claim_token=document.claim_token).update(
+            checksum=result.checksum,
+            mime_type=result.mime_type,
+            page_count=result.page_count,
+            processing_status=Document.PROCESSED,
+            processing_error=None,
+            processed_at=timezone.now(),
+            claim_token=None,
+            claimed_until=None
+        )
+
+        if updated:
+            for derivative in document.derivatives.all():
+                derivative.delete()
+
+            DocumentDerivative.objects.bulk_create(derivatives)
+
+    if not updated:
+        for derivative in derivatives:
+            derivative.file.delete(save=False)
+
+
+def fail(document, error):
+    Document.objects.filter(pk=document.pk, claim_token=document.claim_token).update(
+        processing_status=Document.FAILED,
+        processing_error=repr(error),
+        processed_at=timezone.now(),
+        claim_token=None,
+        claimed_until=None
+    )
+
+
+def process_batch(executor, batch_size=20):
+    'Claim and process a batch of pending documents in the executor. Returns a tuple (processed, failed).'
+
+    processed = failed = 0
+    documents = claim_batch(batch_size)
+
+    tasks = [
+        executor.submit(process_file, document.file.storage, document.file.name, document.filename)
+        for document in documents
+    ]
+
+    for document, task in zip(documents, tasks):
+        try:
+            result = task.result()
+        except Exception as e:
+            fail(document, e)
+            failed += 1
+        else:
+            complete(document, result)
+            processed += 1
+
+        # A replaced file was recorded in full, as a new version.
+        encode_pending_versions(document)
+
+    return processed, failed
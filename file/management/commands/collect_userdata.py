@@ -0,0 +1,144 @@
+import os
+import shutil
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from file.models import ChunkedUpload, Document, DocumentDerivative, DocumentVersion, FileBlob
+from file.uploads import cancel_upload
+
+
+def walk(root, directory=''):
+    'Yield the paths of all files below root, relative to root, without listing the whole tree at once.'
+
+    with os.scandir(os.path.join(root, directory)) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+
+    for entry in entries:
+        path = os.path.join(directory, entry.name)
+
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(root, path)
+        elif entry.is_file(follow_symlinks=False):
+            yield path, entry
+
+
+def get_referenced(paths):
+    'Return the paths of the batch which are used by a document, a derivative, a version, a blob or an upload.'
+
+    referenced = set(Document.objects.filter(file__in=paths).values_list('file', flat=True))
+    referenced.update(DocumentDerivative.objects.filter(file__in=paths).values_list('file', flat=True))
+    referenced.update(DocumentVersion.objects.filter(file__in=paths).values_list('file', flat=True))
+    referenced.update(ChunkedUpload.objects.filter(file_name__in=paths).values_list('file_name', flat=True))
+
+    checksums = {os.path.basename(path): path for path in paths if path.startswith('blobs' + os.sep)}
+    for checksum in FileBlob.objects.filter(checksum__in=checksums).values_list('checksum', flat=True):
+        referenced.add(checksums[checksum])
+
+    return referenced
+
+
+# Files are compared against the database in batches, so that neither the file tree nor the file names stored in
+# the database are loaded at once. Only files older than --min-age are removed, as uploaded files are stored before
+# their document is saved.
+class Command(BaseCommand):
+    help = 'Removes files in USERDATA_ROOT which do not belong to any document, derivative, version, blob or upload.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the files which would be removed.')
+        parser.add_argument('--quarantine', help='Move the files to this directory instead of deleting them.')
+        parser.add_argument('--min-age', type=float, default=24, help='Hours since a file was last modified.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Files looked up per query.')
+        parser.add_argument('--rate', type=float, default=0, help='Maximum files removed per second (0: no limit).')
+
+    def handle(self, *args, **options):
+        self.root = os.path.abspath(settings.USERDATA_ROOT)
+        self.options = options
+        self.removed = self.removed_bytes = 0
+
+        quarantine = options['quarantine'] and os.path.abspath(options['quarantine'])
+        if quarantine and (quarantine + os.sep).startswith(self.root + os.sep):
+            raise CommandError('The quarantine directory must not be inside USERDATA_ROOT.')
+
+        if not options['dry_run']:
+            expired = ChunkedUpload.objects.filter(document__isnull=True, expires_at__lt=timezone.now())
+            for upload in expired.iterator():
+                cancel_upload(upload)
+
+        self.min_mtime = time.time() - options['min_age'] * 60 * 60
+        self.last_removal = 0.0
+        batch = []
+        checked = 0
+
+        if os.path.isdir(self.root):
+            for path, entry in walk(self.root):
+                batch.append((path, entry))
+                checked += 1
+
+                if len(batch) >= options['batch_size']:
+                    self.collect(batch)
+                    batch = []
+
+            self.collect(batch)
+
+        self.stdout.write('{} {} of {} files ({} bytes).'.format(
+            'Would remove' if options['dry_run'] else 'Removed', self.removed, checked, self.removed_bytes
+        ))
+
+    def collect(self, batch):
+        if not batch:
+            return
+
+        referenced = get_referenced([path for path, entry in batch])
+
+        for path, entry in batch:
+            if path in referenced:
+                continue
+
+            stat = entry.stat(follow_symlinks=False)
+
+            if stat.st_mtime > self.min_mtime:
+                continue
+
+            self.removed += 1
+            self.removed_bytes += stat.st_size
+
+            if self.options['dry_run']:
+                self.stdout.write(path)
+                continue
+
+            self.wait()
+            self.remove(path)
+
+    def wait(self):
+        'Limit the removals per second, so that the volume stays responsive.'
+
+        if not self.options['rate']:
+            return
+
+        delay = self.last_removal + 1 / self.options['rate'] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        self.last_removal = time.monotonic()
+
+    def remove(self, path):
+        absolute_path = os.path.join(self.root, path)
+
+        if self.options['quarantine']:
+            target = os.path.join(self.options['quarantine'], path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(absolute_path, target)
+        else:
+            os.remove(absolute_path)
+
+        # Remove directories which became empty, e.g. the unique directory of a document.
+        directory = os.path.dirname(absolute_path)
+        while directory != self.root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
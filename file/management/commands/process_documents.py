@@ -0,0 +1,39 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from file.derivatives import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Detects the MIME type of new documents and renders their thumbnails and previews.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20, help='Documents claimed at once.')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running and poll for new documents instead of stopping once all are processed.'
+        )
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between two polls when idle.')
+        parser.add_argument('--workers', type=int, default=4, help='Threads processing files in parallel.')
+
+    def handle(self, *args, **options):
+        total_processed = total_failed = 0
+
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='process-documents') as executor:
+            while True:
+                processed, failed = process_batch(executor, options['batch_size'])
+                total_processed += processed
+                total_failed += failed
+
+                if processed or failed:
+                    continue
+
+                if not options['loop']:
+                    break
+
+                time.sleep(options['interval'])
+
+        self.stdout.write('Processed {} documents, {} failed.'.format(total_processed, total_failed))
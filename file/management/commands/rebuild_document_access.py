@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from file.acl import refresh_access
+from file.models import Document
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the read permissions of all documents (DocumentAccess) from their owners and shares.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Documents recomputed per transaction.')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to wait between two batches.')
+
+    def handle(self, *args, **options):
+        last_id = 0
+        total = 0
+
+        while True:
+            documents = Document.objects.filter(pk__gt=last_id).order_by('pk')
+            ids = list(documents.values_list('pk', flat=True)[:options['batch_size']])
+
+            if not ids:
+                break
+
+            refresh_access(ids)
+            total += len(ids)
+            last_id = ids[-1]
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write('Recomputed the access to {} documents.'.format(total))
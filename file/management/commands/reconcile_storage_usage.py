@@ -0,0 +1,76 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from file.models import Document, DocumentVersion, StorageUsage
+from file.quota import get_versions_size
+from user.models import User
+
+
+def fill_sizes(documents):
+    'Store the sizes of documents saved before sizes were stored.'
+
+    for document in documents.filter(size__isnull=True).iterator():
+        try:
+            size = document.file.size if document.file else 0
+        except FileNotFoundError:
+            size = 0
+
+        Document.objects.filter(pk=document.pk).update(size=size)
+
+
+def reconcile(user_id):
+    'Recompute the storage usage of a user. Returns whether the counters were wrong.'
+
+    with transaction.atomic():
+        # Locking the counters makes concurrent documents wait until the sum was calculated.
+        StorageUsage.objects.get_or_create(user_id=user_id)
+        usage = StorageUsage.objects.select_for_update().get(user_id=user_id)
+
+        totals = Document.objects.filter(owner=user_id).aggregate(bytes_used=Sum('size'), file_count=Count('id'))
+        bytes_used, file_count = totals['bytes_used'] or 0, totals['file_count']
+        bytes_used += get_versions_size(DocumentVersion.objects.filter(document__owner=user_id))
+        changed = (usage.bytes_used, usage.file_count) != (bytes_used, file_count)
+
+        usage.bytes_used = bytes_used
+        usage.file_count = file_count
+        usage.reconciled_at = timezone.now()
+        usage.save()
+
+    return changed
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the storage usage counters of all users from their documents.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Users reconciled per batch.')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to wait between two batches.')
+
+    def handle(self, *args, **options):
+        last_id = 0
+        total = corrected = 0
+
+        while True:
+            ids = list(
+                User.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:options['batch_size']]
+            )
+
+            if not ids:
+                break
+
+            fill_sizes(Document.objects.filter(owner__in=ids).only('id', 'file'))
+
+            for user_id in ids:
+                corrected += reconcile(user_id)
+
+            total += len(ids)
+            last_id = ids[-1]
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write('Reconciled the storage usage of {} users, {} were corrected.'.format(total, corrected))
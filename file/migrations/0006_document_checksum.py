@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0005_auto_20210601_1323'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='checksum',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
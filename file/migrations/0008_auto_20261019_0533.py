@@ -0,0 +1,40 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+import file.models
+import file.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0007_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileBlob',
+            fields=[
+                ('checksum', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.BigIntegerField()),
+                ('references', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='filename',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='file',
+            field=file.models.DocumentFileField(max_length=255, storage=file.storage.UserDataFileStorage(), upload_to=file.storage.create_file_path),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='file.fileblob'),
+        ),
+    ]
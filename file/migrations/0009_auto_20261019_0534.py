@@ -0,0 +1,25 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:34
+
+from django.db import migrations, models
+import file.models
+import file.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0008_auto_20261019_0533'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chunkedupload',
+            name='file_name',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='file',
+            field=file.models.DocumentFileField(db_index=True, max_length=255, storage=file.storage.UserDataFileStorage(), upload_to=file.storage.create_file_path),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+import file.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0009_auto_20261019_0534'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='claim_token',
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='mime_type',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='page_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='processing_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='processing_status',
+            field=models.IntegerField(choices=[(0, 'Pending'), (1, 'Processed'), (2, 'Failed')], db_index=True, default=0),
+        ),
+        migrations.CreateModel(
+            name='DocumentDerivative',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('thumbnail', 'Thumbnail'), ('preview', 'Preview')], max_length=20)),
+                ('size', models.IntegerField()),
+                ('file', models.FileField(db_index=True, max_length=255, storage=file.storage.UserDataFileStorage(), upload_to=file.storage.create_derivative_path)),
+                ('content_type', models.CharField(max_length=100)),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='file.document')),
+            ],
+            options={
+                'ordering': ['kind', 'size'],
+                'unique_together': {('document', 'kind', 'size')},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0010_document_processing'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['owner', 'created_at', 'id'], name='file_docume_owner_i_5f8668_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['created_at', 'id'], name='file_docume_created_80d3f3_idx'),
+        ),
+    ]
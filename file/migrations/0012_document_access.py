@@ -0,0 +1,73 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def grant_owners(apps, schema_editor):
+    'Let the owners of the existing documents read them.'
+
+    Document = apps.get_model('file', 'Document')
+    DocumentAccess = apps.get_model('file', 'DocumentAccess')
+
+    batch = []
+
+    for document_id, owner_id in Document.objects.values_list('id', 'owner_id').iterator():
+        batch.append(DocumentAccess(document_id=document_id, user_id=owner_id))
+
+        if len(batch) >= 1000:
+            DocumentAccess.objects.bulk_create(batch)
+            batch = []
+
+    DocumentAccess.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0027_usergroup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('file', '0011_document_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentShare',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shares', to='file.document')),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='document_shares', to='user.usergroup')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='document_shares', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DocumentAccess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access', to='file.document')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Document access',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='documentshare',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('group__isnull', True), ('user__isnull', False)), models.Q(('group__isnull', False), ('user__isnull', True)), _connector='OR'), name='file_documentshare_user_or_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='documentshare',
+            constraint=models.UniqueConstraint(fields=('document', 'user'), name='file_documentshare_unique_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='documentshare',
+            constraint=models.UniqueConstraint(fields=('document', 'group'), name='file_documentshare_unique_group'),
+        ),
+        migrations.AddConstraint(
+            model_name='documentaccess',
+            constraint=models.UniqueConstraint(fields=('user', 'document'), name='file_documentaccess_user_document'),
+        ),
+        migrations.RunPython(grant_owners, migrations.RunPython.noop),
+    ]
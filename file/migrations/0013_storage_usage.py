@@ -0,0 +1,33 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0027_usergroup'),
+        ('file', '0012_document_access'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_usage', serialize=False, to='user.user')),
+                ('bytes_used', models.BigIntegerField(default=0)),
+                ('file_count', models.IntegerField(default=0)),
+                ('quota', models.BigIntegerField(blank=True, null=True)),
+                ('reconciled_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Storage usage',
+            },
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
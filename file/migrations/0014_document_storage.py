@@ -0,0 +1,25 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:58
+
+from django.db import migrations, models
+import file.models
+import file.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0013_storage_usage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='document',
+            name='file',
+            field=file.models.DocumentFileField(db_index=True, max_length=255, storage=file.storage.get_userdata_storage, upload_to=file.storage.create_file_path),
+        ),
+        migrations.AlterField(
+            model_name='documentderivative',
+            name='file',
+            field=models.FileField(db_index=True, max_length=255, storage=file.storage.get_userdata_storage, upload_to=file.storage.create_derivative_path),
+        ),
+    ]
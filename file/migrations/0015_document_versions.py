@@ -0,0 +1,46 @@
+# Generated by Django 3.1.2 on 2026-10-19 06:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+import file.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0014_document_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='replaces',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='version_uploads', to='file.document'),
+        ),
+        migrations.AlterField(
+            model_name='chunkedupload',
+            name='document',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='uploads', to='file.document'),
+        ),
+        migrations.CreateModel(
+            name='DocumentVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('snapshot_number', models.IntegerField()),
+                ('kind', models.CharField(choices=[('snapshot', 'Snapshot'), ('delta', 'Delta')], max_length=20)),
+                ('file', models.FileField(db_index=True, max_length=255, storage=file.storage.get_userdata_storage, upload_to=file.storage.create_version_path)),
+                ('size', models.BigIntegerField()),
+                ('stored_size', models.BigIntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('filename', models.CharField(blank=True, max_length=255, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('blob', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='file.fileblob')),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='file.document')),
+            ],
+            options={
+                'ordering': ['-number'],
+                'unique_together': {('document', 'number')},
+            },
+        ),
+    ]
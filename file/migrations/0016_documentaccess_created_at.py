@@ -0,0 +1,39 @@
+# Generated by Django 3.1.2 on 2026-10-19 06:34
+
+from django.db import migrations, models
+
+
+def copy_created_at(apps, schema_editor):
+    'Copy the creation times of the documents into their access rows.'
+
+    Document = apps.get_model('file', 'Document')
+    DocumentAccess = apps.get_model('file', 'DocumentAccess')
+
+    DocumentAccess.objects.update(
+        created_at=models.Subquery(Document.objects.filter(pk=models.OuterRef('document')).values('created_at')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0015_document_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentaccess',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(copy_created_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='documentaccess',
+            name='created_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddIndex(
+            model_name='documentaccess',
+            index=models.Index(fields=['user', 'created_at', 'document'], name='file_docume_user_id_cc757e_idx'),
+        ),
+    ]
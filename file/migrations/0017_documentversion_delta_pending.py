@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-19 06:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file', '0016_documentaccess_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='delta_pending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,27 +1,470 @@
-from django.db import models
+import hashlib
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.template.defaultfilters import slugify
 
-from user.models import User
+from user.models import User, UserGroup
+
+from .storage import (
+    create_blob_path, create_derivative_path, create_file_path, create_version_path, get_userdata_storage
+)
+
+
+class FileBlob(models.Model):
+    """
+    A file stored once under its SHA-256, shared by all documents with the same content (see file.blobs).
+    """
+
+    checksum = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    # The number of documents referring to the blob.
+    references = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.checksum
 
-from .storage import create_file_path, UserDataFileStorage
+    @property
+    def name(self):
+        return create_blob_path(self.checksum)
+
+
+class DocumentFieldFile(models.fields.files.FieldFile):
+    def save(self, name, content, save=True):
+        if not settings.USERDATA_CONTENT_ADDRESSED:
+            return super().save(name, content, save)
+
+        # Content-addressed files are stored by Document.save, as their name depends on the checksum.
+        self.name = name
+        self.file = content
+        self._committed = False
+
+        if save:
+            self.instance.save()
+
+
+class DocumentFileField(models.FileField):
+    attr_class = DocumentFieldFile
 
 
 class Document(models.Model):
+    # Processing of the file by the process_documents command (see file.derivatives).
+    PENDING = 0
+    PROCESSED = 1
+    FAILED = 2
+
+    PROCESSING_STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSED, 'Processed'),
+        (FAILED, 'Failed'),
+    )
+
     title = models.CharField(max_length=200, blank=True, null=True)
     description = models.TextField(blank=True, null=True)
-    file = models.FileField(upload_to=create_file_path, storage=UserDataFileStorage(), max_length=255)
+    file = DocumentFileField(upload_to=create_file_path, storage=get_userdata_storage, max_length=255, db_index=True)
     owner = models.ForeignKey(User, on_delete=models.PROTECT)
     created_at = models.DateTimeField(auto_now_add=True)
     slug = models.SlugField(max_length=255, blank=True, null=True)
+    # SHA-256 of the file, used as the ETag of downloads.
+    checksum = models.CharField(max_length=64, blank=True, null=True)
+    # The name of the uploaded file, as the stored file may be named by its checksum.
+    filename = models.CharField(max_length=255, blank=True, null=True)
+    # The shared file, if the document was stored content-addressed.
+    blob = models.ForeignKey(FileBlob, null=True, blank=True, on_delete=models.PROTECT)
+    # The size of the file in bytes, counted in the StorageUsage of the owner.
+    size = models.BigIntegerField(blank=True, null=True)
+
+    # Metadata detected from the content of the file.
+    mime_type = models.CharField(max_length=100, blank=True, null=True)
+    page_count = models.IntegerField(blank=True, null=True)
+
+    processing_status = models.IntegerField(choices=PROCESSING_STATUS_CHOICES, default=PENDING, db_index=True)
+    processing_error = models.TextField(blank=True, null=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    # A worker claims documents by setting a token and a lease, see file.derivatives.claim_batch.
+    claim_token = models.UUIDField(null=True, blank=True, db_index=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['-created_at']
+        # The documents query pages through the documents of a user (or all documents, for admins) by creation.
+        indexes = [
+            models.Index(fields=['owner', 'created_at', 'id']),
+            models.Index(fields=['created_at', 'id']),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.id and self.title:
             self.slug = slugify(self.title)
 
-        return super(Document, self).save(*args, **kwargs)
+        from .blobs import acquire_blob, release_blob
+        from .quota import get_versions_size, update_usage
+        from .versions import add_version
+
+        with transaction.atomic():
+            previous = None
+            if self.pk:
+                previous = Document.objects.filter(pk=self.pk).values_list(
+                    'owner_id', 'size', 'blob_id', 'file', 'checksum', 'filename'
+                ).first()
+
+            new_file = self.file and not self.file._committed
+            # Without content-addressing, FieldFile.save stores a replacing file before the document is saved.
+            changed_file = new_file or (previous is not None and previous[3] != self.file.name)
+
+            # Calculate the checksum of new files (before they are stored), of replacing files unless it was given
+            # (e.g. by a complete upload) and of files stored without one.
+            if self.file and (new_file or not self.checksum or (changed_file and self.checksum == previous[4])):
+                self.checksum = self.calculate_checksum()
+
+            if changed_file:
+                # Content-addressed names are no filenames, the filename of such a file is given with it.
+                if new_file or (self.filename == previous[5] and not self.blob_id):
+                    self.filename = os.path.basename(self.file.name)
+                # The derivatives of a replaced file are replaced by the next processing.
+                self.processing_status = Document.PENDING
+                self.claim_token = None
+                self.claimed_until = None
+
+            if changed_file or (self.file and self.size is None):
+                self.size = self.file.size if self.file else None
+
+            if new_file and settings.USERDATA_CONTENT_ADDRESSED:
+                self.blob = acquire_blob(self.checksum, self.file.size, content=self.file)
+                self.file.name = self.blob.name
+                self.file._committed = True
+
+            super(Document, self).save(*args, **kwargs)
+
+            # The versions of a document of another owner move to the counters of the new owner.
+            if previous is not None and previous[0] != self.owner_id:
+                versions_size = get_versions_size(self.versions.all(), previous[3])
+
+                if versions_size:
+                    update_usage(previous[0], -versions_size, 0)
+                    update_usage(self.owner_id, versions_size, 0)
+
+            # Record the replaced and the new file in the version history (see file.versions).
+            if changed_file and previous is not None and previous[3]:
+                add_version(self, (previous[3], previous[2], previous[4], previous[1], previous[5]))
+
+            if new_file and settings.USERDATA_CONTENT_ADDRESSED and previous and previous[2]:
+                release_blob(previous[2])
+
+            # Count new documents, and move replaced files or documents of another owner between the counters.
+            if previous is None:
+                update_usage(self.owner_id, self.size or 0, 1)
+            elif previous[:2] != (self.owner_id, self.size):
+                update_usage(previous[0], -(previous[1] or 0), -1)
+                update_usage(self.owner_id, self.size or 0, 1)
+
+    def calculate_checksum(self):
+        checksum = hashlib.sha256()
+
+        for chunk in self.file.chunks():
+            checksum.update(chunk)
+
+        return checksum.hexdigest()
+
+    def update_checksum(self):
+        'Store the checksum of a file stored before checksums were introduced.'
+
+        self.checksum = self.calculate_checksum()
+        Document.objects.filter(pk=self.pk).update(checksum=self.checksum)
+
+
+class DocumentDerivative(models.Model):
+    """
+    A file derived from the file of a document, e.g. a thumbnail of an image or a preview of the first page of a PDF,
+    created by the process_documents command (see file.derivatives).
+    """
+
+    THUMBNAIL = 'thumbnail'
+    PREVIEW = 'preview'
+
+    KIND_CHOICES = (
+        (THUMBNAIL, 'Thumbnail'),
+        (PREVIEW, 'Preview'),
+    )
+
+    document = models.ForeignKey(Document, related_name='derivatives', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # The size of the square the image was fitted into.
+    size = models.IntegerField()
+    file = models.FileField(
+        upload_to=create_derivative_path, storage=get_userdata_storage, max_length=255, db_index=True
+    )
+    content_type = models.CharField(max_length=100)
+    width = models.IntegerField()
+    height = models.IntegerField()
+    checksum = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['kind', 'size']
+        unique_together = [('document', 'kind', 'size')]
+
+    def __str__(self):
+        return '{} {} of {}'.format(self.kind, self.size, self.document)
+
+    @property
+    def filename(self):
+        return os.path.basename(self.file.name)
+
+
+class DocumentVersion(models.Model):
+    """
+    A version of the file of a document, recorded whenever the file is replaced (see file.versions). It is stored
+    in full (a snapshot, which shares the file or blob of the document) or as a delta against the previous version.
+    """
+
+    SNAPSHOT = 'snapshot'
+    DELTA = 'delta'
+
+    KIND_CHOICES = (
+        (SNAPSHOT, 'Snapshot'),
+        (DELTA, 'Delta'),
+    )
+
+    document = models.ForeignKey(Document, related_name='versions', on_delete=models.CASCADE)
+    number = models.IntegerField()
+    # The number of the snapshot the deltas up to this version are applied to.
+    snapshot_number = models.IntegerField()
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    file = models.FileField(
+        upload_to=create_version_path, storage=get_userdata_storage, max_length=255, db_index=True
+    )
+    # The shared file of a snapshot of a content-addressed document.
+    blob = models.ForeignKey(FileBlob, null=True, blank=True, related_name='+', on_delete=models.PROTECT)
+    # The size of the version's content and the size of its stored file (the delta or the snapshot).
+    size = models.BigIntegerField()
+    stored_size = models.BigIntegerField()
+    checksum = models.CharField(max_length=64)
+    filename = models.CharField(max_length=255, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Whether the version was recorded in full by Document.save and may still be stored as a delta by
+    # process_documents (see file.versions.encode_pending_versions).
+    delta_pending = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ['-number']
+        unique_together = [('document', 'number')]
+
+    def __str__(self):
+        return 'Version {} of {}'.format(self.number, self.document)
+
+
+class StorageUsage(models.Model):
+    """
+    The storage used by the documents of a user and their versions. The counters are updated with every saved or
+    deleted document and recomputed by the reconcile_storage_usage command (see file.quota).
+    """
+
+    user = models.OneToOneField(User, primary_key=True, related_name='storage_usage', on_delete=models.CASCADE)
+    bytes_used = models.BigIntegerField(default=0)
+    file_count = models.IntegerField(default=0)
+    # The quota of the user in bytes, if it differs from FILE_STORAGE_QUOTA.
+    quota = models.BigIntegerField(blank=True, null=True)
+    reconciled_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name_plural = 'Storage usage'
+
+    def __str__(self):
+        return str(self.user)
+
+
+class DocumentShare(models.Model):
+    """
+    A document shared with a user or with a group of users. The resulting permissions are stored in DocumentAccess.
+    """
+
+    document = models.ForeignKey(Document, related_name='shares', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, null=True, blank=True, related_name='document_shares', on_delete=models.CASCADE)
+    group = models.ForeignKey(
+        UserGroup, null=True, blank=True, related_name='document_shares', on_delete=models.CASCADE
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=(
+                    models.Q(user__isnull=False, group__isnull=True) | models.Q(user__isnull=True, group__isnull=False)
+                ),
+                name='file_documentshare_user_or_group'
+            ),
+            models.UniqueConstraint(fields=['document', 'user'], name='file_documentshare_unique_user'),
+            models.UniqueConstraint(fields=['document', 'group'], name='file_documentshare_unique_group'),
+        ]
+
+    def __str__(self):
+        return '{} shared with {}'.format(self.document_id, self.user or self.group)
+
+
+class DocumentAccess(models.Model):
+    """
+    The users who may read a document: its owner, the users it is shared with and the members of the groups it is
+    shared with. Derived from the documents and shares by file.acl, so that a permission check is a single lookup
+    of the (user, document) index. Admins may read every document and have no rows.
+    """
+
+    # The unique constraint indexes the user first, which covers the lookups of a user's documents.
+    user = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE, db_index=False)
+    document = models.ForeignKey(Document, related_name='access', on_delete=models.CASCADE)
+    # A copy of the creation time of the document, so that the documents a user may read are paged through (newest
+    # first) on the index of this table, without sorting all of them.
+    created_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name_plural = 'Document access'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'document'], name='file_documentaccess_user_document'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'document']),
+        ]
+
+
+class ChunkedUpload(models.Model):
+    """
+    A resumable upload of a document (see file.uploads). The chunks are written to the final location of the file,
+    which becomes the file of a new document (or of the replaced document) when the upload is complete.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    title = models.CharField(max_length=200, blank=True, null=True)
+    filename = models.CharField(max_length=255)
+    # The path of the file within the storage, see create_file_path.
+    file_name = models.CharField(max_length=255, db_index=True)
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    # The document which was created or replaced by the complete upload.
+    document = models.ForeignKey(Document, null=True, blank=True, related_name='uploads', on_delete=models.SET_NULL)
+    # The document whose file is replaced by the upload, if any.
+    replaces = models.ForeignKey(
+        Document, null=True, blank=True, related_name='version_uploads', on_delete=models.CASCADE
+    )
+
+    def __str__(self):
+        return self.filename
+
+
+# The documents being deleted by the current thread, whose shares are deleted with them.
+_deleting = threading.local()
+
+
+def get_deleting_documents():
+    if not hasattr(_deleting, 'documents'):
+        _deleting.documents = set()
+    return _deleting.documents
+
+
+@receiver(pre_delete, sender=Document)
+def mark_deleting_document(sender, instance, **kwargs):
+    get_deleting_documents().add(instance.pk)
+
+
+@receiver(post_delete, sender=Document)
+def unmark_deleting_document(sender, instance, **kwargs):
+    get_deleting_documents().discard(instance.pk)
+
+
+@receiver(post_delete, sender=Document)
+def delete_document_file(sender, instance, **kwargs):
+    'Delete the file of a deleted document, or remove its reference to a shared file.'
+
+    if instance.blob_id:
+        from .blobs import release_blob
+        release_blob(instance.blob_id)
+    elif instance.file:
+        storage, name = instance.file.storage, instance.file.name
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver(post_delete, sender=Document)
+def release_document_usage(sender, instance, **kwargs):
+    from .quota import update_usage
+    update_usage(instance.owner_id, -(instance.size or 0), -1)
+
+
+@receiver(post_delete, sender=DocumentDerivative)
+def delete_derivative_file(sender, instance, **kwargs):
+    storage, name = instance.file.storage, instance.file.name
+    transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver(post_delete, sender=DocumentVersion)
+def delete_version_file(sender, instance, **kwargs):
+    'Delete the delta of a deleted version, or release the file it shares with the document.'
+
+    from .quota import update_usage
+
+    # Snapshots sharing the current file of the document are counted with it (see file.quota).
+    document = Document.objects.filter(pk=instance.document_id).values_list('owner_id', 'file').first()
+
+    if document and not (instance.kind == DocumentVersion.SNAPSHOT and instance.file.name == document[1]):
+        update_usage(document[0], -instance.stored_size, 0)
+
+    if instance.blob_id:
+        from .blobs import release_blob
+        release_blob(instance.blob_id)
+    else:
+        from .versions import delete_unreferenced_file
+        storage, name = instance.file.storage, instance.file.name
+        transaction.on_commit(lambda: delete_unreferenced_file(storage, name))
+
+
+@receiver(post_save, sender=Document)
+def update_document_access(sender, instance, created, update_fields=None, **kwargs):
+    from .acl import grant_owner, refresh_access
+
+    if created:
+        grant_owner(instance)
+    elif update_fields is None or 'owner' in update_fields:
+        refresh_access([instance.pk])
+
+
+@receiver(post_save, sender=DocumentShare)
+@receiver(post_delete, sender=DocumentShare)
+def update_shared_document_access(sender, instance, **kwargs):
+    from .acl import refresh_access
+
+    # The access rows of a deleted document are deleted with it; refreshing them would grant the owner again.
+    if kwargs.get('signal') is post_delete and instance.document_id in get_deleting_documents():
+        return
+
+    refresh_access([instance.document_id])
+
+
+@receiver(m2m_changed, sender=UserGroup.members.through)
+def update_group_document_access(sender, instance, action, reverse, pk_set, **kwargs):
+    'Update the access to the documents shared with a group, whose members changed.'
+
+    from .acl import refresh_access
+
+    if action == 'pre_clear':
+        # The groups of a user are not known after they were cleared.
+        instance._cleared_groups = list(instance.user_groups.values_list('pk', flat=True)) if reverse else []
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
 
+    if not reverse:
+        groups = [instance.pk]
+    elif action == 'post_clear':
+        groups = instance._cleared_groups
+    else:
+        groups = pk_set
 
-# TODO: Remove files when the corresponding object is deleted
+    refresh_access(DocumentShare.objects.filter(group__in=groups).values_list('document_id', flat=True))
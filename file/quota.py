@@ -0,0 +1,82 @@
+# This file implements the storage quotas of users. The size and the number of the documents of each user are kept in
+# counters (StorageUsage), which are updated in the transaction saving or deleting a document (see Document.save),
+# so that checking the quota does not have to sum up the sizes of all documents.
+# The files of the versions of documents (see file.versions) are counted in bytes_used as well, except for snapshots
+# sharing the current file of their document, which is counted with the document.
+# The reconcile_storage_usage command recomputes the counters, e.g. after documents were changed with update().
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import ChunkedUpload, DocumentVersion, StorageUsage
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def update_usage(user_id, size, count):
+    'Add size bytes and count files to the storage usage of the user.'
+
+    usage = StorageUsage.objects.filter(user_id=user_id)
+
+    if usage.update(bytes_used=F('bytes_used') + size, file_count=F('file_count') + count):
+        return
+
+    try:
+        with transaction.atomic():
+            StorageUsage.objects.create(user_id=user_id, bytes_used=size, file_count=count)
+    except IntegrityError:
+        # Created by a concurrent transaction.
+        usage.update(bytes_used=F('bytes_used') + size, file_count=F('file_count') + count)
+
+
+def get_versions_size(versions, current_file=None):
+    """Return the bytes stored by versions, without the snapshots sharing the current file of their document.
+    current_file overrides the name of this file, for the versions of one document."""
+
+    versions = versions.exclude(
+        kind=DocumentVersion.SNAPSHOT, file=current_file if current_file is not None else F('document__file')
+    )
+    return versions.aggregate(stored_size=Sum('stored_size'))['stored_size'] or 0
+
+
+def get_usage(user):
+    return StorageUsage.objects.filter(user=user).first() or StorageUsage(user=user)
+
+
+def get_quota(usage):
+    'Return the quota of a StorageUsage in bytes, or None if it is unlimited.'
+
+    return usage.quota if usage.quota is not None else settings.FILE_STORAGE_QUOTA
+
+
+def get_reserved(user, exclude=None):
+    'Return the bytes reserved by the incomplete uploads of the user, except for the upload exclude.'
+
+    uploads = ChunkedUpload.objects.filter(owner=user, document__isnull=True, expires_at__gt=timezone.now())
+
+    if exclude is not None:
+        uploads = uploads.exclude(pk=exclude.pk)
+
+    return uploads.aggregate(reserved=Sum('length'))['reserved'] or 0
+
+
+def check_quota(user, size, upload=None):
+    """Raise QuotaExceeded if storing size more bytes would exceed the quota of the user.
+    upload is the upload of these bytes, if it is reserved already.
+    Called within a transaction, the storage usage stays locked until it ends, so that concurrent uploads are
+    checked one after the other."""
+
+    # The counters are created first, so that there is a row to lock for the first upload of the user.
+    StorageUsage.objects.get_or_create(user=user)
+    usage = StorageUsage.objects.select_for_update().get(user=user)
+    quota = get_quota(usage)
+
+    if quota is None:
+        return
+
+    if usage.bytes_used + get_reserved(user, exclude=upload) + size > quota:
+        raise QuotaExceeded('The file exceeds the storage quota of {} bytes.'.format(quota))
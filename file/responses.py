@@ -0,0 +1,327 @@
+# This file builds the responses of document downloads (see file.views.DocumentDownload).
+# Downloads support conditional requests (ETag derived from the document's checksum, Last-Modified) and byte ranges.
+# Range requests are answered by Django when streaming the file, or by the web server when the file is offloaded,
+# or by the object storage when redirecting to it.
+
+import asyncio
+import mimetypes
+import os
+import uuid
+
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+CHUNK_SIZE = 64 * 1024
+
+# Reads of async downloads are larger, as each one costs a round trip to a thread.
+ASYNC_BLOCK_SIZE = 1024 * 1024
+
+# Requests with more ranges are answered with the whole file, as many small ranges cost more than the file.
+MAX_RANGES = 16
+
+# The serve modes that work with each USERDATA_STORAGE. The web server only finds files stored in USERDATA_ROOT.
+SERVE_MODES = {
+    'filesystem': ('django', 'x-accel-redirect', 'x-sendfile'),
+    's3': ('django', 'presigned-url'),
+}
+
+
+def check_serve_mode():
+    'Raise ImproperlyConfigured if USERDATA_SERVE_MODE does not work with USERDATA_STORAGE (see file.apps).'
+
+    if settings.USERDATA_SERVE_MODE not in SERVE_MODES.get(settings.USERDATA_STORAGE, ('django',)):
+        raise ImproperlyConfigured('USERDATA_SERVE_MODE {!r} does not work with USERDATA_STORAGE {!r}.'.format(
+            settings.USERDATA_SERVE_MODE, settings.USERDATA_STORAGE
+        ))
+
+
+def get_content_disposition(filename):
+    'Return the Content-Disposition header value of an attachment, like FileResponse does.'
+
+    try:
+        filename.encode('ascii')
+        file_expr = 'filename="{}"'.format(filename.replace('\\', '\\\\').replace('"', r'\"'))
+    except UnicodeEncodeError:
+        file_expr = "filename*=utf-8''{}".format(quote(filename))
+
+    return 'attachment; {}'.format(file_expr)
+
+
+def parse_range_header(header, size):
+    """Return the list of (first byte, last byte) tuples requested by a Range header.
+    Returns an empty list if no range can be satisfied, and None if the header is invalid and should be ignored."""
+
+    units, _, range_set = header.partition('=')
+
+    if units.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+
+    for range_spec in range_set.split(','):
+        first, separator, last = range_spec.strip().partition('-')
+
+        if not separator:
+            return None
+
+        try:
+            if not first:
+                # A suffix range (-n) requests the last n bytes.
+                length = int(last)
+
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size - 1))
+
+                continue
+
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+
+        if first < 0 or (last is not None and first > last):
+            return None
+
+        if last is None:
+            last = size - 1
+
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    return ranges
+
+
+def if_range_passes(request, etag, last_modified):
+    'If-Range makes a Range header apply only if the file has not changed since the client downloaded a part of it.'
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+
+    if not if_range:
+        return True
+
+    if if_range.startswith('"'):
+        return if_range == etag
+
+    return parse_http_date_safe(if_range) == last_modified
+
+
+class FileRangeResponse(StreamingHttpResponse):
+    """
+    Streams byte ranges of a stored file. Each part is a tuple (prefix, first byte, last byte, suffix), where prefix
+    and suffix are the multipart/byteranges delimiters and headers of the part, if any.
+
+    Under WSGI, the file is read by iterating the response. Under ASGI, file.asgi.DocumentASGIHandler reads it with
+    async_chunks() instead, so that slow clients do not keep a thread busy.
+    """
+
+    def __init__(self, storage, name, parts, suffix=b'', *args, **kwargs):
+        self.storage = storage
+        self.name = name
+        self.parts = parts
+        self.suffix = suffix
+
+        super().__init__(self.read(), *args, **kwargs)
+
+    def read(self):
+        with self.storage.open(self.name, 'rb') as f:
+            for prefix, first, last, suffix in self.parts:
+                if prefix:
+                    yield prefix
+
+                f.seek(first)
+                remaining = last - first + 1
+
+                while remaining > 0:
+                    data = f.read(min(CHUNK_SIZE, remaining))
+
+                    if not data:
+                        break
+
+                    remaining -= len(data)
+                    yield data
+
+                if suffix:
+                    yield suffix
+
+        if self.suffix:
+            yield self.suffix
+
+    def get_path(self):
+        'Return the absolute path of the file, or None if the storage is not a file system.'
+
+        try:
+            return self.storage.path(self.name)
+        except NotImplementedError:
+            return None
+
+    async def async_chunks(self, path, executor):
+        'Yield the bytes of the ranges, reading the file in the thread pool executor in aligned blocks.'
+
+        loop = asyncio.get_event_loop()
+        fd = await loop.run_in_executor(executor, os.open, path, os.O_RDONLY)
+
+        try:
+            for prefix, first, last, suffix in self.parts:
+                if prefix:
+                    yield prefix
+
+                offset = first
+
+                while offset <= last:
+                    # Read up to the next multiple of the block size, so that all further reads are aligned.
+                    size = min(ASYNC_BLOCK_SIZE - offset % ASYNC_BLOCK_SIZE, last - offset + 1)
+                    data = await loop.run_in_executor(executor, os.pread, fd, size, offset)
+
+                    if not data:
+                        break
+
+                    offset += len(data)
+                    yield data
+
+                if suffix:
+                    yield suffix
+
+            if self.suffix:
+                yield self.suffix
+        finally:
+            await loop.run_in_executor(executor, os.close, fd)
+
+
+def get_stream_response(request, document, ranges, content_type, size):
+    storage, name = document.file.storage, document.file.name
+
+    if ranges is None:
+        response = FileRangeResponse(storage, name, [(b'', 0, size - 1, b'')], content_type=content_type)
+        response['Content-Length'] = size
+        return response
+
+    if len(ranges) == 1:
+        first, last = ranges[0]
+
+        response = FileRangeResponse(storage, name, [(b'', first, last, b'')], content_type=content_type, status=206)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+        response['Content-Length'] = last - first + 1
+        return response
+
+    boundary = uuid.uuid4().hex.encode()
+    parts = [
+        (
+            b'--' + boundary + b'\r\n' + 'Content-Type: {}\r\nContent-Range: bytes {}-{}/{}'.format(
+                content_type, first, last, size
+            ).encode() + b'\r\n\r\n',
+            first,
+            last,
+            b'\r\n'
+        )
+        for first, last in ranges
+    ]
+    suffix = b'--' + boundary + b'--\r\n'
+
+    response = FileRangeResponse(
+        storage,
+        name,
+        parts,
+        suffix,
+        content_type='multipart/byteranges; boundary={}'.format(boundary.decode()),
+        status=206
+    )
+    response['Content-Length'] = sum(
+        len(prefix) + (last - first + 1) + len(part_suffix) for prefix, first, last, part_suffix in parts
+    ) + len(suffix)
+    return response
+
+
+def get_presigned_response(document, content_type, filename):
+    'Redirect to a presigned URL of the file in the object storage (see file.s3), which sends it.'
+
+    url = document.file.storage.get_presigned_url(
+        document.file.name, content_type=content_type, content_disposition=get_content_disposition(filename)
+    )
+
+    # The URL expires soon and may only be used by the user whose permission was checked.
+    response = HttpResponseRedirect(url)
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
+def get_offload_response(document, content_type):
+    'Return an empty response, which lets the web server send the file of the document (and handle byte ranges).'
+
+    response = HttpResponse(content_type=content_type)
+
+    if settings.USERDATA_SERVE_MODE == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = quote(settings.USERDATA_ACCEL_PREFIX + document.file.name)
+    elif settings.USERDATA_SERVE_MODE == 'x-sendfile':
+        # Header values are ASCII, the path is unescaped by the web server (XSendFileUnescape of mod_xsendfile).
+        response['X-Sendfile'] = quote(document.file.path)
+    else:
+        raise ImproperlyConfigured('Unknown USERDATA_SERVE_MODE: {}'.format(settings.USERDATA_SERVE_MODE))
+
+    return response
+
+
+def get_download_response(request, document, byte_range=None):
+    """Return the response of a permitted download of the document (or of a DocumentDerivative).
+    If byte_range (first byte, last byte or None) is given, only this range is sent, regardless of a Range header."""
+
+    filename = document.filename or os.path.basename(document.file.name)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    # The object storage answers conditional and range requests itself.
+    if settings.USERDATA_SERVE_MODE == 'presigned-url' and byte_range is None:
+        return get_presigned_response(document, content_type, filename)
+
+    if not document.checksum:
+        document.update_checksum()
+
+    etag = quote_etag(document.checksum)
+    last_modified = int(document.file.storage.get_modified_time(document.file.name).timestamp())
+
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': get_content_disposition(filename)
+    }
+
+    # Answer If-None-Match and If-Modified-Since with 304 and failed If-Match preconditions with 412.
+    response = HttpResponse()
+    for header, value in headers.items():
+        response[header] = value
+
+    conditional_response = get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+    if conditional_response is not response:
+        return conditional_response
+
+    # The web server would apply the request's Range header, therefore restricted downloads are always streamed.
+    if settings.USERDATA_SERVE_MODE != 'django' and byte_range is None:
+        response = get_offload_response(document, content_type)
+    else:
+        size = document.file.size
+        ranges = None
+
+        if byte_range is not None:
+            first, last = byte_range
+            ranges = parse_range_header('bytes={}-{}'.format(first, '' if last is None else last), size)
+        elif 'HTTP_RANGE' in request.META and if_range_passes(request, etag, last_modified):
+            ranges = parse_range_header(request.META['HTTP_RANGE'], size)
+
+        if ranges == []:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+
+        response = get_stream_response(request, document, ranges, content_type, size)
+
+    for header, value in headers.items():
+        response[header] = value
+
+    return response
@@ -0,0 +1,255 @@
+# This file implements the storage of documents in an object storage speaking the S3 API (e.g. AWS S3 or MinIO),
+# selected by USERDATA_STORAGE = 's3'. Unlike UserDataFileStorage, the files are shared by all nodes.
+# - All storages and threads of a process share one client, whose pool keeps up to USERDATA_S3_MAX_CONNECTIONS
+#   connections open, so that requests do not pay for a new TCP and TLS handshake each.
+# - Files larger than USERDATA_S3_MULTIPART_THRESHOLD are uploaded as multipart uploads, whose parts are sent in
+#   parallel (see get_transfer_config).
+# - Downloads are sent by the object storage from presigned URLs (USERDATA_SERVE_MODE = 'presigned-url'), after the
+#   permission check of file.views. The URLs of the storage point to file.views.DocumentDownload, like the URLs of
+#   files in USERDATA_ROOT, so that no file can be downloaded without this check.
+# Files are read with ranged GET requests otherwise, e.g. for archives or by the process_documents command.
+
+import mimetypes
+import threading
+
+from urllib.parse import urljoin
+
+import boto3
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import Storage
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+from django.utils.functional import cached_property
+
+from .storage import delete_on_commit
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client():
+    'Return the S3 client of the configured object storage, which is shared by all threads of the process.'
+
+    key = (
+        settings.USERDATA_S3_ENDPOINT_URL,
+        settings.USERDATA_S3_REGION,
+        settings.USERDATA_S3_ACCESS_KEY,
+        settings.USERDATA_S3_ADDRESSING_STYLE,
+        settings.USERDATA_S3_MAX_CONNECTIONS
+    )
+
+    with _clients_lock:
+        if key not in _clients:
+            # Clients are thread-safe, but sessions are not, therefore each client is created by its own session.
+            _clients[key] = boto3.session.Session().client(
+                's3',
+                endpoint_url=settings.USERDATA_S3_ENDPOINT_URL,
+                region_name=settings.USERDATA_S3_REGION,
+                aws_access_key_id=settings.USERDATA_S3_ACCESS_KEY,
+                aws_secret_access_key=settings.USERDATA_S3_SECRET_KEY,
+                config=Config(
+                    max_pool_connections=settings.USERDATA_S3_MAX_CONNECTIONS,
+                    retries={'max_attempts': 3, 'mode': 'standard'},
+                    signature_version='s3v4',
+                    s3={'addressing_style': settings.USERDATA_S3_ADDRESSING_STYLE}
+                )
+            )
+
+        return _clients[key]
+
+
+def get_transfer_config():
+    return TransferConfig(
+        multipart_threshold=settings.USERDATA_S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=settings.USERDATA_S3_MULTIPART_CHUNK_SIZE,
+        max_concurrency=settings.USERDATA_S3_MULTIPART_CONCURRENCY,
+        use_threads=True
+    )
+
+
+def is_not_found(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+class S3File(File):
+    """
+    A stored file opened for reading. The data is streamed from a GET request, which starts at the current position;
+    it is sent again (with a Range header) after seeking to another position.
+    """
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.mode = 'rb'
+        self.file = None
+        self.position = 0
+        self._closed = False
+
+    @cached_property
+    def size(self):
+        return self.storage.size(self.name)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+
+        if offset < 0:
+            raise ValueError('Negative seek position {}.'.format(offset))
+
+        if offset != self.position:
+            self.close_body()
+            self.position = offset
+
+        return self.position
+
+    def read(self, size=-1):
+        if self.file is None:
+            parameters = {'Bucket': self.storage.bucket, 'Key': self.storage.get_key(self.name)}
+
+            if self.position:
+                parameters['Range'] = 'bytes={}-'.format(self.position)
+
+            try:
+                self.file = self.storage.client.get_object(**parameters)['Body']
+            except ClientError as e:
+                # The position is at or after the end of the file.
+                if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                    return b''
+                raise
+
+        data = self.file.read(None if size is None or size < 0 else size)
+        self.position += len(data)
+        return data
+
+    def close_body(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.close_body()
+        self._closed = True
+
+
+@deconstructible
+class S3UserDataStorage(Storage):
+    'Stores files in the bucket USERDATA_S3_BUCKET, under their names as keys.'
+
+    @property
+    def client(self):
+        return get_client()
+
+    @property
+    def bucket(self):
+        return settings.USERDATA_S3_BUCKET
+
+    def get_key(self, name):
+        return name.replace('\\', '/').lstrip('/')
+
+    def head(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=self.get_key(name))
+
+    def _open(self, name, mode='rb'):
+        if mode not in ('r', 'rb'):
+            raise ValueError('Files of the object storage can only be opened for reading.')
+
+        return S3File(self, name)
+
+    def _save(self, name, content):
+        if hasattr(content, 'seek') and content.seekable():
+            content.seek(0)
+
+        self.client.upload_fileobj(
+            content,
+            self.bucket,
+            self.get_key(name),
+            ExtraArgs={'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream'},
+            Config=get_transfer_config()
+        )
+
+        return name
+
+    def save_blob(self, name, content=None, path=None):
+        """Store a file under the given name, unless it exists already, like UserDataFileStorage.save_blob.
+        A file given as the path of a local file is uploaded from it and deleted when the transaction commits."""
+
+        if self.exists(name):
+            if path:
+                delete_on_commit(path)
+            return name
+
+        if path:
+            self.client.upload_file(
+                path,
+                self.bucket,
+                self.get_key(name),
+                ExtraArgs={'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream'},
+                Config=get_transfer_config()
+            )
+            delete_on_commit(path)
+            return name
+
+        return self._save(name, content)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.get_key(name))
+
+    def exists(self, name):
+        try:
+            self.head(name)
+        except ClientError as e:
+            if is_not_found(e):
+                return False
+            raise
+
+        return True
+
+    def size(self, name):
+        return self.head(name)['ContentLength']
+
+    def get_modified_time(self, name):
+        modified = self.head(name)['LastModified']
+        return modified if settings.USE_TZ else timezone.make_naive(modified)
+
+    def url(self, name):
+        # Files are downloaded through file.views.DocumentDownload, which checks the permission.
+        return urljoin(settings.USERDATA_URL, filepath_to_uri(name))
+
+    def get_presigned_url(self, name, content_type=None, content_disposition=None, expires_in=None):
+        'Return a URL from which the file can be downloaded without authentication, until it expires.'
+
+        parameters = {'Bucket': self.bucket, 'Key': self.get_key(name)}
+
+        # Override the headers stored with the object.
+        if content_type:
+            parameters['ResponseContentType'] = content_type
+        if content_disposition:
+            parameters['ResponseContentDisposition'] = content_disposition
+
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params=parameters,
+            ExpiresIn=expires_in or settings.USERDATA_S3_PRESIGNED_URL_EXPIRATION
+        )
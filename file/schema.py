@@ -0,0 +1,336 @@
+import base64
+import binascii
+import graphene
+
+from datetime import datetime, timezone
+
+from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+
+from graphene_django import DjangoObjectType
+
+from graphql import GraphQLError
+
+from graphql_jwt.decorators import login_required
+
+from api.helpers import ErrorType, get_selected_fields
+
+from user.models import User, UserGroup
+
+from .acl import can_read, get_readable_documents, get_readable_page, remember_readable
+from .models import Document, DocumentDerivative, DocumentShare, DocumentVersion
+from .quota import get_quota, get_usage
+from .signing import sign_download
+
+
+DOCUMENTS_PAGE_SIZE = 20
+DOCUMENTS_MAX_PAGE_SIZE = 100
+
+
+def load_selected(documents, fields):
+    'Load only the columns of the selected fields (and the ones needed for paginating), and the selected derivatives.'
+
+    columns = {'id', 'created_at'}
+    columns.update(fields & {field.name for field in Document._meta.concrete_fields})
+
+    documents = documents.only(*columns)
+
+    if 'derivatives' in fields:
+        documents = documents.prefetch_related('derivatives')
+
+    if 'versions' in fields:
+        documents = documents.prefetch_related('versions')
+
+    return documents
+
+
+# Cursors of the documents connection are the sort key of the last document, so that each page is read from the
+# (user, created_at, document) index of DocumentAccess (or the (created_at, id) index of documents, for admins)
+# instead of counting the preceding documents (as offsets would).
+def encode_cursor(document):
+    return base64.urlsafe_b64encode('{}|{}'.format(document.created_at.isoformat(), document.pk).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        created_at, pk = parse_datetime(created_at), int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        created_at = None
+
+    if created_at is None:
+        raise GraphQLError('Invalid cursor.')
+
+    return created_at, pk
+
+
+class DocumentDerivativeType(DjangoObjectType):
+    url = graphene.String()
+
+    class Meta:
+        model = DocumentDerivative
+        fields = ('kind', 'size', 'content_type', 'width', 'height', 'checksum')
+
+    def resolve_url(self, info):
+        # The file is downloaded through file.views.DocumentDownload, which checks the permission.
+        return info.context.build_absolute_uri(self.file.url)
+
+
+class DocumentVersionType(DjangoObjectType):
+    url = graphene.String()
+    # Sizes in bytes are floats, as GraphQL integers are limited to 32 bits.
+    size = graphene.Float()
+    stored_size = graphene.Float()
+
+    class Meta:
+        model = DocumentVersion
+        fields = ('number', 'kind', 'checksum', 'filename', 'created_at')
+
+    def resolve_url(self, info):
+        return info.context.build_absolute_uri(reverse('document-version', args=[self.document_id, self.number]))
+
+
+class DocumentType(DjangoObjectType):
+    processing_status = graphene.String()
+
+    class Meta:
+        model = Document
+        fields = (
+            'id', 'title', 'description', 'created_at', 'slug', 'checksum', 'filename', 'mime_type',
+            'page_count', 'processed_at', 'derivatives', 'versions'
+        )
+
+    def resolve_processing_status(self, info):
+        return self.get_processing_status_display()
+
+    def resolve_derivatives(self, info):
+        return self.derivatives.all()
+
+    def resolve_versions(self, info):
+        return self.versions.all()
+
+
+class StorageUsageType(graphene.ObjectType):
+    bytes_used = graphene.Float()
+    file_count = graphene.Int()
+    # The quota in bytes, or null if it is unlimited.
+    quota = graphene.Float()
+
+
+class DocumentConnection(graphene.Connection):
+    class Meta:
+        node = DocumentType
+
+
+class Query(graphene.ObjectType):
+    document = graphene.Field(DocumentType, id=graphene.ID(required=True))
+    # The documents of the user (all documents for admins), newest first.
+    documents = graphene.Field(DocumentConnection, first=graphene.Int(), after=graphene.String())
+    storage_usage = graphene.Field(StorageUsageType)
+
+    @login_required
+    def resolve_document(self, info, id):
+        try:
+            pk = int(id)
+        except ValueError:
+            return None
+
+        if not can_read(info.context.user, pk):
+            return None
+
+        return load_selected(Document.objects.all(), get_selected_fields(info)).filter(pk=pk).first()
+
+    @login_required
+    def resolve_storage_usage(self, info):
+        usage = get_usage(info.context.user)
+        return StorageUsageType(bytes_used=usage.bytes_used, file_count=usage.file_count, quota=get_quota(usage))
+
+    @login_required
+    def resolve_documents(self, info, first=DOCUMENTS_PAGE_SIZE, after=None):
+        first = max(1, min(first, DOCUMENTS_MAX_PAGE_SIZE))
+        # One more document is loaded to tell whether there is a next page.
+        documents = get_readable_page(info.context.user, first + 1, decode_cursor(after) if after else None)
+        page = list(load_selected(documents, get_selected_fields(info, 'edges', 'node'))[:first + 1])
+        remember_readable(info.context.user, [document.pk for document in page])
+        edges = [DocumentConnection.Edge(node=document, cursor=encode_cursor(document)) for document in page[:first]]
+
+        return DocumentConnection(
+            edges=edges,
+            page_info=graphene.relay.PageInfo(
+                has_next_page=len(page) > first,
+                has_previous_page=bool(after),
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None
+            )
+        )
+
+
+class CreateDownloadUrl(graphene.Mutation):
+    """
+    Issue a signed URL, which allows downloading a document (or a byte range of it) until it expires, without any
+    further authentication. Pass expiresIn in seconds, the default is USERDATA_SIGNED_URL_EXPIRATION. Larger values
+    than USERDATA_SIGNED_URL_MAX_EXPIRATION (seven days) are reduced to it.
+
+    This mutation can return following errors:
+    - Code 1: The document does not exist or the user may not download it.
+    - Code 2: The byte range is invalid.
+    - Code 3: expiresIn is not positive.
+    """
+
+    class Arguments:
+        document_id = graphene.ID(required=True)
+        expires_in = graphene.Int()
+        first_byte = graphene.Float()
+        last_byte = graphene.Float()
+
+    ok = graphene.Boolean()
+    url = graphene.String()
+    expires_at = graphene.DateTime()
+    error = graphene.Field(ErrorType)
+
+    @staticmethod
+    @login_required
+    def mutate(root, info, document_id, expires_in=None, first_byte=None, last_byte=None):
+        user = info.context.user
+
+        try:
+            document = get_readable_documents(user).get(pk=document_id)
+        except (Document.DoesNotExist, ValueError):
+            error = ErrorType(
+                code=1,
+                message='The document does not exist.'
+            )
+
+            return CreateDownloadUrl(ok=False, error=error)
+
+        # Byte offsets are floats, as GraphQL integers are limited to 32 bits.
+        if (
+            (first_byte is None and last_byte is not None) or
+            (first_byte is not None and (first_byte < 0 or first_byte % 1)) or
+            (last_byte is not None and (last_byte < first_byte or last_byte % 1))
+        ):
+            error = ErrorType(
+                code=2,
+                message='Please provide a valid byte range.'
+            )
+
+            return CreateDownloadUrl(ok=False, error=error)
+
+        if expires_in is not None and expires_in <= 0:
+            error = ErrorType(
+                code=3,
+                message='Please provide a positive expiry.'
+            )
+
+            return CreateDownloadUrl(ok=False, error=error)
+
+        path, expires = sign_download(
+            document,
+            user,
+            expires_in=expires_in,
+            first_byte=None if first_byte is None else int(first_byte),
+            last_byte=None if last_byte is None else int(last_byte)
+        )
+
+        return CreateDownloadUrl(
+            ok=True,
+            url=info.context.build_absolute_uri(path),
+            expires_at=datetime.fromtimestamp(expires, timezone.utc)
+        )
+
+
+def get_share_target(info, document_id, user_id, group_id):
+    """Return the document (if the user may share it) and the user or group of a share, or an error.
+    Only owners and admins may share documents."""
+
+    user = info.context.user
+    documents = Document.objects.all() if user.is_admin else Document.objects.filter(owner=user)
+
+    try:
+        document = documents.get(pk=document_id)
+    except (Document.DoesNotExist, ValueError):
+        return None, None, ErrorType(code=1, message='The document does not exist.')
+
+    if (user_id is None) == (group_id is None):
+        return None, None, ErrorType(code=2, message='Please provide either a user or a group.')
+
+    try:
+        if user_id is not None:
+            target = User.objects.filter(pk=user_id).first()
+        else:
+            target = UserGroup.objects.filter(pk=group_id).first()
+    except ValueError:
+        target = None
+
+    if target is None:
+        return None, None, ErrorType(code=3, message='The user or group does not exist.')
+
+    return document, target, None
+
+
+class ShareDocument(graphene.Mutation):
+    """
+    Let a user or the members of a group read a document.
+
+    This mutation can return following errors:
+    - Code 1: The document does not exist or the user may not share it.
+    - Code 2: Neither or both of userId and groupId were provided.
+    - Code 3: The user or group does not exist.
+    """
+
+    class Arguments:
+        document_id = graphene.ID(required=True)
+        user_id = graphene.ID()
+        group_id = graphene.ID()
+
+    ok = graphene.Boolean()
+    error = graphene.Field(ErrorType)
+
+    @staticmethod
+    @login_required
+    def mutate(root, info, document_id, user_id=None, group_id=None):
+        document, target, error = get_share_target(info, document_id, user_id, group_id)
+
+        if error:
+            return ShareDocument(ok=False, error=error)
+
+        field = 'user' if isinstance(target, User) else 'group'
+        DocumentShare.objects.get_or_create(document=document, **{field: target})
+
+        return ShareDocument(ok=True)
+
+
+class UnshareDocument(graphene.Mutation):
+    """
+    Remove the share of a document with a user or a group. Returns the same errors as shareDocument.
+    """
+
+    class Arguments:
+        document_id = graphene.ID(required=True)
+        user_id = graphene.ID()
+        group_id = graphene.ID()
+
+    ok = graphene.Boolean()
+    error = graphene.Field(ErrorType)
+
+    @staticmethod
+    @login_required
+    def mutate(root, info, document_id, user_id=None, group_id=None):
+        document, target, error = get_share_target(info, document_id, user_id, group_id)
+
+        if error:
+            return UnshareDocument(ok=False, error=error)
+
+        field = 'user' if isinstance(target, User) else 'group'
+
+        # Deleted one by one, so that the permissions are updated (see file.acl).
+        for share in DocumentShare.objects.filter(document=document, **{field: target}):
+            share.delete()
+
+        return UnshareDocument(ok=True)
+
+
+class Mutation(graphene.ObjectType):
+    create_download_url = CreateDownloadUrl.Field()
+    share_document = ShareDocument.Field()
+    unshare_document = UnshareDocument.Field()
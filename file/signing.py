@@ -0,0 +1,98 @@
+# This file implements signed download URLs of documents (see file.views.SignedDocumentDownload).
+# A signed URL carries everything needed to send the file: the stored file name, the filename and the checksum of
+# the document, the user it was issued to, its expiry and optionally a byte range. Downloads through a signed URL
+# are verified by the HMAC alone, without a session, a JWT or any database query.
+# As the URL itself is the permission, its responses may be cached by proxies until it expires.
+
+import math
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+
+from .models import Document
+
+SALT = 'file.signing.download'
+
+# Expiry times are rounded up to full minutes, so that repeated requests issue the same URL, which proxies can cache.
+EXPIRY_GRANULARITY = 60
+
+
+class SignedDownload:
+    'The scope of a verified signed URL.'
+
+    def __init__(self, document_id, user_id, file_name, filename, checksum, expires, first_byte, last_byte):
+        self.document_id = document_id
+        self.user_id = user_id
+        self.file_name = file_name
+        self.filename = filename
+        self.checksum = checksum
+        self.expires = expires
+        self.first_byte = first_byte
+        self.last_byte = last_byte
+
+    @property
+    def byte_range(self):
+        if self.first_byte is None:
+            return None
+
+        return self.first_byte, self.last_byte
+
+    def get_document(self):
+        'Return an unsaved document with the signed values, which is enough to send the file.'
+
+        return Document(
+            pk=self.document_id,
+            owner_id=self.user_id,
+            file=self.file_name,
+            filename=self.filename,
+            checksum=self.checksum
+        )
+
+
+def sign_download(document, user, expires_in=None, first_byte=None, last_byte=None):
+    """Return the path of a signed URL allowing the user to download the document (or the given byte range of it)
+    within expires_in seconds, and its expiry as a unix timestamp."""
+
+    if not document.checksum:
+        document.update_checksum()
+
+    if expires_in is None:
+        expires_in = settings.USERDATA_SIGNED_URL_EXPIRATION
+
+    expires_in = min(expires_in, settings.USERDATA_SIGNED_URL_MAX_EXPIRATION)
+    expires = math.ceil((time.time() + expires_in) / EXPIRY_GRANULARITY) * EXPIRY_GRANULARITY
+
+    token = signing.dumps(
+        [
+            document.pk,
+            user.pk,
+            document.file.name,
+            document.filename,
+            document.checksum,
+            expires,
+            first_byte,
+            last_byte
+        ],
+        salt=SALT,
+        compress=True
+    )
+
+    filename = document.filename or document.file.name.rsplit('/', 1)[-1]
+    return reverse('signed-download', args=[token, filename]), expires
+
+
+def verify_download(token, now=None):
+    'Return the SignedDownload of a token, or None if its signature is invalid or it has expired.'
+
+    try:
+        # The signature is compared in constant time.
+        scope = SignedDownload(*signing.loads(token, salt=SALT))
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+    if scope.expires <= (now or time.time()):
+        return None
+
+    return scope
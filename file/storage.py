@@ -1,8 +1,10 @@
 import os
+import shutil
 import uuid
 
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
+from django.db import transaction
 from django.utils.functional import cached_property
 
 
@@ -19,8 +21,90 @@ class UserDataFileStorage(FileSystemStorage):
             self._base_url += '/'
         return self._value_or_setting(self._base_url, settings.USERDATA_URL)
 
+    def _clear_cached_properties(self, setting, **kwargs):
+        # Called when settings are changed, e.g. in tests.
+        super()._clear_cached_properties(setting, **kwargs)
+
+        if setting == 'USERDATA_ROOT':
+            self.__dict__.pop('base_location', None)
+            self.__dict__.pop('location', None)
+        elif setting == 'USERDATA_URL':
+            self.__dict__.pop('base_url', None)
+
+    def save_blob(self, name, content=None, path=None):
+        """Store a file under the given (content-addressed) name, unless it exists already.
+        The file is given as content or as the path of a local file, which is deleted when the transaction commits.
+        Files are written to a temporary name and renamed, so that no partial file has the final name."""
+
+        target = self.path(name)
+
+        if os.path.exists(target):
+            if path:
+                delete_on_commit(path)
+            return name
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary = '{}.{}.tmp'.format(target, uuid.uuid4().hex)
+
+        if path:
+            # A hard link stores the file without copying it, if it is on the same volume.
+            try:
+                os.link(path, temporary)
+            except OSError:
+                shutil.copyfile(path, temporary)
+
+            delete_on_commit(path)
+        else:
+            with open(temporary, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+
+        os.replace(temporary, target)
+        return name
+
+
+def delete_on_commit(path):
+    'Delete a local file when the transaction commits, so that it is kept if the transaction is rolled back.'
+
+    def delete():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    transaction.on_commit(delete)
+
+
+def get_userdata_storage():
+    'Return the storage of documents and their derivatives, selected by USERDATA_STORAGE.'
+
+    if settings.USERDATA_STORAGE == 's3':
+        # boto3 is only needed if the object storage is used.
+        from .s3 import S3UserDataStorage
+        return S3UserDataStorage()
+
+    return UserDataFileStorage()
+
+
+def create_blob_path(checksum):
+    # Content-addressed files are stored under their checksum, in two levels of directories (blobs/ab/cd/abcd...),
+    # so that no directory contains too many files.
+    return os.path.join('blobs', checksum[:2], checksum[2:4], checksum)
+
 
 def create_file_path(instance, filename):
     # Uses the User's identification and a unique uuid string for creating the file's location.
     folder = str(instance.owner.id) + '/' + str(uuid.uuid4())
     return os.path.join(folder, filename)
+
+
+def create_derivative_path(instance, filename):
+    # Derivatives are stored apart from the documents, in a unique directory per derivative.
+    folder = 'derivatives/' + str(instance.document_id) + '/' + str(uuid.uuid4())
+    return os.path.join(folder, filename)
+
+
+def create_version_path(instance, filename):
+    # Deltas of document versions are stored apart from the documents, in a unique directory per version.
+    folder = 'versions/' + str(instance.document_id) + '/' + str(uuid.uuid4())
+    return os.path.join(folder, filename)
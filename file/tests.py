@@ -0,0 +1,1249 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import base64
+
+import graphene
+
+from PIL import Image
+
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from datetime import datetime, timedelta
+from io import StringIO
+from urllib.parse import quote
+from unittest import mock
+
+from moto import mock_aws
+
+from user.models import User, UserGroup
+
+from .acl import can_read, filter_readable, refresh_access
+from .asgi import DocumentASGIHandler
+from .blobs import acquire_blob
+from .derivatives import sniff_mime_type
+from .models import (
+    ChunkedUpload, Document, DocumentAccess, DocumentDerivative, DocumentShare, DocumentVersion, FileBlob,
+    StorageUsage
+)
+from .responses import check_serve_mode
+from .s3 import S3UserDataStorage
+from .schema import Mutation, Query, encode_cursor
+from .signing import sign_download, verify_download
+from .uploads import open_locked
+from .versions import apply_delta, encode_delta
+
+USERDATA_ROOT = tempfile.mkdtemp()
+
+
+class DocumentTestMixin:
+    AUTH_BACKEND = 'user.auth_backends.authentication.AuthenticationBackend'
+    CONTENT = b'0123456789' * 100
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(USERDATA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.owner = User.objects.create_user(email='owner@simonprast.com', password='test-password')
+        self.document = Document(title='Report', owner=self.owner)
+        self.document.file.save('report.pdf', ContentFile(self.CONTENT))
+
+        self.client.force_login(self.owner, backend=self.AUTH_BACKEND)
+
+    def download(self, **headers):
+        return self.client.get('/userdata/{}'.format(self.document.file.name), **headers)
+
+    def execute(self, user, query, **variables):
+        'Execute the GraphQL query (or mutation) as the user.'
+
+        request = RequestFactory().post('/graphql')
+        request.user = user
+
+        schema = graphene.Schema(query=Query, mutation=Mutation)
+        return schema.execute(query, variables=variables, context_value=request)
+
+
+@override_settings(USERDATA_ROOT=USERDATA_ROOT)
+class DocumentTestCase(DocumentTestMixin, TestCase):
+    pass
+
+
+class DocumentDownloadTest(DocumentTestCase):
+    def test_stream(self):
+        response = self.download()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="report.pdf"')
+
+    def test_forbidden(self):
+        other_user = User.objects.create_user(email='other@simonprast.com', password='test-password')
+        self.client.force_login(other_user, backend=self.AUTH_BACKEND)
+
+        self.assertEqual(self.download().status_code, 403)
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_file_is_deleted_with_document(self, on_commit):
+        path = self.document.file.path
+        self.document.delete()
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_x_accel_redirect(self):
+        with self.settings(USERDATA_SERVE_MODE='x-accel-redirect'):
+            response = self.download()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-userdata/' + self.document.file.name)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="report.pdf"')
+
+    def test_x_sendfile(self):
+        with self.settings(USERDATA_SERVE_MODE='x-sendfile'):
+            response = self.download()
+
+        self.assertEqual(response['X-Sendfile'], self.document.file.path)
+        self.assertTrue(response['X-Sendfile'].startswith(USERDATA_ROOT))
+
+    def test_x_sendfile_non_ascii(self):
+        self.document.file.save('Bericht März.pdf', ContentFile(self.CONTENT))
+
+        with self.settings(USERDATA_SERVE_MODE='x-sendfile'):
+            response = self.download()
+
+        self.assertEqual(response['X-Sendfile'], quote(self.document.file.path))
+        self.assertTrue(response['X-Sendfile'].endswith('/Bericht_M%C3%A4rz.pdf'))
+
+    def test_serve_mode_mismatch(self):
+        with self.settings(USERDATA_STORAGE='filesystem', USERDATA_SERVE_MODE='presigned-url'):
+            self.assertRaises(ImproperlyConfigured, check_serve_mode)
+
+        with self.settings(USERDATA_STORAGE='s3', USERDATA_SERVE_MODE='x-sendfile'):
+            self.assertRaises(ImproperlyConfigured, check_serve_mode)
+
+        with self.settings(USERDATA_STORAGE='s3', USERDATA_SERVE_MODE='presigned-url'):
+            check_serve_mode()
+
+
+class DocumentRangeTest(DocumentTestCase):
+    def test_checksum_etag(self):
+        response = self.download()
+        etag = '"{}"'.format(hashlib.sha256(self.CONTENT).hexdigest())
+
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.download(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.download(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        self.assertEqual(self.download(HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+    def test_single_range(self):
+        response = self.download(HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1000')
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT[10:20])
+
+        response = self.download(HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT[-5:])
+
+        response = self.download(HTTP_RANGE='bytes=995-2000')
+        self.assertEqual(response['Content-Range'], 'bytes 995-999/1000')
+
+    def test_multiple_ranges(self):
+        response = self.download(HTTP_RANGE='bytes=0-1, 5-6')
+        content = b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self.assertIn(b'Content-Range: bytes 0-1/1000\r\n\r\n01\r\n', content)
+        self.assertIn(b'Content-Range: bytes 5-6/1000\r\n\r\n56\r\n', content)
+
+    def test_invalid_ranges(self):
+        response = self.download(HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1000')
+
+        # Invalid headers are ignored.
+        self.assertEqual(self.download(HTTP_RANGE='bytes=5-1').status_code, 200)
+        self.assertEqual(self.download(HTTP_RANGE='lines=1-2').status_code, 200)
+
+    def test_if_range(self):
+        self.assertEqual(self.download(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"outdated"').status_code, 200)
+
+        etag = self.download()['ETag']
+        self.assertEqual(self.download(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag).status_code, 206)
+
+    def test_offload(self):
+        with self.settings(USERDATA_SERVE_MODE='x-accel-redirect'):
+            etag = self.download()['ETag']
+            response = self.download(HTTP_RANGE='bytes=0-1')
+
+            # The web server handles the range.
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['ETag'], etag)
+            self.assertIn('X-Accel-Redirect', response)
+            self.assertEqual(self.download(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class ChunkedUploadTest(DocumentTestCase):
+    def create(self, length, filename='upload.txt'):
+        metadata = 'filename {},title {}'.format(
+            base64.b64encode(filename.encode()).decode(), base64.b64encode(b'Uploaded').decode()
+        )
+        return self.client.post('/uploads/', HTTP_UPLOAD_LENGTH=str(length), HTTP_UPLOAD_METADATA=metadata)
+
+    def patch(self, location, offset, data):
+        return self.client.generic(
+            'PATCH', location, data, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    def test_upload(self):
+        response = self.create(len(self.CONTENT))
+        self.assertEqual(response.status_code, 201)
+        location = response['Location']
+
+        response = self.patch(location, 0, self.CONTENT[:600])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response['Upload-Offset'], '600')
+
+        # The client asks for the offset after a dropped connection.
+        self.assertEqual(self.client.head(location)['Upload-Offset'], '600')
+        self.assertEqual(self.patch(location, 500, self.CONTENT[500:]).status_code, 409)
+
+        response = self.patch(location, 600, self.CONTENT[600:])
+        self.assertEqual(response['Upload-Offset'], '1000')
+
+        document = Document.objects.get(pk=response['Upload-Document'])
+        self.assertEqual(document.title, 'Uploaded')
+        self.assertEqual(document.owner, self.owner)
+        self.assertEqual(document.checksum, hashlib.sha256(self.CONTENT).hexdigest())
+        self.assertTrue(document.file.name.endswith('/upload.txt'))
+
+        with document.file.open('rb') as f:
+            self.assertEqual(f.read(), self.CONTENT)
+
+    def test_checksum_after_restart(self):
+        location = self.create(len(self.CONTENT))['Location']
+        self.patch(location, 0, self.CONTENT[:300])
+
+        # Another process continues the upload, which does not know the checksum of the first chunk.
+        from . import uploads
+        uploads._checksums.clear()
+
+        response = self.patch(location, 300, self.CONTENT[300:])
+        document = Document.objects.get(pk=response['Upload-Document'])
+        self.assertEqual(document.checksum, hashlib.sha256(self.CONTENT).hexdigest())
+
+    def test_size_limit(self):
+        with self.settings(FILE_UPLOAD_MAX_LENGTH=100):
+            self.assertEqual(self.create(101).status_code, 413)
+
+        location = self.create(10)['Location']
+        self.assertEqual(self.patch(location, 0, b'x' * 11).status_code, 413)
+
+        upload = ChunkedUpload.objects.get()
+        self.assertEqual(upload.offset, 0)
+        self.assertEqual(os.path.getsize(os.path.join(USERDATA_ROOT, upload.file_name)), 0)
+
+    def test_other_user_and_cancel(self):
+        location = self.create(10)['Location']
+
+        other_user = User.objects.create_user(email='other@simonprast.com', password='test-password')
+        self.client.force_login(other_user, backend=self.AUTH_BACKEND)
+        self.assertEqual(self.patch(location, 0, b'x' * 10).status_code, 404)
+
+        self.client.force_login(self.owner, backend=self.AUTH_BACKEND)
+        self.assertEqual(self.client.delete(location).status_code, 204)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+        self.client.logout()
+        self.assertEqual(self.create(10).status_code, 401)
+
+    def test_concurrent_chunk(self):
+        location = self.create(10)['Location']
+        upload = ChunkedUpload.objects.get()
+
+        # Another request is writing to the upload.
+        with open_locked(os.path.join(USERDATA_ROOT, upload.file_name), upload.length):
+            self.assertEqual(self.patch(location, 0, b'x' * 10).status_code, 409)
+
+        self.assertEqual(self.patch(location, 0, b'x' * 10).status_code, 204)
+
+
+@override_settings(USERDATA_CONTENT_ADDRESSED=True)
+class ContentAddressedStorageTest(DocumentTestCase):
+    # Differs from the content of the document created by setUp.
+    SHARED_CONTENT = b'abcdefghij' * 100
+
+    def create_document(self, owner, filename='copy.pdf'):
+        document = Document(title='Copy', owner=owner)
+        document.file.save(filename, ContentFile(self.SHARED_CONTENT))
+        return document
+
+    def test_files_are_stored_once(self):
+        other_user = User.objects.create_user(email='other@simonprast.com', password='test-password')
+        first = self.create_document(self.owner)
+        second = self.create_document(other_user, 'other-name.pdf')
+
+        checksum = hashlib.sha256(self.SHARED_CONTENT).hexdigest()
+        self.assertEqual(first.file.name, 'blobs/{}/{}/{}'.format(checksum[:2], checksum[2:4], checksum))
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(FileBlob.objects.get(pk=checksum).references, 2)
+
+        # Each user downloads the file under the name of their own document.
+        self.client.force_login(other_user, backend=self.AUTH_BACKEND)
+        response = self.client.get('/userdata/{}'.format(second.file.name))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="other-name.pdf"')
+        self.assertEqual(b''.join(response.streaming_content), self.SHARED_CONTENT)
+
+    # Run the callbacks of committed transactions immediately, as test cases never commit.
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_file_is_deleted_with_last_reference(self, on_commit):
+        first = self.create_document(self.owner)
+        second = self.create_document(self.owner)
+        path = first.file.path
+
+        first.delete()
+
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(FileBlob.objects.get(pk=first.checksum).references, 1)
+
+        second.delete()
+
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(FileBlob.objects.filter(pk=first.checksum).exists())
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_chunked_upload(self, on_commit):
+        existing = self.create_document(self.owner)
+
+        response = self.client.post('/uploads/', HTTP_UPLOAD_LENGTH=str(len(self.SHARED_CONTENT)))
+        response = self.client.generic(
+            'PATCH', response['Location'], self.SHARED_CONTENT,
+            content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='0'
+        )
+
+        document = Document.objects.get(pk=response['Upload-Document'])
+        self.assertEqual(document.file.name, existing.file.name)
+        self.assertEqual(FileBlob.objects.get(pk=existing.checksum).references, 2)
+        self.assertFalse(os.path.exists(os.path.join(USERDATA_ROOT, ChunkedUpload.objects.get().file_name)))
+
+    def test_rollback_keeps_upload(self):
+        path = os.path.join(USERDATA_ROOT, 'upload.pdf')
+
+        with open(path, 'wb') as f:
+            f.write(self.SHARED_CONTENT)
+
+        checksum = hashlib.sha256(self.SHARED_CONTENT).hexdigest()
+
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                acquire_blob(checksum, len(self.SHARED_CONTENT), path=path)
+                raise RuntimeError()
+
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(FileBlob.objects.filter(pk=checksum).exists())
+
+
+class CollectUserdataTest(DocumentTestCase):
+    def write_file(self, name, age=48 * 60 * 60):
+        path = os.path.join(USERDATA_ROOT, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(b'orphan')
+
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def collect(self, **options):
+        call_command('collect_userdata', batch_size=2, stdout=StringIO(), **options)
+
+    def test_orphans_are_removed(self):
+        orphan = self.write_file('999/orphan/file.pdf')
+        recent = self.write_file('999/recent/file.pdf', age=60)
+
+        self.collect(dry_run=True)
+        self.assertTrue(os.path.exists(orphan))
+
+        self.collect()
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(os.path.dirname(orphan)))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(self.document.file.path))
+
+    def test_quarantine(self):
+        orphan = self.write_file('999/orphan/file.pdf')
+
+        with tempfile.TemporaryDirectory() as quarantine:
+            self.collect(quarantine=quarantine)
+
+            self.assertFalse(os.path.exists(orphan))
+            self.assertTrue(os.path.exists(os.path.join(quarantine, '999/orphan/file.pdf')))
+
+    def test_expired_uploads(self):
+        response = self.client.post('/uploads/', HTTP_UPLOAD_LENGTH='10')
+        upload = ChunkedUpload.objects.get()
+        os.utime(os.path.join(USERDATA_ROOT, upload.file_name), (0, 0))
+
+        self.collect()
+        self.assertTrue(ChunkedUpload.objects.exists())
+        self.assertEqual(self.client.head(response['Location']).status_code, 200)
+
+        ChunkedUpload.objects.update(expires_at=timezone.now())
+        self.collect()
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertFalse(os.path.exists(os.path.join(USERDATA_ROOT, upload.file_name)))
+
+
+class SignedDownloadTest(DocumentTestCase):
+    MUTATION = '''
+        mutation createDownloadUrl($documentId: ID!, $expiresIn: Int, $firstByte: Float, $lastByte: Float) {
+            createDownloadUrl(
+                documentId: $documentId, expiresIn: $expiresIn, firstByte: $firstByte, lastByte: $lastByte
+            ) {
+                ok
+                url
+                expiresAt
+                error {
+                    code
+                }
+            }
+        }
+    '''
+
+    def create_url(self, user, **variables):
+        return self.execute(user, self.MUTATION, documentId=self.document.pk, **variables).data['createDownloadUrl']
+
+    def test_mutation(self):
+        result = self.create_url(self.owner)
+        self.assertTrue(result['ok'])
+
+        self.client.logout()
+
+        # The signature replaces the session and the document is not loaded from the database.
+        with self.assertNumQueries(0):
+            response = self.client.get(result['url'])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="report.pdf"')
+        self.assertIn('public', response['Cache-Control'])
+
+        other = User.objects.create_user(email='other@simonprast.com', password='test-password')
+        self.assertEqual(self.create_url(other)['error']['code'], 1)
+        self.assertEqual(self.create_url(self.owner, firstByte=10, lastByte=5)['error']['code'], 2)
+
+    def test_expiry(self):
+        self.assertEqual(self.create_url(self.owner, expiresIn=-60)['error']['code'], 3)
+        self.assertEqual(self.create_url(self.owner, expiresIn=0)['error']['code'], 3)
+
+        # Longer expiries are reduced to USERDATA_SIGNED_URL_MAX_EXPIRATION.
+        result = self.create_url(self.owner, expiresIn=30 * 24 * 60 * 60)
+        self.assertTrue(result['ok'])
+
+        expires_at = datetime.fromisoformat(result['expiresAt'])
+        self.assertLessEqual(expires_at, timezone.now() + timedelta(days=7, minutes=1))
+
+    def test_byte_range(self):
+        path, expires = sign_download(self.document, self.owner, first_byte=10, last_byte=19)
+
+        response = self.client.get(path, HTTP_RANGE='bytes=0-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT[10:20])
+
+    def test_invalid_urls(self):
+        path, expires = sign_download(self.document, self.owner)
+        token = path.split('/')[2]
+
+        self.assertEqual(verify_download(token).document_id, self.document.pk)
+        self.assertIsNone(verify_download(token, now=expires))
+        self.assertIsNone(verify_download(token[:-1] + ('A' if token[-1] != 'A' else 'B')))
+        self.assertEqual(self.client.get(path.replace(token, token[::-1])).status_code, 403)
+
+        self.document.file.storage.delete(self.document.file.name)
+        self.assertEqual(self.client.get(path).status_code, 404)
+
+
+class DocumentProcessingTest(DocumentTestCase):
+    def create_document(self, name, content):
+        document = Document(title=name, owner=self.owner)
+        document.file.save(name, ContentFile(content))
+        return document
+
+    def create_image(self, size, mode='RGB', image_format='PNG'):
+        output = io.BytesIO()
+        Image.new(mode, size, 'red').save(output, image_format)
+        return output.getvalue()
+
+    def process(self):
+        call_command('process_documents', workers=2, stdout=StringIO())
+
+    def test_sniff_mime_type(self):
+        self.assertEqual(sniff_mime_type(b'%PDF-1.7\n'), 'application/pdf')
+        self.assertEqual(sniff_mime_type(self.create_image((1, 1), image_format='JPEG')), 'image/jpeg')
+        self.assertEqual(sniff_mime_type(b'RIFF\x00\x00\x00\x00WEBPVP8 '), 'image/webp')
+        self.assertEqual(
+            sniff_mime_type(b'PK\x03\x04', 'letter.docx'),
+            'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+        )
+        self.assertEqual(sniff_mime_type('Grüße'.encode() * 1000), 'text/plain')
+        self.assertEqual(sniff_mime_type(bytes(range(256))), 'application/octet-stream')
+
+    def test_image_derivatives(self):
+        document = self.create_document('photo.jpg', self.create_image((2000, 1000), image_format='JPEG'))
+        transparent = self.create_document('logo.png', self.create_image((300, 300), mode='RGBA'))
+
+        with self.settings(FILE_THUMBNAIL_SIZES=(128,), FILE_PREVIEW_SIZES=(1024,)):
+            self.process()
+
+        document.refresh_from_db()
+        self.assertEqual(document.processing_status, Document.PROCESSED)
+        self.assertEqual(document.mime_type, 'image/jpeg')
+        self.assertEqual(document.page_count, 1)
+        self.assertEqual(
+            [(d.kind, d.width, d.height, d.content_type) for d in document.derivatives.all()],
+            [('preview', 1024, 512, 'image/jpeg'), ('thumbnail', 128, 64, 'image/jpeg')]
+        )
+        self.assertEqual(transparent.derivatives.first().content_type, 'image/png')
+
+        # Derivatives are downloaded with the permission of their document.
+        thumbnail = document.derivatives.get(kind='thumbnail')
+        response = self.client.get('/userdata/{}'.format(thumbnail.file.name))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(hashlib.sha256(b''.join(response.streaming_content)).hexdigest(), thumbnail.checksum)
+
+        self.client.force_login(
+            User.objects.create_user(email='other@simonprast.com', password='test-password'),
+            backend=self.AUTH_BACKEND
+        )
+        self.assertEqual(self.client.get('/userdata/{}'.format(thumbnail.file.name)).status_code, 403)
+
+    def test_query(self):
+        document = self.create_document('photo.png', self.create_image((500, 500)))
+        self.process()
+
+        result = self.execute(
+            self.owner, '{ document(id: %d) { mimeType processingStatus derivatives { kind size url } } }' % document.pk
+        )
+
+        self.assertEqual(result.data['document']['processingStatus'], 'Processed')
+        self.assertEqual(
+            [(d['kind'], d['size']) for d in result.data['document']['derivatives']],
+            [('PREVIEW', 1024), ('THUMBNAIL', 128), ('THUMBNAIL', 256)]
+        )
+        self.assertTrue(result.data['document']['derivatives'][0]['url'].startswith('http://testserver/userdata/'))
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_replaced_file(self, on_commit):
+        document = self.create_document('photo.png', self.create_image((500, 500)))
+        self.process()
+
+        name = document.derivatives.first().file.name
+        document.file.save('notes.txt', ContentFile(b'Notes'))
+        self.assertEqual(document.processing_status, Document.PENDING)
+
+        self.process()
+        document.refresh_from_db()
+        self.assertEqual(document.mime_type, 'text/plain')
+        self.assertFalse(document.derivatives.exists())
+        self.assertFalse(os.path.exists(os.path.join(USERDATA_ROOT, name)))
+
+    def test_pdf_and_failures(self):
+        pdf = self.create_document('letter.pdf', b'%PDF-1.4\n')
+        broken = self.create_document('broken.png', b'\x89PNG\r\n\x1a\n broken')
+
+        # PDFs are only rendered if poppler-utils is installed.
+        with self.settings(FILE_PDFTOPPM='missing-pdftoppm', FILE_PDFINFO='missing-pdfinfo'):
+            self.process()
+
+        pdf.refresh_from_db()
+        self.assertEqual((pdf.processing_status, pdf.mime_type), (Document.PROCESSED, 'application/pdf'))
+
+        broken.refresh_from_db()
+        self.assertEqual(broken.processing_status, Document.FAILED)
+        self.assertIn('UnidentifiedImageError', broken.processing_error)
+
+
+class DocumentsQueryTest(DocumentTestCase):
+    QUERY = '''
+        query documents($first: Int, $after: String) {
+            documents(first: $first, after: $after) {
+                edges {
+                    node {
+                        ...documentFields
+                    }
+                }
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
+            }
+        }
+
+        fragment documentFields on DocumentType {
+            id
+            title
+        }
+    '''
+
+    def setUp(self):
+        super().setUp()
+
+        for i in range(4):
+            document = Document(title='Document {}'.format(i), owner=self.owner)
+            document.file.save('document.pdf', ContentFile(self.CONTENT))
+
+        # Documents created at the same time are ordered by their id.
+        documents = Document.objects.filter(title__in=['Document 1', 'Document 2'])
+        documents.update(created_at=timezone.now())
+        refresh_access(documents.values_list('pk', flat=True))
+
+    def query(self, user, **variables):
+        return self.execute(user, self.QUERY, **variables)
+
+    def test_pagination(self):
+        titles = []
+        cursor = None
+
+        with CaptureQueriesContext(connection) as queries:
+            while True:
+                result = self.query(self.owner, first=2, after=cursor)
+                connection_data = result.data['documents']
+                titles.extend(edge['node']['title'] for edge in connection_data['edges'])
+                cursor = connection_data['pageInfo']['endCursor']
+
+                if not connection_data['pageInfo']['hasNextPage']:
+                    break
+
+        self.assertEqual(titles, ['Document 2', 'Document 1', 'Document 3', 'Document 0', 'Report'])
+        self.assertEqual(len(queries), 3)
+        # Only the selected columns are loaded.
+        self.assertNotIn('description', queries[0]['sql'])
+
+    def test_permissions(self):
+        other = User.objects.create_user(email='other@simonprast.com', password='test-password')
+        self.assertEqual(self.query(other).data['documents']['edges'], [])
+
+        admin = User.objects.create_superuser('admin', email='admin@simonprast.com', password='test-password')
+        self.assertEqual(len(self.query(admin, first=10).data['documents']['edges']), 5)
+
+        result = self.query(self.owner, after='invalid')
+        self.assertIn('Invalid cursor', str(result.errors[0]))
+
+    def test_query_plan(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.query(self.owner, first=2, after=encode_cursor(self.document))
+
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + queries[0]['sql'])
+            plan = [(parent, detail) for node, parent, unused, detail in cursor.fetchall()]
+
+        # The page is selected on the (user, created_at, document) index, only the documents of the page are sorted.
+        self.assertTrue(any('INDEX file_docume_user_id_cc757e_idx' in detail for parent, detail in plan))
+        self.assertFalse(any(detail.startswith('SCAN') for parent, detail in plan))
+        self.assertEqual([parent for parent, detail in plan if 'TEMP B-TREE' in detail], [0])
+
+    def test_selected_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.execute(self.owner, '{ documents(first: 1) { edges { node { description } } } }')
+
+        self.assertEqual(result.data['documents']['edges'], [{'node': {'description': None}}])
+        self.assertIn('description', queries[0]['sql'])
+
+
+class DocumentAccessTest(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.reader = User.objects.create_user(email='reader@simonprast.com', password='test-password')
+        self.group = UserGroup.objects.create(name='Team', owner=self.owner)
+        self.client.force_login(self.reader, backend=self.AUTH_BACKEND)
+
+    def can_read(self):
+        # A new user object, as permissions are memoized per user object (i.e. per request).
+        return can_read(User.objects.get(pk=self.reader.pk), self.document.pk)
+
+    def test_user_share(self):
+        self.assertEqual(self.download().status_code, 403)
+
+        share = DocumentShare.objects.create(document=self.document, user=self.reader)
+        self.assertEqual(self.download().status_code, 200)
+
+        share.delete()
+        self.assertEqual(self.download().status_code, 403)
+
+    def test_delete_shared_document(self):
+        DocumentShare.objects.create(document=self.document, user=self.reader)
+        pk = self.document.pk
+
+        self.document.delete()
+        self.assertFalse(DocumentAccess.objects.filter(document=pk).exists())
+        connection.check_constraints()
+
+    def test_group_share(self):
+        self.group.members.add(self.reader)
+        share = DocumentShare.objects.create(document=self.document, group=self.group)
+        self.assertTrue(self.can_read())
+
+        self.group.members.remove(self.reader)
+        self.assertFalse(self.can_read())
+
+        self.reader.user_groups.add(self.group)
+        self.assertTrue(self.can_read())
+
+        # The direct share still grants access after the group share is removed.
+        DocumentShare.objects.create(document=self.document, user=self.reader)
+        share.delete()
+        self.assertTrue(self.can_read())
+
+        self.reader.document_shares.all().delete()
+        self.group.document_shares.create(document=self.document)
+        self.reader.user_groups.clear()
+        self.assertFalse(self.can_read())
+
+    def test_owner_change_and_rebuild(self):
+        self.document.owner = self.reader
+        self.document.save()
+        self.assertTrue(self.can_read())
+        self.assertFalse(can_read(self.owner, self.document.pk))
+
+        DocumentAccess.objects.all().delete()
+        call_command('rebuild_document_access', batch_size=1, stdout=StringIO())
+        self.assertTrue(self.can_read())
+
+    def test_share_mutation(self):
+        def share(user, mutation='shareDocument', documentId=None, **arguments):
+            arguments = ', '.join('{}: {}'.format(*item) for item in arguments.items())
+            result = self.execute(user, 'mutation { %s(documentId: %s, %s) { ok error { code } } }' % (
+                mutation, documentId or self.document.pk, arguments
+            ))
+            return result.data[mutation]
+
+        self.assertEqual(share(self.reader, userId=self.reader.pk)['error']['code'], 1)
+        self.assertEqual(share(self.owner, userId=self.reader.pk, groupId=self.group.pk)['error']['code'], 2)
+        self.assertEqual(share(self.owner, documentId='"invalid"', userId=self.reader.pk)['error']['code'], 1)
+        self.assertEqual(share(self.owner, userId='"invalid"')['error']['code'], 3)
+
+        self.assertTrue(share(self.owner, groupId=self.group.pk)['ok'])
+        self.group.members.add(self.reader)
+        self.assertTrue(self.can_read())
+
+        self.assertTrue(share(self.owner, 'unshareDocument', groupId=self.group.pk)['ok'])
+        self.assertFalse(self.can_read())
+
+    def test_memoized_checks(self):
+        other = Document(title='Other', owner=self.owner)
+        other.file.save('other.pdf', ContentFile(self.CONTENT))
+        DocumentShare.objects.create(document=other, user=self.reader)
+
+        reader = User.objects.get(pk=self.reader.pk)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(filter_readable(reader, [self.document.pk, other.pk]), {other.pk})
+            self.assertFalse(can_read(reader, self.document.pk))
+            self.assertTrue(can_read(reader, other.pk))
+
+
+class ArchiveDownloadTest(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.documents = [self.document]
+
+        for name, content in (('report.pdf', b'%PDF-1.4 copy'), ('notes.txt', b'Notes ' * 10000)):
+            document = Document(title=name, owner=self.owner)
+            document.file.save(name, ContentFile(content))
+            self.documents.append(document)
+
+    def download_archive(self, documents=None):
+        return self.client.get('/archive/', {'document': [document.pk for document in documents or self.documents]})
+
+    def read_archive(self, response):
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_archive(self):
+        response = self.download_archive()
+
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertFalse(response.has_header('Content-Length'))
+
+        archive = self.read_archive(response)
+        self.assertEqual(archive.namelist(), ['report.pdf', 'report (2).pdf', 'notes.txt'])
+        self.assertEqual(archive.read('report.pdf'), self.CONTENT)
+        self.assertEqual(archive.read('notes.txt'), b'Notes ' * 10000)
+        self.assertEqual(archive.getinfo('report.pdf').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertIsNone(archive.testzip())
+
+    def test_streaming(self):
+        large = Document(title='Large', owner=self.owner)
+        large.file.save('large.bin', ContentFile(os.urandom(1024 * 1024)))
+
+        chunks = iter(self.download_archive([large]).streaming_content)
+
+        # The local header is sent with the first chunk of the file, and no chunk holds the whole file.
+        first = next(chunks)
+        self.assertTrue(first.startswith(b'PK\x03\x04'))
+        self.assertLess(max(len(chunk) for chunk in chunks), 128 * 1024)
+
+    def test_zip64(self):
+        with mock.patch('zipfile.ZIP64_LIMIT', 1000):
+            archive = self.read_archive(self.download_archive())
+
+        self.assertEqual(archive.read('report.pdf'), self.CONTENT)
+        self.assertIsNone(archive.testzip())
+
+    def test_permissions(self):
+        other = User.objects.create_user(email='other@simonprast.com', password='test-password')
+        self.client.force_login(other, backend=self.AUTH_BACKEND)
+        self.assertEqual(self.download_archive().status_code, 403)
+
+        # All documents have to be readable.
+        DocumentShare.objects.create(document=self.document, user=other)
+        self.assertEqual(self.download_archive().status_code, 403)
+        self.assertEqual(self.download_archive([self.document]).status_code, 200)
+
+        self.assertEqual(self.client.get('/archive/', {'document': 'x'}).status_code, 400)
+
+
+class StorageQuotaTest(DocumentTestCase):
+    def usage(self, user=None):
+        usage = StorageUsage.objects.get(user=user or self.owner)
+        return usage.bytes_used, usage.file_count
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_counters(self, on_commit):
+        self.assertEqual(self.usage(), (1000, 1))
+
+        other = Document(title='Other', owner=self.owner)
+        other.file.save('other.pdf', ContentFile(b'x' * 500))
+        self.assertEqual(self.usage(), (1500, 2))
+
+        # Replaced files and changed owners move the size between the counters. The replaced file is kept by the
+        # first version, the new file is shared by the second one.
+        other.file.save('other.pdf', ContentFile(b'x' * 200))
+        self.assertEqual(self.usage(), (1700, 2))
+
+        reader = User.objects.create_user(email='reader@simonprast.com', password='test-password')
+        other.owner = reader
+        other.save()
+        self.assertEqual(self.usage(), (1000, 1))
+        self.assertEqual(self.usage(reader), (700, 1))
+
+        other.delete()
+        self.assertEqual(self.usage(reader), (0, 0))
+
+    def test_upload_quota(self):
+        with self.settings(FILE_STORAGE_QUOTA=1500):
+            response = self.client.post('/uploads/', HTTP_UPLOAD_LENGTH='400')
+            self.assertEqual(response.status_code, 201)
+
+            # The incomplete upload reserves its length.
+            response = self.client.post('/uploads/', HTTP_UPLOAD_LENGTH='200')
+            self.assertEqual(response.status_code, 413)
+
+            StorageUsage.objects.filter(user=self.owner).update(quota=2000)
+            self.assertEqual(self.client.post('/uploads/', HTTP_UPLOAD_LENGTH='200').status_code, 201)
+
+    def test_expired_upload_quota(self):
+        def patch(location, data):
+            return self.client.generic(
+                'PATCH', location, data, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='0'
+            )
+
+        with self.settings(FILE_STORAGE_QUOTA=1500):
+            expired = self.client.post('/uploads/', HTTP_UPLOAD_LENGTH='400')['Location']
+            ChunkedUpload.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+            # The expired upload is no longer reserved, and can not be finished.
+            location = self.client.post('/uploads/', HTTP_UPLOAD_LENGTH='400')['Location']
+            self.assertEqual(patch(expired, b'x' * 400).status_code, 410)
+
+            # Finishing an upload checks the quota again.
+            StorageUsage.objects.filter(user=self.owner).update(quota=1200)
+            self.assertEqual(patch(location, b'x' * 400).status_code, 413)
+            self.assertFalse(ChunkedUpload.objects.filter(document__isnull=False).exists())
+
+        self.assertEqual(self.usage(), (1000, 1))
+
+    def test_first_upload_quota(self):
+        # The counters of a user without documents are created before they are locked.
+        StorageUsage.objects.filter(user=self.owner).delete()
+
+        with self.settings(FILE_STORAGE_QUOTA=500):
+            self.assertEqual(self.client.post('/uploads/', HTTP_UPLOAD_LENGTH='600').status_code, 413)
+            self.assertEqual(self.client.post('/uploads/', HTTP_UPLOAD_LENGTH='400').status_code, 201)
+
+        self.assertEqual(self.usage(), (0, 0))
+
+    def test_reconcile(self):
+        StorageUsage.objects.filter(user=self.owner).update(bytes_used=5, file_count=7)
+        Document.objects.filter(pk=self.document.pk).update(size=None)
+
+        stdout = StringIO()
+        call_command('reconcile_storage_usage', batch_size=1, stdout=stdout)
+
+        self.assertIn('1 were corrected', stdout.getvalue())
+        self.assertEqual(self.usage(), (1000, 1))
+
+
+@override_settings(FILE_VERSION_SNAPSHOT_INTERVAL=3)
+class DocumentVersionTest(DocumentTestCase):
+    def edit(self, content, position, insert=b'', remove=0):
+        return content[:position] + insert + content[position + remove:]
+
+    def replace(self, content):
+        self.document.file.save('report.pdf', ContentFile(content))
+        return self.document.file.name
+
+    def download_version(self, number):
+        response = self.client.get('/documents/{}/versions/{}/'.format(self.document.pk, number))
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def upload(self, content, document_id):
+        metadata = 'filename {},document {}'.format(
+            base64.b64encode(b'report-v2.pdf').decode(), base64.b64encode(str(document_id).encode()).decode()
+        )
+        response = self.client.post('/uploads/', HTTP_UPLOAD_LENGTH=str(len(content)), HTTP_UPLOAD_METADATA=metadata)
+
+        if response.status_code != 201:
+            return response
+
+        return self.client.generic(
+            'PATCH', response['Location'], content, content_type='application/offset+octet-stream',
+            HTTP_UPLOAD_OFFSET='0'
+        )
+
+    def test_delta(self):
+        base = os.urandom(200000)
+        target = self.edit(self.edit(base, 1000, insert=b'inserted'), 150000, remove=300)
+
+        delta = io.BytesIO()
+        self.assertTrue(encode_delta(io.BytesIO(base), io.BytesIO(target), delta, len(target)))
+        self.assertLess(len(delta.getvalue()), 5000)
+
+        delta.seek(0)
+        self.assertEqual(b''.join(apply_delta(io.BytesIO(base), delta)), target)
+
+        # Unrelated files have no delta.
+        self.assertFalse(encode_delta(io.BytesIO(base), io.BytesIO(os.urandom(200000)), io.BytesIO(), 100000))
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_versions(self, on_commit):
+        storage = self.document.file.storage
+        first_name = self.document.file.name
+
+        contents = [self.CONTENT, os.urandom(100000)]
+        contents.append(self.edit(contents[1], 5000, insert=b'edited'))
+        contents.append(self.edit(contents[2], 90000, remove=100))
+        contents.append(self.edit(contents[3], 100, insert=b'again'))
+
+        names = [self.replace(content) for content in contents[1:]]
+
+        # The same content is no new version.
+        self.replace(contents[-1])
+
+        # The new files are recorded in full, and stored as deltas by process_documents.
+        self.assertEqual(
+            list(self.document.versions.order_by('number').values_list('kind', 'delta_pending')),
+            [(DocumentVersion.SNAPSHOT, False)] + [(DocumentVersion.SNAPSHOT, True)] * 4
+        )
+        call_command('process_documents', stdout=StringIO())
+
+        versions = list(self.document.versions.order_by('number'))
+        self.assertEqual(
+            [version.kind for version in versions],
+            [DocumentVersion.SNAPSHOT, DocumentVersion.SNAPSHOT, DocumentVersion.DELTA, DocumentVersion.DELTA,
+             DocumentVersion.SNAPSHOT]
+        )
+        self.assertLess(versions[2].stored_size, 2000)
+
+        # The versions are counted in the storage usage. The last snapshot keeps the file replaced by the same content.
+        bytes_used = len(contents[-1]) + sum(version.stored_size for version in versions)
+        self.assertEqual(StorageUsage.objects.get(user=self.owner).bytes_used, bytes_used)
+        call_command('reconcile_storage_usage', stdout=StringIO())
+        self.assertEqual(StorageUsage.objects.get(user=self.owner).bytes_used, bytes_used)
+
+        for number, content in enumerate(contents, 1):
+            self.assertEqual(self.download_version(number), content)
+
+        # Snapshots keep the replaced files, the files of versions stored as deltas are deleted.
+        self.assertTrue(storage.exists(first_name))
+        self.assertTrue(storage.exists(names[0]))
+        self.assertFalse(storage.exists(names[1]))
+        self.assertFalse(storage.exists(names[2]))
+
+        self.document.delete()
+        self.assertFalse(storage.exists(first_name))
+        self.assertFalse(storage.exists(versions[2].file.name))
+        self.assertEqual(StorageUsage.objects.get(user=self.owner).bytes_used, 0)
+
+    def test_permission(self):
+        self.replace(b'new content')
+
+        other_user = User.objects.create_user(email='other@simonprast.com', password='test-password')
+        self.client.force_login(other_user, backend=self.AUTH_BACKEND)
+        self.assertEqual(self.client.get('/documents/{}/versions/1/'.format(self.document.pk)).status_code, 403)
+
+        DocumentShare.objects.create(document=self.document, user=other_user)
+        self.assertEqual(self.download_version(1), self.CONTENT)
+
+        # Only owners may upload new versions.
+        self.assertEqual(self.upload(b'x', self.document.pk).status_code, 404)
+
+    def test_upload(self):
+        content = self.edit(self.CONTENT, 500, insert=b'uploaded')
+        response = self.upload(content, self.document.pk)
+
+        self.assertEqual(response['Upload-Document'], str(self.document.pk))
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.filename, 'report-v2.pdf')
+        self.assertEqual(self.document.checksum, hashlib.sha256(content).hexdigest())
+        self.assertEqual(self.document.versions.count(), 2)
+        self.assertEqual(self.download_version(1), self.CONTENT)
+        self.assertEqual(self.download_version(2), content)
+
+    def test_content_addressed(self):
+        with self.settings(USERDATA_CONTENT_ADDRESSED=True):
+            self.document = Document(title='Report', owner=self.owner)
+            self.document.file.save('report.pdf', ContentFile(self.CONTENT))
+            first_blob = self.document.blob_id
+
+            response = self.upload(self.CONTENT + b'appended', self.document.pk)
+
+        self.assertEqual(response['Upload-Document'], str(self.document.pk))
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.filename, 'report-v2.pdf')
+
+        # The first version keeps the replaced blob.
+        self.assertEqual(self.document.versions.get(number=1).blob_id, first_blob)
+        self.assertEqual(FileBlob.objects.get(checksum=first_blob).references, 1)
+        self.assertEqual(self.download_version(1), self.CONTENT)
+
+
+@override_settings(
+    USERDATA_SERVE_MODE='presigned-url',
+    USERDATA_S3_BUCKET='userdata',
+    USERDATA_S3_REGION='us-east-1',
+    USERDATA_S3_ACCESS_KEY='access-key',
+    USERDATA_S3_SECRET_KEY='secret-key',
+    USERDATA_S3_MULTIPART_THRESHOLD=5 * 1024 * 1024,
+    USERDATA_S3_MULTIPART_CHUNK_SIZE=5 * 1024 * 1024
+)
+class S3StorageTest(DocumentTestCase):
+    'The storage of documents in an object storage, which is simulated by moto.'
+
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+
+        # Clients created outside of the simulation would send requests to AWS.
+        clients = mock.patch.dict('file.s3._clients', clear=True)
+        clients.start()
+        self.addCleanup(clients.stop)
+
+        self.storage = S3UserDataStorage()
+        self.storage.client.create_bucket(Bucket='userdata')
+
+        for model in (Document, DocumentDerivative):
+            storage = mock.patch.object(model._meta.get_field('file'), 'storage', self.storage)
+            storage.start()
+            self.addCleanup(storage.stop)
+
+        super().setUp()
+
+    def test_presigned_download(self):
+        self.assertEqual(self.storage.size(self.document.file.name), 1000)
+
+        response = self.download()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Cache-Control'], 'private, no-store')
+        self.assertTrue(response['Location'].startswith('https://userdata.s3.amazonaws.com/{}?'.format(
+            self.document.file.name
+        )))
+        self.assertIn('response-content-disposition=attachment', response['Location'])
+        self.assertIn('X-Amz-Signature=', response['Location'])
+
+        # The permission is checked before the URL is issued.
+        other_user = User.objects.create_user(email='other@simonprast.com', password='test-password')
+        self.client.force_login(other_user, backend=self.AUTH_BACKEND)
+        self.assertEqual(self.download().status_code, 403)
+
+    def test_signed_byte_range(self):
+        path, expires = sign_download(self.document, self.owner, first_byte=995)
+        self.client.logout()
+
+        # Restricted downloads are streamed from the object storage.
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT[995:])
+
+    def test_seek(self):
+        with self.storage.open(self.document.file.name) as f:
+            self.assertEqual(f.read(4), b'0123')
+            f.seek(-3, 2)
+            self.assertEqual(f.read(), b'789')
+            self.assertEqual(f.read(), b'')
+
+            f.seek(1000)
+            self.assertEqual(f.read(10), b'')
+
+    def test_multipart_upload(self):
+        content = os.urandom(11 * 1024 * 1024)
+        name = self.storage.save('large.bin', ContentFile(content))
+
+        # The ETags of multipart uploads end with the number of parts.
+        self.assertTrue(self.storage.head(name)['ETag'].endswith('-3"'))
+
+        with self.storage.open(name) as f:
+            self.assertEqual(hashlib.sha256(f.read()).digest(), hashlib.sha256(content).digest())
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_chunked_upload(self, on_commit):
+        location = self.client.post('/uploads/', HTTP_UPLOAD_LENGTH=str(len(self.CONTENT)))['Location']
+        upload = ChunkedUpload.objects.get()
+
+        # The chunks are received in USERDATA_ROOT.
+        self.assertTrue(os.path.exists(os.path.join(USERDATA_ROOT, upload.file_name)))
+
+        response = self.client.generic(
+            'PATCH', location, self.CONTENT, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='0'
+        )
+        document = Document.objects.get(pk=response['Upload-Document'])
+
+        self.assertEqual(document.file.name, upload.file_name)
+        self.assertFalse(os.path.exists(os.path.join(USERDATA_ROOT, upload.file_name)))
+
+        with document.file.open('rb') as f:
+            self.assertEqual(f.read(), self.CONTENT)
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_delete(self, on_commit):
+        name = self.document.file.name
+        self.document.delete()
+
+        self.assertFalse(self.storage.exists(name))
+
+
+# The views run in other threads, which only see committed data.
+@override_settings(USERDATA_ROOT=USERDATA_ROOT)
+class AsyncDownloadTest(DocumentTestMixin, TransactionTestCase):
+    CONTENT = bytes(range(256)) * 10000
+
+    def download(self, *headers, path=None, query_string=b''):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path or '/userdata/{}'.format(self.document.file.name),
+            'query_string': query_string,
+            'server': ('testserver', 80),
+            'headers': [
+                (b'cookie', 'sessionid={}'.format(self.client.cookies['sessionid'].value).encode())
+            ] + list(headers),
+        }
+
+        @async_to_sync
+        async def communicate():
+            communicator = ApplicationCommunicator(DocumentASGIHandler(), scope)
+            await communicator.send_input({'type': 'http.request'})
+
+            start = await communicator.receive_output(timeout=5)
+            messages = []
+
+            while True:
+                message = await communicator.receive_output(timeout=5)
+                messages.append(message)
+
+                if not message.get('more_body'):
+                    return start, messages
+
+        return communicate()
+
+    def test_async_stream(self):
+        start, messages = self.download()
+
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(b''.join(message.get('body', b'') for message in messages), self.CONTENT)
+        # The file is read in aligned blocks of 1 MiB.
+        self.assertEqual(len(messages[0]['body']), 1024 * 1024)
+
+    def test_async_disconnect(self):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/userdata/{}'.format(self.document.file.name),
+            'query_string': b'',
+            'server': ('testserver', 80),
+            'headers': [(b'cookie', 'sessionid={}'.format(self.client.cookies['sessionid'].value).encode())],
+        }
+
+        @async_to_sync
+        async def communicate():
+            communicator = ApplicationCommunicator(DocumentASGIHandler(), scope)
+            await communicator.send_input({'type': 'http.request'})
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(timeout=5)
+
+            messages = []
+
+            while not communicator.output_queue.empty():
+                messages.append(communicator.output_queue.get_nowait())
+
+            return messages
+
+        messages = communicate()
+
+        self.assertEqual(messages[0]['type'], 'http.response.start')
+        # The handler stops before the end of the body.
+        self.assertTrue(all(message.get('more_body') for message in messages[1:]))
+        self.assertLess(sum(len(message.get('body', b'')) for message in messages[1:]), len(self.CONTENT))
+
+    def test_async_range(self):
+        start, messages = self.download((b'range', b'bytes=1048000-1049000,5-9'))
+
+        self.assertEqual(start['status'], 206)
+
+        body = b''.join(message.get('body', b'') for message in messages)
+        self.assertEqual(dict(start['headers'])[b'Content-Length'], str(len(body)).encode())
+        self.assertIn(self.CONTENT[1048000:1049001], body)
+        self.assertIn(self.CONTENT[5:10], body)
+
+    def test_async_archive(self):
+        start, messages = self.download(path='/archive/', query_string=b'document=%d' % self.document.pk)
+
+        self.assertEqual(start['status'], 200)
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(message.get('body', b'') for message in messages)))
+        self.assertEqual(archive.read('report.pdf'), self.CONTENT)
+
+    def test_forbidden(self):
+        self.client.logout()
+        self.client.force_login(
+            User.objects.create_user(email='other@simonprast.com', password='test-password'),
+            backend=self.AUTH_BACKEND
+        )
+
+        start, messages = self.download()
+        self.assertEqual(start['status'], 403)
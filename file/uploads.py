@@ -0,0 +1,324 @@
+# This file implements resumable uploads of documents, following the core protocol of tus (https://tus.io):
+# An upload is created with its length, chunks are sent with PATCH requests at the current offset, and the document
+# is created when the last chunk arrived. Chunks are written straight to the final location of the file, or to the
+# same path in USERDATA_ROOT if documents are stored in an object storage, to which the file is uploaded at the end.
+# An upload with a document id replaces the file of this document, which records a new version (see file.versions).
+# The SHA-256 checksum is calculated while the chunks arrive. If an upload is continued by another process, the
+# checksum of the stored part is calculated once from the file.
+
+import hashlib
+import os
+import threading
+
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .blobs import acquire_blob, release_blob
+from .models import ChunkedUpload, Document
+from .quota import QuotaExceeded, check_quota
+from .storage import UserDataFileStorage, create_file_path
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no advisory locks, a byte range of the file is locked instead.
+    fcntl = None
+    import msvcrt
+
+READ_SIZE = 64 * 1024
+
+# The checksums of the uploads in progress within this process, as {upload id: (offset, sha256 object)}.
+_checksums = {}
+_checksums_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    'An invalid upload request. The status is the HTTP status code of the response.'
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadLocked(UploadError):
+    def __init__(self):
+        super().__init__('Another chunk of this upload is being received.', status=409)
+
+
+def get_storage():
+    return Document._meta.get_field('file').storage
+
+
+def get_staging_storage():
+    'Return the storage which receives the chunks: the storage of documents, unless it is no file system.'
+
+    storage = get_storage()
+
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return UserDataFileStorage()
+
+    return storage
+
+
+def get_replaced_document(owner, document_id):
+    'Return the document whose file is replaced by an upload. Only owners and admins may replace files.'
+
+    documents = Document.objects.all() if owner.is_admin else Document.objects.filter(owner=owner)
+
+    try:
+        document = documents.filter(pk=int(document_id)).first()
+    except ValueError:
+        document = None
+
+    if document is None:
+        raise UploadError('The document does not exist.', 404)
+
+    return document
+
+
+def create_upload(owner, filename, length, title=None, replaces=None):
+    if length < 0:
+        raise UploadError('Invalid upload length.')
+
+    if length > settings.FILE_UPLOAD_MAX_LENGTH:
+        raise UploadError('The file exceeds the maximum size of {} bytes.'.format(settings.FILE_UPLOAD_MAX_LENGTH), 413)
+
+    storage = get_staging_storage()
+    filename = storage.get_valid_name(os.path.basename(filename or '')) or 'upload'
+
+    upload = ChunkedUpload(
+        owner=owner,
+        title=title,
+        filename=filename,
+        length=length,
+        replaces=None if replaces is None else get_replaced_document(owner, replaces),
+        expires_at=timezone.now() + timedelta(seconds=settings.FILE_UPLOAD_EXPIRATION)
+    )
+    upload.file_name = create_file_path(upload, filename)
+
+    # The length of incomplete uploads is reserved within the quota, so uploads exceeding it are refused at once.
+    with transaction.atomic():
+        try:
+            check_quota(owner, length)
+        except QuotaExceeded as e:
+            raise UploadError(str(e), 413)
+
+        # Create the (empty) file, so that chunks are written into its final location.
+        path = storage.path(upload.file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'xb').close()
+
+        upload.save()
+
+    if length == 0:
+        upload.document = complete_upload(upload, hashlib.sha256())
+
+    return upload
+
+
+def get_checksum(upload, f):
+    'Return the checksum object of the stored part of the upload, reading the file if it is unknown to this process.'
+
+    with _checksums_lock:
+        offset, checksum = _checksums.pop(upload.pk, (None, None))
+
+    if offset == upload.offset:
+        return checksum
+
+    checksum = hashlib.sha256()
+    f.seek(0)
+    remaining = upload.offset
+
+    while remaining > 0:
+        data = f.read(min(READ_SIZE, remaining))
+
+        if not data:
+            break
+
+        checksum.update(data)
+        remaining -= len(data)
+
+    return checksum
+
+
+@contextmanager
+def open_locked(path, length):
+    """Open the file of an upload of the given length for writing, locked against the other processes.
+    Raises UploadLocked if the file is locked already."""
+
+    with open(path, 'r+b') as f:
+        if fcntl:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadLocked()
+
+            yield f
+            return
+
+        # The locked byte follows the last byte of the upload, so that it is never written or read.
+        f.seek(length)
+
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            raise UploadLocked()
+
+        try:
+            yield f
+        finally:
+            f.seek(length)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_chunk(upload, offset, stream, content_length=None):
+    """Append the bytes of a stream to an upload at the given offset, which has to be the current one.
+    Returns the new offset. The document is created if the upload is complete."""
+
+    if upload.document_id:
+        raise UploadError('The upload is complete already.', 403)
+
+    # Expired uploads are no longer reserved within the quota, and are deleted by the collect_userdata command.
+    if upload.expires_at <= timezone.now():
+        raise UploadError('The upload has expired.', 410)
+
+    if offset != upload.offset:
+        raise UploadError('The offset does not match the current offset {}.'.format(upload.offset), 409)
+
+    remaining = upload.length - offset
+
+    if content_length is not None and content_length > remaining:
+        raise UploadError('The chunk exceeds the length of the upload.', 413)
+
+    # Only one request may write to an upload at a time.
+    with open_locked(get_staging_storage().path(upload.file_name), upload.length) as f:
+        # The offset may have changed while waiting for the lock.
+        upload.refresh_from_db()
+
+        if offset != upload.offset:
+            raise UploadError('The offset does not match the current offset {}.'.format(upload.offset), 409)
+
+        checksum = get_checksum(upload, f)
+        f.seek(offset)
+        f.truncate()
+
+        written = 0
+
+        try:
+            while True:
+                data = stream.read(READ_SIZE)
+
+                if not data:
+                    break
+
+                # The size limit is enforced as the bytes arrive. A chunk exceeding it is discarded entirely.
+                if written + len(data) > remaining:
+                    f.truncate(offset)
+                    written = 0
+                    checksum = None
+                    raise UploadError('The chunk exceeds the length of the upload.', 413)
+
+                f.write(data)
+                checksum.update(data)
+                written += len(data)
+        finally:
+            # If the connection dropped, the bytes received so far are kept and the client continues after them.
+            f.flush()
+            os.fsync(f.fileno())
+            save_offset(upload, offset + written, checksum)
+
+    if upload.offset == upload.length:
+        upload.document = complete_upload(upload, checksum)
+
+    return upload.offset
+
+
+def save_offset(upload, offset, checksum):
+    upload.offset = offset
+    upload.expires_at = timezone.now() + timedelta(seconds=settings.FILE_UPLOAD_EXPIRATION)
+    upload.save(update_fields=['offset', 'expires_at'])
+
+    if checksum is not None:
+        with _checksums_lock:
+            _checksums[upload.pk] = (offset, checksum)
+
+
+def complete_upload(upload, checksum):
+    'Create the document of a complete upload, or replace the file of the replaced document.'
+
+    with _checksums_lock:
+        _checksums.pop(upload.pk, None)
+
+    with transaction.atomic():
+        upload = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+
+        if upload.document_id:
+            return upload.document
+
+        # The quota may have been used up by other uploads, e.g. while this one was interrupted.
+        try:
+            check_quota(upload.owner, upload.length, upload=upload)
+        except QuotaExceeded as e:
+            raise UploadError(str(e), 413)
+
+        file_name = upload.file_name
+        staging_storage = get_staging_storage()
+        path = staging_storage.path(upload.file_name)
+        blob = None
+
+        # Move the file to its content-addressed location, or delete it if the same file is stored already.
+        if settings.USERDATA_CONTENT_ADDRESSED:
+            blob = acquire_blob(checksum.hexdigest(), upload.length, path=path)
+            file_name = blob.name
+        elif staging_storage is not get_storage():
+            # Upload the file to the object storage (in parallel parts, if it is large).
+            get_storage().save_blob(file_name, path=path)
+
+        if upload.replaces_id:
+            document = Document.objects.select_for_update().get(pk=upload.replaces_id)
+            previous_blob_id = document.blob_id
+
+            document.file = file_name
+            document.filename = upload.filename
+            document.checksum = checksum.hexdigest()
+            document.blob = blob
+            document.size = upload.length
+            document.title = upload.title or document.title
+            document.save()
+
+            if previous_blob_id:
+                release_blob(previous_blob_id)
+        else:
+            document = Document.objects.create(
+                title=upload.title,
+                owner=upload.owner,
+                file=file_name,
+                filename=upload.filename,
+                checksum=checksum.hexdigest(),
+                blob=blob,
+                size=upload.length
+            )
+
+        upload.document = document
+        upload.save(update_fields=['document'])
+
+    return document
+
+
+def cancel_upload(upload):
+    'Delete an incomplete upload and its file.'
+
+    if upload.document_id:
+        raise UploadError('The upload is complete already.', 403)
+
+    with _checksums_lock:
+        _checksums.pop(upload.pk, None)
+
+    get_staging_storage().delete(upload.file_name)
+    upload.delete()
@@ -1,8 +1,27 @@
 from django.urls import path
 
-from .views import DocumentDownload
+from .views import (
+    ArchiveDownload, DocumentDownload, DocumentVersionDownload, SignedDocumentDownload, UploadDetailView, UploadView
+)
 
 urlpatterns = [
     # Redirect request to media files to permission check.
     path('userdata/<path:relative_path>', DocumentDownload.as_view(), name='document-download'),
+
+    # ZIP archives of several documents.
+    path('archive/', ArchiveDownload.as_view(), name='document-archive'),
+
+    # Versions of documents, see file.versions.
+    path(
+        'documents/<int:document_id>/versions/<int:number>/',
+        DocumentVersionDownload.as_view(),
+        name='document-version'
+    ),
+
+    # Signed download URLs, see file.signing.
+    path('downloads/<str:token>/<str:filename>', SignedDocumentDownload.as_view(), name='signed-download'),
+
+    # Resumable uploads of documents.
+    path('uploads/', UploadView.as_view(), name='upload'),
+    path('uploads/<uuid:upload_id>', UploadDetailView.as_view(), name='upload-detail'),
 ]
@@ -0,0 +1,530 @@
+# This file implements the version history of documents. Whenever the file of a document is replaced, the new content
+# is recorded as a DocumentVersion in full (a snapshot sharing the file of the document). As encoding deltas takes
+# seconds for large files, the process_documents command stores the version as a binary delta against the previous
+# version afterwards, if this is much smaller than the file (e.g. for slightly edited documents).
+#
+# Deltas are computed like rsync does: the previous version is split into blocks, which are indexed by a weak rolling
+# checksum (Adler-32) and a strong hash. The new content is scanned for these blocks, moving by one byte (and rolling
+# the weak checksum) where none matches and by one block where one does. The delta is a zlib-compressed sequence of
+# copies of ranges of the previous version and literal data.
+#
+# Reading a version applies the deltas since the last full version (a snapshot) to it. Every
+# FILE_VERSION_SNAPSHOT_INTERVAL-th version is a snapshot, which bounds the number of deltas applied to read any
+# version. Snapshots share the stored file (or blob) of the document instead of copying it. Intermediate versions are
+# written to temporary files, the requested version is streamed, so reading a version needs little memory.
+
+import hashlib
+import math
+import mimetypes
+import os
+import struct
+import tempfile
+import zlib
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils.http import quote_etag
+
+from .models import Document, DocumentVersion
+from .quota import get_versions_size, update_usage
+from .responses import CHUNK_SIZE, get_content_disposition
+
+DELTA_MAGIC = b'FDLT1'
+COPY = b'C'
+LITERAL = b'L'
+END = b'E'
+
+READ_SIZE = 1024 * 1024
+
+# Scanning literal data moves by single bytes, which takes about a second per MB. Therefore deltas are abandoned
+# if their literal data exceeds this share of the file, and before scanning a file, PROBES regions of it are
+# searched for blocks of the previous version: it is only scanned if the same share of the regions contain one.
+MAX_LITERAL_RATIO = 0.25
+PROBES = 16
+
+ADLER_MODULUS = 65521
+
+
+def get_block_size(size):
+    # Like rsync, about the square root of the size, so that both the index and the literal data around changes stay
+    # small, at least 512 bytes and at most 64 KiB.
+    return min(max(int(math.sqrt(size)) // 64 * 64, 512), 64 * 1024)
+
+
+def get_strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def read_exactly(f, size):
+    'Read size bytes, or fewer at the end of the file, from a file whose reads may return less.'
+
+    data = f.read(size)
+
+    while len(data) < size:
+        more = f.read(size - len(data))
+
+        if not more:
+            break
+
+        data += more
+
+    return data
+
+
+def get_signature(base, block_size):
+    'Return the blocks of a file, as {weak checksum: {strong checksum: offset}}.'
+
+    signature = {}
+    offset = 0
+
+    while True:
+        block = read_exactly(base, block_size)
+
+        # A short last block is not indexed, the bytes are sent as literal data.
+        if len(block) < block_size:
+            return signature
+
+        signature.setdefault(zlib.adler32(block), {}).setdefault(get_strong_checksum(block), offset)
+        offset += block_size
+
+
+def find_block(signature, data, block_size):
+    'Return whether the data contains a block of the signature.'
+
+    weak = zlib.adler32(data[:block_size])
+    a, b = weak & 0xffff, weak >> 16
+
+    for pos in range(len(data) - block_size + 1):
+        if pos:
+            removed, added = data[pos - 1], data[pos + block_size - 1]
+            a = (a - removed + added) % ADLER_MODULUS
+            b = (b - block_size * removed + a - 1) % ADLER_MODULUS
+            weak = (b << 16) | a
+
+        blocks = signature.get(weak)
+
+        if blocks and get_strong_checksum(data[pos:pos + block_size]) in blocks:
+            return True
+
+    return False
+
+
+def is_similar(signature, block_size, target):
+    'Return whether the share of the probed regions of the target which contain a block is large enough.'
+
+    size = target.seek(0, 2)
+    matches = 0
+
+    # Small files are scanned anyway.
+    if size < block_size * PROBES * 4:
+        target.seek(0)
+        return True
+
+    for index in range(PROBES):
+        # Each region covers two blocks, so it contains a complete block of any unchanged part.
+        target.seek(size * index // PROBES)
+
+        if find_block(signature, read_exactly(target, 2 * block_size), block_size):
+            matches += 1
+
+    target.seek(0)
+    return PROBES - matches <= PROBES * MAX_LITERAL_RATIO
+
+
+class DeltaWriter:
+    'Writes the compressed operations of a delta, merging copies of adjacent blocks.'
+
+    def __init__(self, output):
+        self.output = output
+        self.compressor = zlib.compressobj()
+        self.copy_offset = None
+        self.copy_length = 0
+        self.literal_size = 0
+
+        output.write(DELTA_MAGIC)
+
+    def write(self, data):
+        self.output.write(self.compressor.compress(data))
+
+    def copy(self, offset, length):
+        if self.copy_offset is not None and self.copy_offset + self.copy_length == offset:
+            self.copy_length += length
+            return
+
+        self.flush_copy()
+        self.copy_offset, self.copy_length = offset, length
+
+    def flush_copy(self):
+        if self.copy_offset is not None:
+            self.write(COPY + struct.pack('>QQ', self.copy_offset, self.copy_length))
+            self.copy_offset = None
+
+    def literal(self, data):
+        if not data:
+            return
+
+        self.flush_copy()
+        self.literal_size += len(data)
+        self.write(LITERAL + struct.pack('>Q', len(data)))
+        self.write(data)
+
+    def close(self):
+        self.flush_copy()
+        self.write(END)
+        self.output.write(self.compressor.flush())
+
+
+def encode_delta(base, target, output, max_literal_size):
+    """Write the delta from the base file to the target file to output.
+    Returns False (leaving output incomplete) if the literal data exceeds max_literal_size."""
+
+    base_size = base.seek(0, 2)
+    base.seek(0)
+
+    block_size = get_block_size(base_size)
+    signature = get_signature(base, block_size)
+
+    if not is_similar(signature, block_size, target):
+        return False
+
+    writer = DeltaWriter(output)
+
+    data = b''
+    start = pos = 0
+    eof = False
+    weak = None
+
+    while True:
+        # Keep a window and the next byte in the buffer. Pending literal data is written before the buffer is moved.
+        if not eof and len(data) - pos <= block_size:
+            writer.literal(data[start:pos])
+
+            if writer.literal_size > max_literal_size:
+                return False
+
+            chunk = target.read(READ_SIZE)
+            eof = not chunk
+            data = data[pos:] + chunk
+            start = pos = 0
+            continue
+
+        if len(data) - pos < block_size:
+            break
+
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + block_size])
+            a, b = weak & 0xffff, weak >> 16
+
+        blocks = signature.get(weak)
+
+        if blocks:
+            offset = blocks.get(get_strong_checksum(data[pos:pos + block_size]))
+
+            if offset is not None:
+                writer.literal(data[start:pos])
+                writer.copy(offset, block_size)
+                pos += block_size
+                start = pos
+                weak = None
+                continue
+
+        if len(data) - pos == block_size:
+            if eof:
+                break
+            continue
+
+        # Roll the checksum by one byte.
+        removed, added = data[pos], data[pos + block_size]
+        a = (a - removed + added) % ADLER_MODULUS
+        b = (b - block_size * removed + a - 1) % ADLER_MODULUS
+        weak = (b << 16) | a
+        pos += 1
+
+    writer.literal(data[start:])
+
+    if writer.literal_size > max_literal_size:
+        return False
+
+    writer.close()
+    return True
+
+
+class DeltaReader:
+    'Reads the decompressed operations of a delta.'
+
+    def __init__(self, delta):
+        if delta.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+            raise ValueError('The file is no delta.')
+
+        self.delta = delta
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b''
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            if self.decompressor.unconsumed_tail:
+                compressed = self.decompressor.unconsumed_tail
+            else:
+                compressed = self.delta.read(CHUNK_SIZE)
+
+                if not compressed:
+                    raise ValueError('The delta is truncated.')
+
+            # The output is limited, so that large literals are not decompressed at once.
+            self.buffer += self.decompressor.decompress(compressed, max(size - len(self.buffer), CHUNK_SIZE))
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def apply_delta(base, delta):
+    'Yield the content of a version from the previous version (a seekable file) and the delta file.'
+
+    reader = DeltaReader(delta)
+
+    while True:
+        operation = reader.read(1)
+
+        if operation == COPY:
+            offset, remaining = struct.unpack('>QQ', reader.read(16))
+            base.seek(offset)
+
+            while remaining > 0:
+                data = base.read(min(CHUNK_SIZE, remaining))
+
+                if not data:
+                    raise ValueError('The delta exceeds the previous version.')
+
+                remaining -= len(data)
+                yield data
+        elif operation == LITERAL:
+            remaining, = struct.unpack('>Q', reader.read(8))
+
+            while remaining > 0:
+                data = reader.read(min(CHUNK_SIZE, remaining))
+                remaining -= len(data)
+                yield data
+        elif operation == END:
+            return
+        else:
+            raise ValueError('Invalid delta operation {!r}.'.format(operation))
+
+
+def iter_version(version):
+    'Yield the content of a version, applying the deltas since the last snapshot.'
+
+    chain = list(
+        DocumentVersion.objects.filter(
+            document=version.document_id,
+            number__gte=version.snapshot_number,
+            number__lte=version.number
+        ).order_by('number')
+    )
+
+    if not chain or chain[0].kind != DocumentVersion.SNAPSHOT:
+        raise ValueError('The snapshot of version {} is missing.'.format(version.number))
+
+    with chain[0].file.storage.open(chain[0].file.name, 'rb') as snapshot:
+        if len(chain) == 1:
+            yield from snapshot.chunks(CHUNK_SIZE)
+            return
+
+        with tempfile.TemporaryFile() as first, tempfile.TemporaryFile() as second:
+            base = snapshot
+
+            # Each intermediate version is written to a temporary file, which is the base of the next delta.
+            for index, delta_version in enumerate(chain[1:-1]):
+                current = (first, second)[index % 2]
+                current.seek(0)
+                current.truncate()
+
+                with delta_version.file.storage.open(delta_version.file.name, 'rb') as delta:
+                    for data in apply_delta(base, delta):
+                        current.write(data)
+
+                base = current
+
+            with chain[-1].file.storage.open(chain[-1].file.name, 'rb') as delta:
+                yield from apply_delta(base, delta)
+
+
+class VersionResponse(StreamingHttpResponse):
+    """
+    Streams the content of a version. Under ASGI, file.asgi.DocumentASGIHandler iterates it in its thread pool, as
+    applying the deltas reads files.
+    """
+
+    def __init__(self, version):
+        content_type = mimetypes.guess_type(version.filename)[0] or 'application/octet-stream'
+        super().__init__(iter_version(version), content_type=content_type)
+        self['Content-Length'] = version.size
+        self['Content-Disposition'] = get_content_disposition(version.filename)
+        self['ETag'] = quote_etag(version.checksum)
+
+
+def create_snapshot(document, number, name, blob_id, checksum, size, filename, delta_pending=False):
+    'Record a version stored in full, sharing the stored file (or the blob) of the document.'
+
+    if blob_id:
+        # The version keeps the blob, as long as it exists.
+        from .blobs import acquire_blob
+        acquire_blob(blob_id, size)
+
+    return DocumentVersion.objects.create(
+        document=document,
+        number=number,
+        snapshot_number=number,
+        kind=DocumentVersion.SNAPSHOT,
+        file=name,
+        blob_id=blob_id,
+        size=size,
+        stored_size=size,
+        checksum=checksum,
+        filename=filename,
+        delta_pending=delta_pending
+    )
+
+
+def create_delta(version, previous):
+    'Store the content of a version as a delta against the previous version. Returns (name, size) or None.'
+
+    storage = version.file.storage
+
+    with tempfile.TemporaryFile() as base, tempfile.TemporaryFile() as output:
+        # The previous version may be a delta itself.
+        for data in iter_version(previous):
+            base.write(data)
+
+        with storage.open(version.file.name, 'rb') as target:
+            if not encode_delta(base, target, output, version.size * MAX_LITERAL_RATIO):
+                return None
+
+        stored_size = output.tell()
+
+        # Small files may not shrink at all.
+        if stored_size >= version.size:
+            return None
+
+        delta = DocumentVersion(document_id=version.document_id, number=version.number)
+        output.seek(0)
+        delta.file.save('{}.delta'.format(version.number), File(output), save=False)
+
+    return delta.file.name, stored_size
+
+
+def encode_version(version):
+    """Store a version recorded in full by Document.save as a delta against the previous version, unless this saves no
+    space or FILE_VERSION_SNAPSHOT_INTERVAL - 1 deltas follow the last snapshot already."""
+
+    previous = DocumentVersion.objects.get(document=version.document_id, number=version.number - 1)
+    delta = None
+
+    if version.number - previous.snapshot_number < settings.FILE_VERSION_SNAPSHOT_INTERVAL and \
+            version.size <= settings.FILE_VERSION_DELTA_MAX_SIZE:
+        try:
+            delta = create_delta(version, previous)
+        except (OSError, ValueError):
+            # E.g. a file is missing, the version stays a snapshot.
+            delta = None
+
+    storage = version.file.storage
+
+    with transaction.atomic():
+        # The version may have been encoded by another worker, whose claim of the document expired.
+        locked = DocumentVersion.objects.select_for_update().filter(pk=version.pk, delta_pending=True).first()
+
+        if locked is None or delta is None:
+            if locked is not None:
+                locked.delta_pending = False
+                locked.save(update_fields=['delta_pending'])
+
+            if delta is not None:
+                storage.delete(delta[0])
+
+            return
+
+        owner_id, current_file = Document.objects.filter(pk=version.document_id).values_list('owner_id', 'file').get()
+        versions = DocumentVersion.objects.filter(document=version.document_id)
+        versions_size = get_versions_size(versions, current_file)
+        name, blob_id = locked.file.name, locked.blob_id
+
+        locked.kind = DocumentVersion.DELTA
+        locked.snapshot_number = previous.snapshot_number
+        locked.file = delta[0]
+        locked.blob = None
+        locked.stored_size = delta[1]
+        locked.delta_pending = False
+        locked.save()
+
+        update_usage(owner_id, get_versions_size(versions, current_file) - versions_size, 0)
+
+        # The file stays as long as it is the file of the document (or of another version).
+        if blob_id:
+            from .blobs import release_blob
+            release_blob(blob_id)
+        else:
+            transaction.on_commit(lambda: delete_unreferenced_file(storage, name))
+
+
+def encode_pending_versions(document):
+    'Encode the versions of a document recorded in full by Document.save, in order. Called by process_documents.'
+
+    for version in DocumentVersion.objects.filter(document=document, delta_pending=True).order_by('number'):
+        encode_version(version)
+
+
+def add_version(document, previous):
+    """Record the new file of a document as a version. previous is the tuple (name, blob id, checksum, size, filename)
+    of the replaced file, which is recorded as the first version if the document has none yet."""
+
+    previous_name, previous_blob_id, previous_checksum, previous_size, previous_filename = previous
+    previous_filename = previous_filename or os.path.basename(previous_name)
+    storage = document.file.storage
+    versions_size = get_versions_size(document.versions.all(), previous_name)
+
+    latest = document.versions.order_by('-number').first()
+
+    if latest is None:
+        # Files stored before checksums and sizes were introduced may have none.
+        if not previous_checksum:
+            previous_checksum = hashlib.sha256()
+
+            with storage.open(previous_name, 'rb') as f:
+                for chunk in f.chunks():
+                    previous_checksum.update(chunk)
+
+            previous_checksum = previous_checksum.hexdigest()
+
+        if previous_size is None:
+            previous_size = storage.size(previous_name)
+
+        latest = create_snapshot(
+            document, 1, previous_name, previous_blob_id, previous_checksum, previous_size, previous_filename
+        )
+
+    if latest.checksum != document.checksum:
+        # Encoding the delta takes too long for the request replacing the file, it is left to process_documents.
+        latest = create_snapshot(
+            document, latest.number + 1, document.file.name, document.blob_id, document.checksum, document.size,
+            document.filename or os.path.basename(document.file.name), delta_pending=True
+        )
+
+    # Count the new versions, and the snapshot of the replaced file, in the storage usage of the owner.
+    update_usage(document.owner_id, get_versions_size(document.versions.all(), document.file.name) - versions_size, 0)
+
+    # The replaced file is kept by a snapshot, or its content can be read from the versions.
+    if not previous_blob_id:
+        transaction.on_commit(lambda: delete_unreferenced_file(storage, previous_name))
+
+    return latest
+
+
+def delete_unreferenced_file(storage, name):
+    'Delete a file, unless it is the file of a document or of a version.'
+
+    if Document.objects.filter(file=name).exists() or DocumentVersion.objects.filter(file=name).exists():
+        return
+
+    storage.delete(name)
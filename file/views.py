@@ -1,24 +1,264 @@
+import base64
+import binascii
+import time
+
 from django.conf import settings
-from django.http import FileResponse, HttpResponseForbidden
+from django.contrib.auth import authenticate
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from graphql_jwt.exceptions import JSONWebTokenError
+
+from .acl import can_read, filter_readable, get_readable_documents
+from .archives import ArchiveResponse
+from .models import ChunkedUpload, Document, DocumentDerivative, DocumentVersion
+from .responses import get_download_response
+from .signing import verify_download
+from .uploads import UploadError, cancel_upload, create_upload, write_chunk
+from .versions import VersionResponse
+
+TUS_VERSION = '1.0.0'
+
+
+def get_request_user(request):
+    'Return the user authenticated by the session or by a JSON web token (Authorization: JWT <token>), or None.'
+
+    if request.user.is_authenticated:
+        return request.user
+
+    try:
+        return authenticate(request=request)
+    except JSONWebTokenError:
+        return None
+
+
+def parse_upload_metadata(header):
+    'Parse the Upload-Metadata header, a comma separated list of keys and base64 encoded values.'
 
-from .models import Document
+    metadata = {}
+
+    for pair in header.split(','):
+        key, _, value = pair.strip().partition(' ')
+
+        if key:
+            try:
+                metadata[key] = base64.b64decode(value, validate=True).decode()
+            except (binascii.Error, UnicodeDecodeError):
+                raise UploadError('Invalid Upload-Metadata header.')
+
+    return metadata
+
+
+def tus_response(status=204, **headers):
+    response = HttpResponse(status=status)
+    response['Tus-Resumable'] = TUS_VERSION
+
+    for header, value in headers.items():
+        response[header.replace('_', '-')] = value
+
+    return response
 
 
 class DocumentDownload(View):
     def get(self, request, relative_path):
-        # get_object_or_404:
-        # Calls get() on a given model manager, but it raises Http404 instead of the model’s DoesNotExist exception.
-        document = get_object_or_404(Document, file=relative_path)
+        # Content-addressed files are shared by all documents with the same content.
+        documents = list(Document.objects.filter(file=relative_path))
+        derivative = None
+
+        # Derivatives (e.g. thumbnails) may be downloaded by the users who may download their document.
+        if not documents:
+            derivative = DocumentDerivative.objects.select_related('document').filter(file=relative_path).first()
+
+            if derivative is None:
+                raise Http404()
 
-        # Deny file access if the reuqesting user is not authorized to do so.
-        # TODO: Implement files with group access
-        if request.user.is_anonymous or (not request.user.is_admin and document.owner != request.user):
+            documents = [derivative.document]
+
+        # Deny file access if the requesting user is not authorized to do so (see file.acl).
+        if request.user.is_anonymous:
+            return HttpResponseForbidden()
+
+        readable = filter_readable(request.user, [document.pk for document in documents])
+
+        # Use the requesting user's document, e.g. for its filename.
+        documents = sorted(
+            (document for document in documents if document.pk in readable),
+            key=lambda document: document.owner_id != request.user.pk
+        )
+
+        if not documents:
             return HttpResponseForbidden()
 
-        absolute_path = '{}/{}'.format(settings.USERDATA_ROOT, relative_path)
+        document = documents[0]
+
+        # Streams the file or lets the web server send it, depending on USERDATA_SERVE_MODE.
+        return get_download_response(request, derivative or document)
+
+
+class ArchiveDownload(View):
+    'Streams a ZIP archive of the selected documents (?document=<id>&document=<id>...).'
+
+    def get(self, request):
+        user = get_request_user(request)
+
+        if user is None:
+            return HttpResponseForbidden()
+
+        try:
+            ids = {int(document_id) for document_id in request.GET.getlist('document')}
+        except ValueError:
+            return HttpResponseBadRequest('Invalid document id.')
+
+        if not ids or len(ids) > settings.USERDATA_ARCHIVE_MAX_DOCUMENTS:
+            return HttpResponseBadRequest(
+                'Select between 1 and {} documents.'.format(settings.USERDATA_ARCHIVE_MAX_DOCUMENTS)
+            )
+
+        # The permissions of all documents are checked by the query loading them (see file.acl).
+        documents = list(
+            get_readable_documents(user).filter(pk__in=ids).only('id', 'file', 'filename', 'mime_type').order_by('id')
+        )
+
+        if len(documents) != len(ids):
+            return HttpResponseForbidden()
+
+        return ArchiveResponse(documents)
+
+
+class DocumentVersionDownload(View):
+    'Streams a version of a document, which is reconstructed from its deltas (see file.versions).'
+
+    def get(self, request, document_id, number):
+        user = get_request_user(request)
+
+        if user is None or not can_read(user, document_id):
+            return HttpResponseForbidden()
+
+        version = get_object_or_404(
+            DocumentVersion.objects.select_related('document'), document=document_id, number=number
+        )
+
+        # The current version is the file of the document, which is sent like any download.
+        if version.checksum == version.document.checksum:
+            return get_download_response(request, version.document)
+
+        return VersionResponse(version)
+
+
+class SignedDocumentDownload(View):
+    'Sends documents to the holders of signed URLs (see file.signing), without querying the database.'
+
+    def get(self, request, token, filename):
+        scope = verify_download(token)
+
+        if scope is None:
+            return HttpResponseForbidden()
+
+        document = scope.get_document()
+
+        # The file was replaced or deleted since the URL was issued.
+        if not document.file.storage.exists(document.file.name):
+            raise Http404()
+
+        response = get_download_response(request, document, byte_range=scope.byte_range)
+
+        if response.status_code in (200, 206, 304):
+            # The content of the file is fixed by the signed checksum, so caches may keep it until the URL expires.
+            response['Cache-Control'] = 'public, max-age={}, immutable'.format(max(int(scope.expires - time.time()), 0))
 
-        # Use as_attachment=True to download the file instead of showing it in-browser.
-        response = FileResponse(open(absolute_path, 'rb'), as_attachment=True)
         return response
+
+
+# Cross-site requests cannot set the Upload-Length header or send the offset content type without a CORS preflight,
+# therefore the upload views do not need the CSRF protection.
+@method_decorator(csrf_exempt, name='dispatch')
+class TusView(View):
+    def dispatch(self, request, *args, **kwargs):
+        self.upload_user = get_request_user(request)
+
+        if self.upload_user is None and request.method != 'OPTIONS':
+            return tus_response(401)
+
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except UploadError as e:
+            response = tus_response(e.status)
+            response.content = str(e)
+            return response
+
+    def options(self, request, *args, **kwargs):
+        return tus_response(
+            Tus_Version=TUS_VERSION,
+            Tus_Max_Size=settings.FILE_UPLOAD_MAX_LENGTH,
+            Tus_Extension='creation,termination'
+        )
+
+
+class UploadView(TusView):
+    'Creates resumable uploads (tus creation extension), of new documents or of new versions of a document.'
+
+    def post(self, request):
+        try:
+            length = int(request.headers['Upload-Length'])
+        except (KeyError, ValueError):
+            raise UploadError('The Upload-Length header is missing or invalid.')
+
+        metadata = parse_upload_metadata(request.headers.get('Upload-Metadata', ''))
+        upload = create_upload(
+            self.upload_user,
+            metadata.get('filename'),
+            length,
+            title=metadata.get('title'),
+            replaces=metadata.get('document')
+        )
+
+        return tus_response(
+            201,
+            Location=request.build_absolute_uri(reverse('upload-detail', args=[upload.pk])),
+            Upload_Offset=upload.offset
+        )
+
+
+class UploadDetailView(TusView):
+    'Receives the chunks of an upload (tus core protocol and termination extension).'
+
+    def get_upload(self, upload_id):
+        return get_object_or_404(ChunkedUpload, pk=upload_id, owner=self.upload_user)
+
+    def head(self, request, upload_id):
+        upload = self.get_upload(upload_id)
+
+        return tus_response(
+            200,
+            Upload_Offset=upload.offset,
+            Upload_Length=upload.length,
+            Cache_Control='no-store'
+        )
+
+    def patch(self, request, upload_id):
+        upload = self.get_upload(upload_id)
+
+        if request.content_type != 'application/offset+octet-stream':
+            raise UploadError('The content type must be application/offset+octet-stream.', 415)
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            raise UploadError('The Upload-Offset header is missing or invalid.')
+
+        content_length = request.headers.get('Content-Length')
+        offset = write_chunk(upload, offset, request, int(content_length) if content_length else None)
+
+        headers = {'Upload_Offset': offset}
+        if upload.document_id:
+            headers['Upload_Document'] = upload.document_id
+
+        return tus_response(**headers)
+
+    def delete(self, request, upload_id):
+        cancel_upload(self.get_upload(upload_id))
+        return tus_response()
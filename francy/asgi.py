@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'francy.settings')
 
-application = get_asgi_application()
+# Like django.core.asgi.get_asgi_application, but using the handler sending documents asynchronously.
+django.setup(set_prefix=False)
+
+from file.asgi import DocumentASGIHandler  # noqa: E402
+
+application = DocumentASGIHandler()
@@ -200,6 +200,76 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 USERDATA_URL = '/userdata/'
 USERDATA_ROOT = os.path.join(BASE_DIR, 'userdata')
 
+# Where documents and their derivatives are stored (see file.storage.get_userdata_storage):
+# 'filesystem' stores them in USERDATA_ROOT.
+# 's3' stores them in the bucket USERDATA_S3_BUCKET of an object storage speaking the S3 API (see file.s3), which is
+# shared by all nodes. Resumable uploads are received in USERDATA_ROOT until they are complete.
+USERDATA_STORAGE = os.getenv('USERDATA_STORAGE', 'filesystem')
+USERDATA_S3_BUCKET = os.getenv('USERDATA_S3_BUCKET')
+# The URL of the object storage, e.g. http://minio:9000 (None: AWS S3).
+USERDATA_S3_ENDPOINT_URL = os.getenv('USERDATA_S3_ENDPOINT_URL')
+USERDATA_S3_REGION = os.getenv('USERDATA_S3_REGION')
+USERDATA_S3_ACCESS_KEY = os.getenv('USERDATA_S3_ACCESS_KEY')
+USERDATA_S3_SECRET_KEY = os.getenv('USERDATA_S3_SECRET_KEY')
+# MinIO and most other S3-compatible storages need 'path', AWS S3 uses 'virtual' hosted buckets.
+USERDATA_S3_ADDRESSING_STYLE = os.getenv('USERDATA_S3_ADDRESSING_STYLE', 'auto')
+# Connections to the object storage kept open by each process, shared by all its threads.
+USERDATA_S3_MAX_CONNECTIONS = 20
+# Files larger than the threshold are uploaded in parts of USERDATA_S3_MULTIPART_CHUNK_SIZE bytes, which are sent
+# by USERDATA_S3_MULTIPART_CONCURRENCY threads at once.
+USERDATA_S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+USERDATA_S3_MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+USERDATA_S3_MULTIPART_CONCURRENCY = 8
+# Seconds a presigned download URL is valid. A new one is issued for every permitted download.
+USERDATA_S3_PRESIGNED_URL_EXPIRATION = 60
+
+# Store files of documents once per content, under their SHA-256 (see file.blobs), instead of once per document.
+USERDATA_CONTENT_ADDRESSED = (os.environ.get('USERDATA_CONTENT_ADDRESSED', 'False') == 'True')
+
+# How documents are sent after the permission check (see file.views.DocumentDownload):
+# 'django' streams the file through the Django worker.
+# 'x-accel-redirect' lets nginx send the file from an internal location, which maps USERDATA_ACCEL_PREFIX to
+# USERDATA_ROOT (location /protected-userdata/ { internal; alias /path/to/userdata/; }).
+# 'x-sendfile' lets Apache (mod_xsendfile) or lighttpd send the file from its absolute path.
+# 'presigned-url' redirects to a presigned URL, from which the object storage sends the file (USERDATA_STORAGE 's3').
+USERDATA_SERVE_MODE = os.getenv('USERDATA_SERVE_MODE', 'django')
+USERDATA_ACCEL_PREFIX = '/protected-userdata/'
+# Under ASGI, streamed documents are read by this number of threads, shared by all downloads (see file.asgi).
+USERDATA_ASYNC_READ_THREADS = 8
+# Signed download URLs expire after USERDATA_SIGNED_URL_EXPIRATION seconds by default, at most after
+# USERDATA_SIGNED_URL_MAX_EXPIRATION seconds (see file.signing).
+USERDATA_SIGNED_URL_EXPIRATION = 60 * 60
+USERDATA_SIGNED_URL_MAX_EXPIRATION = 7 * 24 * 60 * 60
+# The maximum number of documents downloaded as one ZIP archive (see file.archives).
+USERDATA_ARCHIVE_MAX_DOCUMENTS = 1000
+
+# Resumable uploads of documents (see file.uploads)
+# Uploads larger than FILE_UPLOAD_MAX_LENGTH bytes are refused, incomplete uploads expire after FILE_UPLOAD_EXPIRATION
+# seconds without a new chunk.
+FILE_UPLOAD_MAX_LENGTH = 2 * 1024 * 1024 * 1024
+FILE_UPLOAD_EXPIRATION = 24 * 60 * 60
+# The storage quota of each user in bytes (None: unlimited), which can be changed per user (see file.quota).
+FILE_STORAGE_QUOTA = 10 * 1024 * 1024 * 1024
+
+# Processing of documents by the process_documents command (see file.derivatives)
+# Images and the first pages of PDFs are fitted into squares of these sizes (in pixels).
+FILE_THUMBNAIL_SIZES = (128, 256)
+FILE_PREVIEW_SIZES = (1024,)
+# PDFs are rendered by poppler-utils, if installed.
+FILE_PDFTOPPM = 'pdftoppm'
+FILE_PDFINFO = 'pdfinfo'
+# Seconds after which the rendering of a PDF is stopped.
+FILE_PROCESSING_TIMEOUT = 60
+# Seconds a worker owns the documents it claimed, after which they are processed by another worker.
+FILE_PROCESSING_CLAIM_DURATION = 10 * 60
+
+# Version history of documents (see file.versions)
+# Every FILE_VERSION_SNAPSHOT_INTERVAL-th version is stored in full, so that at most FILE_VERSION_SNAPSHOT_INTERVAL - 1
+# deltas are applied to read a version. Files larger than FILE_VERSION_DELTA_MAX_SIZE bytes are always stored in full,
+# as computing their deltas would occupy the process_documents worker for too long.
+FILE_VERSION_SNAPSHOT_INTERVAL = 10
+FILE_VERSION_DELTA_MAX_SIZE = 16 * 1024 * 1024
+
 EMAIL_DEMO_BACKEND = (os.environ.get('EMAIL_DEMO_BACKEND', 'False') == 'True')
 
 # E-mail configuration
@@ -212,6 +282,45 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 EMAIL_USE_TLS = True
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# Mail outbox (see mailing.outbox)
+# Mails are stored by send_mail and sent by the send_outbox command. Failed mails are retried with an exponential
+# backoff, starting at MAIL_OUTBOX_RETRY_DELAY seconds, and marked as dead after MAIL_OUTBOX_MAX_ATTEMPTS attempts.
+MAIL_OUTBOX_MAX_ATTEMPTS = 8
+MAIL_OUTBOX_RETRY_DELAY = 60
+MAIL_OUTBOX_MAX_RETRY_DELAY = 6 * 60 * 60
+# Seconds a worker may take to send a claimed mail before other workers may claim it again.
+MAIL_OUTBOX_CLAIM_DURATION = 5 * 60
+
+# Mail sender (see mailing.sender)
+# Threads sending mails in parallel, open connections per mail server and messages sent per connection at once.
+MAIL_SENDER_WORKERS = 4
+MAIL_SENDER_CONNECTIONS_PER_HOST = 4
+MAIL_SENDER_MESSAGES_PER_TASK = 20
+
+# Full-text search of sent mails in the admin (see mailing.search)
+# The newest MAIL_SEARCH_CANDIDATES matches are ranked, of which the MAIL_SEARCH_MAX_RESULTS best are shown.
+# Ranking is the expensive part of searching common words, so MAIL_SEARCH_CANDIDATES bounds the search time.
+# MAIL_SEARCH_CONFIG is the PostgreSQL text search configuration, 'simple' does not stem words of any language.
+MAIL_SEARCH_MAX_RESULTS = 1000
+MAIL_SEARCH_CANDIDATES = 10000
+MAIL_SEARCH_CONFIG = 'simple'
+
+# Mail campaigns (see mailing.campaigns)
+# Campaign mails are queued in batches of MAIL_CAMPAIGN_BATCH_SIZE, at most MAIL_CAMPAIGN_RATE mails per second.
+# The rate applies to all processes if RATE_LIMIT_BACKEND is shared, e.g. 'user.rate_limit.CacheBackend'.
+MAIL_CAMPAIGN_RATE = 20
+MAIL_CAMPAIGN_BATCH_SIZE = 500
+
+# Retention of sent mails (see the archive_mails command)
+# Mails older than MAIL_RETENTION_DAYS are moved to gzipped JSON lines files in MAIL_ARCHIVE_ROOT, one per month.
+MAIL_RETENTION_DAYS = 365
+MAIL_ARCHIVE_ROOT = os.getenv('MAIL_ARCHIVE_ROOT', os.path.join(BASE_DIR, 'mail-archive'))
+
+# Email verification codes are valid for EMAIL_VERIFICATION_TIMEOUT seconds
+# and can be guessed EMAIL_VERIFICATION_MAX_ATTEMPTS times.
+EMAIL_VERIFICATION_TIMEOUT = 10 * 60
+EMAIL_VERIFICATION_MAX_ATTEMPTS = 5
+
 # Twilio configuration
 # Get TWILIO_SID and TWILIO_AUTH_TOKEN from environment variables
 TWILIO_SID = os.environ.get('TWILIO_SID')
@@ -223,3 +332,24 @@ ALLOWED_PHONE_REGIONS = [
     'DE',
     'CH'
 ]
+
+# Anti-spam rate limiting (see user.rate_limit)
+# The MemoryBackend keeps limits per process. For deployments running multiple processes, use
+# 'user.rate_limit.CacheBackend', which stores the limits in the Django cache named by RATE_LIMIT_CACHE.
+RATE_LIMIT_BACKEND = 'user.rate_limit.MemoryBackend'
+RATE_LIMIT_CACHE = 'default'
+
+# Brute-force protection of the login mutation (see user.auth_backends.login_throttle)
+# Failed attempts allowed per IP address, per subnet (/24 or /64) and per identifier before the backoff starts.
+LOGIN_THROTTLE_FREE_ATTEMPTS = {
+    'ip': 10,
+    'subnet': 50,
+    'identifier': 5
+}
+# Delay in seconds after the first failure beyond the free attempts, doubled with every further failure.
+LOGIN_THROTTLE_BASE_DELAY = 1
+LOGIN_THROTTLE_MAX_DELAY = 15 * 60
+# Seconds without failures after which the failed attempts are forgotten.
+LOGIN_THROTTLE_RESET_AFTER = 60 * 60
+# The request.META key containing the client's IP address (e.g. 'HTTP_X_REAL_IP' behind a reverse proxy).
+LOGIN_THROTTLE_IP_HEADER = 'REMOTE_ADDR'
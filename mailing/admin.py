@@ -1,5 +1,12 @@
+from django import forms
 from django.contrib import admin
-from .models import MailModel
+from django.contrib.admin.views.main import ORDER_VAR
+from django.db.models import Case, IntegerField, When
+
+from . import search
+from .campaigns import SEGMENTS
+from .models import Campaign, MailModel, OutboxMail
+from .outbox import requeue
 
 
 class MailAdmin(admin.ModelAdmin):
@@ -14,14 +21,19 @@ class MailAdmin(admin.ModelAdmin):
         'from_email',
     )
 
+    # Newest first, using the index on (date, id). Counting all mails would scan the whole table.
+    ordering = ('-date', '-id')
+    show_full_result_count = False
+
+    # On databases with full-text search, the search index is used instead of the search fields (see mailing.search).
     search_fields = (
         'to_email',
-        'date',
-        'from_email',
-        'message'
+        'from_email'
     )
 
-    readonly_fields = ('date', 'user', 'to_email', 'from_email', 'template', 'context', 'message')
+    readonly_fields = (
+        'date', 'user', 'to_email', 'from_email', 'template', 'context', 'subject', 'get_message', 'get_html_message'
+    )
 
     fieldsets = (
         (
@@ -33,11 +45,96 @@ class MailAdmin(admin.ModelAdmin):
                     'from_email',
                     'template',
                     'context',
-                    'message'
+                    'subject',
+                    'get_message',
+                    'get_html_message'
                 )
             }
         ),
     )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('dictionary')
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term or not search.is_supported():
+            return super().get_search_results(request, queryset, search_term)
+
+        ids = search.search(search_term)
+        queryset = queryset.filter(pk__in=ids)
+
+        # Order by relevance, unless a column was selected for ordering.
+        if ids and ORDER_VAR not in request.GET:
+            rank = Case(*[When(pk=pk, then=i) for i, pk in enumerate(ids)], output_field=IntegerField())
+            queryset = queryset.order_by(rank)
+
+        return queryset, False
+
+    def get_message(self, obj):
+        return obj.get_message()
+    get_message.short_description = 'Message'
+
+    def get_html_message(self, obj):
+        return obj.get_html_message()
+    get_html_message.short_description = 'HTML message'
+
 
 admin.site.register(MailModel, MailAdmin)
+
+
+class OutboxMailAdmin(admin.ModelAdmin):
+    list_display = (
+        'id',
+        'to_email',
+        'template',
+        'status',
+        'attempts',
+        'next_attempt_at'
+    )
+
+    list_filter = (
+        'status',
+    )
+
+    search_fields = (
+        'to_email',
+    )
+
+    readonly_fields = ('created_at', 'claim_token', 'claimed_until', 'last_error')
+
+    actions = ('requeue_mails',)
+
+    def requeue_mails(self, request, queryset):
+        count = requeue(queryset)
+        self.message_user(request, '{} dead mails were moved back to the outbox.'.format(count))
+    requeue_mails.short_description = 'Retry selected dead mails'
+
+
+admin.site.register(OutboxMail, OutboxMailAdmin)
+
+
+class CampaignAdmin(admin.ModelAdmin):
+    list_display = (
+        'id',
+        'name',
+        'template',
+        'segment',
+        'status',
+        'queued',
+        'created_at'
+    )
+
+    list_filter = (
+        'status',
+    )
+
+    readonly_fields = ('status', 'last_recipient_id', 'queued', 'created_at', 'finished_at')
+
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        if db_field.name == 'segment':
+            return forms.ChoiceField(choices=[(name, name) for name in sorted(SEGMENTS)])
+
+        return super().formfield_for_dbfield(db_field, request, **kwargs)
+
+
+admin.site.register(Campaign, CampaignAdmin)
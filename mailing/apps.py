@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class MailingConfig(AppConfig):
     name = 'mailing'
+
+    def ready(self):
+        from .rendering import warm_templates
+
+        warm_templates()
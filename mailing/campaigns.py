@@ -0,0 +1,116 @@
+# This file implements queueing mail campaigns (Campaign) into the outbox.
+# Recipients are read in batches ordered by id (keyset pagination), so that campaigns to millions of recipients need
+# constant memory, and every batch is queued in the same transaction which stores the campaign's progress.
+# The rate is limited globally by a token bucket, shared by all processes if RATE_LIMIT_BACKEND is shared.
+
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from user.models import EmailAddress
+from user.rate_limit import RateLimiter, TokenBucket
+
+from .models import Campaign, OutboxMail
+
+SEGMENTS = {}
+
+
+def segment(name):
+    'Register a function returning the email objects of the recipients of a segment.'
+
+    def register(func):
+        SEGMENTS[name] = func
+        return func
+
+    return register
+
+
+@segment('verified')
+def get_verified_recipients():
+    return EmailAddress.objects.get_primary_addresses().filter(verified=True, user__is_active=True)
+
+
+@segment('all')
+def get_all_recipients():
+    return EmailAddress.objects.get_primary_addresses().filter(user__is_active=True)
+
+
+def get_limiter():
+    return RateLimiter(
+        'mail-campaign',
+        TokenBucket(settings.MAIL_CAMPAIGN_BATCH_SIZE, 1 / settings.MAIL_CAMPAIGN_RATE)
+    )
+
+
+def get_recipients(campaign, batch_size):
+    return list(
+        SEGMENTS[campaign.segment]()
+        .filter(pk__gt=campaign.last_recipient_id, email_address__isnull=False)
+        .order_by('pk')
+        .values_list('pk', 'user_id', 'email_address')[:batch_size]
+    )
+
+
+def queue_batch(campaign_id, batch_size):
+    'Queue the next batch of recipients of a campaign. Returns the number of queued mails.'
+
+    with transaction.atomic():
+        # Lock the campaign, so that concurrent runners do not queue the same recipients.
+        campaign = Campaign.objects.select_for_update().get(pk=campaign_id)
+
+        if campaign.status == Campaign.DONE:
+            return 0
+
+        recipients = get_recipients(campaign, batch_size)
+
+        if not recipients:
+            campaign.status = Campaign.DONE
+            campaign.finished_at = timezone.now()
+            campaign.save(update_fields=['status', 'finished_at'])
+            return 0
+
+        OutboxMail.objects.bulk_create([
+            OutboxMail(
+                user_id=user_id,
+                to_email=email_address,
+                from_email=campaign.from_email,
+                template=campaign.template,
+                context=dict(campaign.context, email=email_address)
+            )
+            for pk, user_id, email_address in recipients
+        ])
+
+        campaign.status = Campaign.RUNNING
+        campaign.last_recipient_id = recipients[-1][0]
+        campaign.queued += len(recipients)
+        campaign.save(update_fields=['status', 'last_recipient_id', 'queued'])
+
+        return len(recipients)
+
+
+def run_campaign(campaign, batch_size=None, limiter=None, sleep=time.sleep):
+    'Queue all remaining recipients of a campaign at MAIL_CAMPAIGN_RATE mails per second.'
+
+    batch_size = min(batch_size or settings.MAIL_CAMPAIGN_BATCH_SIZE, settings.MAIL_CAMPAIGN_BATCH_SIZE)
+    limiter = limiter or get_limiter()
+    queued = 0
+
+    while True:
+        # Take the tokens of a full batch. If the last batch is smaller, the remaining tokens are lost.
+        allowed, retry_after = limiter.hit('global', cost=batch_size)
+
+        if not allowed:
+            sleep(retry_after)
+            continue
+
+        count = queue_batch(campaign.pk, batch_size)
+
+        if not count:
+            break
+
+        queued += count
+
+    campaign.refresh_from_db()
+    return queued
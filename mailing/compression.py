@@ -0,0 +1,59 @@
+# This file compresses the bodies of sent mails (MailModel) using zlib with a preset dictionary.
+# Most mails are rendered from a few templates, so the rendered templates without context are used as the dictionary:
+# A compressed body mostly consists of references to the dictionary and the variables of the message.
+# Dictionaries are stored in the database (MailDictionary), so that mails stay readable after the templates change.
+
+import functools
+import hashlib
+import os
+import zlib
+
+from .models import MailDictionary
+from .rendering import TEMPLATE_DIR, get_parts, render_message
+
+# zlib only refers to the last 32 KiB of the dictionary.
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def build_dictionary():
+    'Return the dictionary data built from the current templates, rendered with an empty context.'
+
+    parts = []
+
+    for template_name in sorted(os.listdir(TEMPLATE_DIR)):
+        if template_name.endswith('.tpl'):
+            message = render_message(template_name, {}, None, [])
+            parts.extend(part for part in get_parts(message)[1:] if part)
+
+    # Parts near the end of the dictionary are the cheapest to refer to.
+    return '\n'.join(parts).encode()[-MAX_DICTIONARY_SIZE:]
+
+
+def get_dictionary():
+    'Return the MailDictionary object of the current templates.'
+
+    data = build_dictionary()
+
+    dictionary, created = MailDictionary.objects.get_or_create(
+        digest=hashlib.sha256(data).hexdigest(),
+        defaults={'data': data}
+    )
+
+    return dictionary
+
+
+def compress(text, dictionary):
+    if text is None:
+        return None
+
+    compressor = zlib.compressobj(level=9, zdict=bytes(dictionary.data))
+    return compressor.compress(text.encode()) + compressor.flush()
+
+
+def decompress(data, dictionary):
+    if data is None:
+        return None
+
+    decompressor = zlib.decompressobj(zdict=bytes(dictionary.data))
+    return (decompressor.decompress(bytes(data)) + decompressor.flush()).decode()
@@ -0,0 +1,94 @@
+import gzip
+import json
+import os
+import time
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from mailing.models import MailModel
+from mailing.search import remove_mail
+
+
+# Each batch is written to the archive before it is deleted. If the command is interrupted in between, the batch is
+# archived again by the next run, so an archive may contain a mail twice (with the same id).
+class Command(BaseCommand):
+    help = 'Moves mails older than MAIL_RETENTION_DAYS to monthly gzipped JSON lines files, in bounded batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Defaults to MAIL_RETENTION_DAYS.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Mails archived per transaction.')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to pause between two batches.')
+        parser.add_argument('--purge', action='store_true', help='Delete the mails without archiving them.')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.MAIL_RETENTION_DAYS
+        cutoff = timezone.now() - timedelta(days=days)
+
+        expired = MailModel.objects.filter(date__lt=cutoff).select_related('dictionary').order_by('date', 'id')
+        count = 0
+
+        os.makedirs(settings.MAIL_ARCHIVE_ROOT, exist_ok=True)
+
+        while True:
+            batch = list(expired[:options['batch_size']])
+
+            if not batch:
+                break
+
+            messages = [mail.get_message() for mail in batch]
+
+            if not options['purge']:
+                self.archive(batch, messages)
+
+            with transaction.atomic():
+                for mail, message in zip(batch, messages):
+                    remove_mail(mail, message)
+
+                MailModel.objects.filter(pk__in=[mail.pk for mail in batch]).delete()
+
+            count += len(batch)
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write('{} {} mails older than {} days.'.format(
+            'Deleted' if options['purge'] else 'Archived', count, days
+        ))
+
+    def archive(self, batch, messages):
+        'Append the mails to the archive files of their months.'
+
+        lines = {}
+
+        for mail, message in zip(batch, messages):
+            line = json.dumps({
+                'id': mail.pk,
+                'date': mail.date,
+                'user': mail.user_id,
+                'to_email': mail.to_email,
+                'from_email': mail.from_email,
+                'template': mail.template,
+                'context': mail.context,
+                'subject': mail.subject,
+                'message': message,
+                'html_message': mail.get_html_message()
+            }, cls=DjangoJSONEncoder, ensure_ascii=False)
+
+            lines.setdefault(mail.date.strftime('%Y-%m'), []).append(line + '\n')
+
+        for month, month_lines in lines.items():
+            path = os.path.join(settings.MAIL_ARCHIVE_ROOT, 'mails-{}.jsonl.gz'.format(month))
+
+            # Appending adds a gzip member to the file, which is read like a single stream.
+            with open(path, 'ab') as archive_file:
+                with gzip.GzipFile(fileobj=archive_file, mode='wb') as gzip_file:
+                    gzip_file.write(''.join(month_lines).encode())
+
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
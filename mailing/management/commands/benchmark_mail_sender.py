@@ -0,0 +1,115 @@
+import socketserver
+import threading
+import time
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+
+from mailing.sender import MailSender
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """A minimal SMTP server accepting and discarding every message.
+    The server's handshake_delay simulates the cost of establishing a connection (TLS handshake and login)."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        time.sleep(self.server.handshake_delay)
+        self.reply('220 localhost SMTP sink')
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                return
+
+            command = line[:4].upper()
+
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 localhost')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+
+                with self.server.lock:
+                    self.server.received += 1
+
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake_delay):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.handshake_delay = handshake_delay
+        self.received = 0
+        self.lock = threading.Lock()
+
+
+class Command(BaseCommand):
+    help = 'Compares sending mails with one connection per message against the pooled MailSender.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--connections', type=int, default=4, help='Connections per mail server.')
+        parser.add_argument(
+            '--handshake-delay', type=float, default=0.05,
+            help='Seconds the sink takes to accept a connection, simulating the TLS handshake and login.'
+        )
+
+    def handle(self, *args, **options):
+        sink = SMTPSink(options['handshake_delay'])
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+        connection_kwargs = {
+            'backend': 'django.core.mail.backends.smtp.EmailBackend',
+            'host': '127.0.0.1',
+            'port': sink.server_address[1],
+            'username': '',
+            'password': '',
+            'use_tls': False
+        }
+
+        messages = [
+            EmailMessage('Benchmark {}'.format(i), 'Message body ' * 50, 'sender@example.com', ['rcpt@example.com'])
+            for i in range(options['messages'])
+        ]
+
+        try:
+            # One connection per message, as done by EmailMessage.send().
+            start = time.monotonic()
+            for message in messages:
+                get_connection(**connection_kwargs).send_messages([message])
+            self.report('One connection per message', len(messages), time.monotonic() - start)
+
+            sender = MailSender(workers=options['workers'], connections_per_host=options['connections'])
+            start = time.monotonic()
+            results = sender.send(messages, connection_kwargs=connection_kwargs)
+            self.report('Pooled MailSender', len(messages), time.monotonic() - start)
+            sender.close()
+
+            errors = [error for error in results if error is not None]
+            if errors:
+                self.stdout.write('{} messages failed, e.g.: {!r}'.format(len(errors), errors[0]))
+
+            self.stdout.write('The sink received {} messages.'.format(sink.received))
+        finally:
+            sink.shutdown()
+            sink.server_close()
+
+    def report(self, name, count, seconds):
+        self.stdout.write(
+            '{}: {} messages in {:.2f} s ({:.0f} messages/s)'.format(name, count, seconds, count / seconds)
+        )
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mailing.compression import compress, get_dictionary
+from mailing.models import MailModel
+
+
+class Command(BaseCommand):
+    help = 'Compresses the bodies of mails stored uncompressed, in bounded batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Mails compressed per transaction.')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to pause between two batches.')
+
+    def handle(self, *args, **options):
+        dictionary = get_dictionary()
+        uncompressed = MailModel.objects.filter(dictionary__isnull=True).order_by('pk')
+        last_pk = 0
+        count = size_before = size_after = 0
+
+        while True:
+            batch = list(uncompressed.filter(pk__gt=last_pk)[:options['batch_size']])
+
+            if not batch:
+                break
+
+            with transaction.atomic():
+                for mail in batch:
+                    message_data = compress(mail.message, dictionary)
+                    html_message_data = compress(mail.html_message, dictionary)
+
+                    size_before += len((mail.message or '').encode()) + len((mail.html_message or '').encode())
+                    size_after += len(message_data or b'') + len(html_message_data or b'')
+
+                    MailModel.objects.filter(pk=mail.pk).update(
+                        dictionary=dictionary,
+                        message=None,
+                        html_message=None,
+                        message_data=message_data,
+                        html_message_data=html_message_data
+                    )
+
+            count += len(batch)
+            last_pk = batch[-1].pk
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write('Compressed {} mails from {} to {} bytes.'.format(count, size_before, size_after))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mailing import search
+from mailing.models import MailModel
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of sent mails, in bounded batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Mails indexed per transaction.')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to pause between two batches.')
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            raise CommandError('Full-text search is not supported by this database.')
+
+        search.clear_index()
+
+        mails = MailModel.objects.select_related('dictionary').order_by('pk')
+        last_pk = 0
+        count = 0
+
+        while True:
+            batch = list(mails.filter(pk__gt=last_pk)[:options['batch_size']])
+
+            if not batch:
+                break
+
+            with transaction.atomic():
+                for mail in batch:
+                    search.index_mail(mail)
+
+            count += len(batch)
+            last_pk = batch[-1].pk
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write('Indexed {} mails.'.format(count))
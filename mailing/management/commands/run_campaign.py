@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailing.campaigns import SEGMENTS, run_campaign
+from mailing.models import Campaign
+
+
+class Command(BaseCommand):
+    help = 'Queues the mails of a campaign, continuing after the last queued recipient.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('campaign_id', type=int)
+        parser.add_argument('--batch-size', type=int, default=None, help='Defaults to MAIL_CAMPAIGN_BATCH_SIZE.')
+
+    def handle(self, *args, **options):
+        try:
+            campaign = Campaign.objects.get(pk=options['campaign_id'])
+        except Campaign.DoesNotExist:
+            raise CommandError('Campaign {} does not exist.'.format(options['campaign_id']))
+
+        if campaign.segment not in SEGMENTS:
+            raise CommandError('Unknown segment: {}'.format(campaign.segment))
+
+        queued = run_campaign(campaign, batch_size=options['batch_size'])
+
+        self.stdout.write('Queued {} mails of campaign "{}" ({} in total).'.format(queued, campaign, campaign.queued))
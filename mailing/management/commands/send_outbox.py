@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mailing.outbox import process_batch
+from mailing.sender import MailSender
+
+
+class Command(BaseCommand):
+    help = 'Sends the mails stored in the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Mails claimed at once.')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running and poll the outbox instead of stopping once it is drained.'
+        )
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between two polls when idle.')
+        parser.add_argument('--workers', type=int, help='Threads sending mails in parallel.')
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+
+        # The sender keeps its connections to the mail server open between batches.
+        sender = MailSender(workers=options['workers'])
+
+        try:
+            while True:
+                sent, failed = process_batch(options['batch_size'], sender=sender)
+                total_sent += sent
+                total_failed += failed
+
+                if sent or failed:
+                    continue
+
+                if not options['loop']:
+                    break
+
+                time.sleep(options['interval'])
+        finally:
+            sender.close()
+
+        self.stdout.write('Sent {} mails, {} failed.'.format(total_sent, total_failed))
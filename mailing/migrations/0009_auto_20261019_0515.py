@@ -0,0 +1,43 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:15
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mailing', '0008_auto_20210610_1151'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('to_email', models.CharField(max_length=320)),
+                ('from_email', models.CharField(blank=True, max_length=320, null=True)),
+                ('template', models.CharField(max_length=255)),
+                ('context', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Dead (sending failed too often)')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('claim_token', models.UUIDField(blank=True, db_index=True, null=True)),
+                ('claimed_until', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Outbox mail',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxmail',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='mailing_out_status_6fa04b_idx'),
+        ),
+    ]
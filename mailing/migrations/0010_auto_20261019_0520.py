@@ -0,0 +1,61 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:20
+
+import ast
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+def convert_context(apps, schema_editor):
+    # The context was stored as the string representation of a dict, which contains objects like '<User: ...>'
+    # that cannot be parsed. Those contexts are kept as text.
+    MailModel = apps.get_model('mailing', 'MailModel')
+
+    for mail in MailModel.objects.exclude(old_context__isnull=True).exclude(old_context='').iterator():
+        try:
+            context = ast.literal_eval(mail.old_context)
+        except (ValueError, SyntaxError):
+            context = None
+
+        if isinstance(context, dict):
+            context.pop('user', None)
+        else:
+            context = {'text': mail.old_context}
+
+        mail.context = context
+        mail.save(update_fields=['context'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0009_auto_20261019_0515'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='mailmodel',
+            old_name='context',
+            new_name='old_context',
+        ),
+        migrations.AddField(
+            model_name='mailmodel',
+            name='context',
+            field=models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+        migrations.RunPython(convert_context, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='mailmodel',
+            name='old_context',
+        ),
+        migrations.AddField(
+            model_name='mailmodel',
+            name='html_message',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailmodel',
+            name='subject',
+            field=models.CharField(blank=True, max_length=998, null=True),
+        ),
+    ]
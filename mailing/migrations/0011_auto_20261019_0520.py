@@ -0,0 +1,42 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0010_auto_20261019_0520'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailDictionary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('data', models.BinaryField()),
+            ],
+            options={
+                'verbose_name': 'Mail compression dictionary',
+                'verbose_name_plural': 'Mail compression dictionaries',
+            },
+        ),
+        migrations.AddField(
+            model_name='mailmodel',
+            name='html_message_data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailmodel',
+            name='message_data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mailmodel',
+            name='dictionary',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='mailing.maildictionary'),
+        ),
+    ]
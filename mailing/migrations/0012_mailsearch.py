@@ -0,0 +1,27 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:40
+
+from django.db import migrations
+
+
+def create_search_table(apps, schema_editor):
+    from mailing.search import CREATE_SQL
+
+    for sql in CREATE_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def drop_search_table(apps, schema_editor):
+    from mailing.search import DROP_SQL
+
+    schema_editor.execute(DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0011_auto_20261019_0520'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
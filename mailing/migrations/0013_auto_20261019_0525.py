@@ -0,0 +1,17 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0012_mailsearch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mailmodel',
+            index=models.Index(fields=['date', 'id'], name='mailing_mai_date_e4738e_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:26
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0013_auto_20261019_0525'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('template', models.CharField(max_length=255)),
+                ('segment', models.CharField(max_length=64)),
+                ('from_email', models.CharField(blank=True, max_length=320, null=True)),
+                ('context', models.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('status', models.IntegerField(choices=[(0, 'Draft'), (1, 'Running'), (2, 'Done')], default=0)),
+                ('last_recipient_id', models.IntegerField(default=0)),
+                ('queued', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -1,30 +1,153 @@
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
-from django.template.loader import get_template
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 
 from user.models import User
 
 
+class MailDictionary(models.Model):
+    'A preset dictionary used to compress the bodies of MailModel objects, see mailing.compression.'
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    digest = models.CharField(max_length=64, unique=True)
+    data = models.BinaryField()
+
+    def __str__(self):
+        return self.digest
+
+    class Meta:
+        verbose_name = 'Mail compression dictionary'
+        verbose_name_plural = 'Mail compression dictionaries'
+
+
 class MailModel(models.Model):
     date = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
     to_email = models.CharField(max_length=320, null=True, blank=True)
     from_email = models.CharField(max_length=320, null=True, blank=True)
     template = models.CharField(max_length=255, null=True, blank=True)
-    context = models.TextField(null=True, blank=True)
+    # The template context without the 'user' entry, which is stored in the user field.
+    context = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    # The parts of the message as they were sent. The text and the html part are compressed using the dictionary,
+    # message and html_message only contain uncompressed parts of mails stored before (see compress_mails).
+    subject = models.CharField(max_length=998, null=True, blank=True)
     message = models.TextField(null=True, blank=True)
+    html_message = models.TextField(null=True, blank=True)
+    dictionary = models.ForeignKey(MailDictionary, null=True, blank=True, on_delete=models.PROTECT)
+    message_data = models.BinaryField(null=True, blank=True)
+    html_message_data = models.BinaryField(null=True, blank=True)
 
     def __str__(self):
         return self.to_email
 
+    def get_message(self):
+        if self.dictionary_id is None:
+            return self.message
+
+        from .compression import decompress
+        return decompress(self.message_data, self.dictionary)
+
+    def get_html_message(self):
+        if self.dictionary_id is None:
+            return self.html_message
+
+        from .compression import decompress
+        return decompress(self.html_message_data, self.dictionary)
+
     def save(self, *args, **kwargs):
         if self.from_email is None:
             self.from_email = settings.DEFAULT_FROM_EMAIL
 
-        template = get_template(self.template)
-        self.message = template.render(self.context)
-
         super(MailModel, self).save(*args, **kwargs)
 
     class Meta:
         verbose_name = 'Mail message'
+        indexes = [
+            models.Index(fields=['date', 'id'])
+        ]
+
+
+@receiver(pre_delete, sender=MailModel)
+def remove_deleted_mail(sender, instance, **kwargs):
+    'Remove a mail deleted e.g. in the admin from the search index, unless it was removed already.'
+
+    from .search import remove_mail
+    remove_mail(instance)
+
+
+class OutboxMail(models.Model):
+    """
+    Mails waiting to be sent, stored by mailing.views.send_mail and sent by the send_outbox command.
+    After being sent, the outbox entry is replaced by a MailModel object.
+    """
+
+    PENDING = 0
+    DEAD = 1
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DEAD, 'Dead (sending failed too often)'),
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    to_email = models.CharField(max_length=320)
+    from_email = models.CharField(max_length=320, null=True, blank=True)
+    template = models.CharField(max_length=255)
+    # The template context without the 'user' entry, which is restored from the user field.
+    context = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+
+    # A worker claims outbox entries by setting a token and a lease, see mailing.outbox.claim_batch.
+    claim_token = models.UUIDField(null=True, blank=True, db_index=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.to_email
+
+    class Meta:
+        verbose_name = 'Outbox mail'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'])
+        ]
+
+
+class Campaign(models.Model):
+    """
+    A mail sent to all recipients of a segment (see mailing.campaigns), queued by the run_campaign command.
+    Recipients are queued in the order of their email object ids. The id of the last queued recipient is stored
+    with every batch, so that an interrupted campaign continues after it.
+    """
+
+    DRAFT = 0
+    RUNNING = 1
+    DONE = 2
+
+    STATUS_CHOICES = (
+        (DRAFT, 'Draft'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+    )
+
+    name = models.CharField(max_length=255)
+    template = models.CharField(max_length=255)
+    segment = models.CharField(max_length=64)
+    from_email = models.CharField(max_length=320, null=True, blank=True)
+    # The template context shared by all recipients. The user and the email address are added per recipient.
+    context = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+
+    status = models.IntegerField(choices=STATUS_CHOICES, default=DRAFT)
+    last_recipient_id = models.IntegerField(default=0)
+    queued = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
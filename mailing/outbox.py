@@ -0,0 +1,175 @@
+# This file implements the delivery of mails stored in the outbox (OutboxMail).
+# Mails are sent at least once: an outbox entry is only removed after its mail was sent. If a worker stops before
+# removing the entry, its claim expires and the mail is sent again by another worker.
+
+import uuid
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .compression import compress, get_dictionary
+from .models import MailModel, OutboxMail
+from .rendering import get_parts, render_message
+from .search import index_mail
+from .sender import MailSender
+
+
+def enqueue(template, to_email, from_email=None, context=None, user=None):
+    'Store a mail in the outbox. Called within a transaction, the mail is only sent if the transaction commits.'
+
+    return OutboxMail.objects.create(
+        user=user,
+        to_email=to_email,
+        from_email=from_email,
+        template=template,
+        context=context or {}
+    )
+
+
+def claim_batch(batch_size):
+    """Claim up to batch_size mails which are due, so that no other worker sends them while the claim lasts.
+    Claims are taken with a single conditional UPDATE, which works on every database backend."""
+
+    now = timezone.now()
+    token = uuid.uuid4()
+
+    claimable = OutboxMail.objects.filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now),
+        status=OutboxMail.PENDING,
+        next_attempt_at__lte=now
+    )
+
+    ids = list(claimable.order_by('next_attempt_at', 'id').values_list('id', flat=True)[:batch_size])
+
+    # Another worker may have claimed some of the entries in the meantime, therefore the filter is repeated.
+    claimable.filter(id__in=ids).update(
+        claim_token=token,
+        claimed_until=now + timedelta(seconds=settings.MAIL_OUTBOX_CLAIM_DURATION)
+    )
+
+    return list(OutboxMail.objects.filter(claim_token=token).select_related('user').order_by('next_attempt_at', 'id'))
+
+
+def get_retry_delay(attempts):
+    'Exponential backoff, starting at MAIL_OUTBOX_RETRY_DELAY seconds.'
+
+    delay = settings.MAIL_OUTBOX_RETRY_DELAY * 2 ** min(attempts - 1, 32)
+    return timedelta(seconds=min(delay, settings.MAIL_OUTBOX_MAX_RETRY_DELAY))
+
+
+def get_context(outbox_mail):
+    context = dict(outbox_mail.context)
+
+    if outbox_mail.user:
+        context['user'] = outbox_mail.user
+
+    return context
+
+
+def build_message(outbox_mail):
+    'Render the mail of an outbox entry.'
+
+    return render_message(
+        outbox_mail.template,
+        get_context(outbox_mail),
+        outbox_mail.from_email,
+        [outbox_mail.to_email]
+    )
+
+
+def complete(outbox_mail, message, dictionary=None):
+    'Replace a sent outbox mail by a MailModel object, storing the parts of the message as they were sent.'
+
+    subject, body, html = get_parts(message)
+    dictionary = dictionary or get_dictionary()
+
+    with transaction.atomic():
+        mail = MailModel.objects.create(
+            user=outbox_mail.user,
+            to_email=outbox_mail.to_email,
+            from_email=outbox_mail.from_email,
+            template=outbox_mail.template,
+            context=outbox_mail.context,
+            subject=subject,
+            dictionary=dictionary,
+            message_data=compress(body, dictionary),
+            html_message_data=compress(html, dictionary)
+        )
+
+        index_mail(mail, body)
+
+        outbox_mail.delete()
+
+
+def fail(outbox_mail, error):
+    'Schedule the next attempt of a mail, or move it to the dead letters after MAIL_OUTBOX_MAX_ATTEMPTS.'
+
+    outbox_mail.attempts += 1
+    outbox_mail.last_error = repr(error)
+    outbox_mail.claim_token = None
+    outbox_mail.claimed_until = None
+
+    if outbox_mail.attempts >= settings.MAIL_OUTBOX_MAX_ATTEMPTS:
+        outbox_mail.status = OutboxMail.DEAD
+    else:
+        outbox_mail.next_attempt_at = timezone.now() + get_retry_delay(outbox_mail.attempts)
+
+    outbox_mail.save()
+
+
+def process_batch(batch_size=100, sender=None):
+    """Claim and send a batch of due mails. Returns a tuple (sent, failed).
+    Workers sending continuously should pass a MailSender, so that its connections are reused."""
+
+    sent = failed = 0
+    outbox_mails = []
+    messages = []
+
+    for outbox_mail in claim_batch(batch_size):
+        try:
+            messages.append(build_message(outbox_mail))
+            outbox_mails.append(outbox_mail)
+        except Exception as e:
+            fail(outbox_mail, e)
+            failed += 1
+
+    if not messages:
+        return sent, failed
+
+    own_sender = sender is None
+    sender = sender or MailSender()
+
+    try:
+        # Only the messages are sent in parallel, the database is updated from this thread.
+        results = sender.send(messages)
+    finally:
+        if own_sender:
+            sender.close()
+
+    dictionary = get_dictionary()
+
+    for outbox_mail, message, error in zip(outbox_mails, messages, results):
+        if error is None:
+            complete(outbox_mail, message, dictionary)
+            sent += 1
+        else:
+            fail(outbox_mail, error)
+            failed += 1
+
+    return sent, failed
+
+
+def requeue(queryset):
+    'Move dead outbox mails back to the pending ones, e.g. after fixing the mail configuration.'
+
+    return queryset.filter(status=OutboxMail.DEAD).update(
+        status=OutboxMail.PENDING,
+        attempts=0,
+        next_attempt_at=timezone.now(),
+        claim_token=None,
+        claimed_until=None
+    )
@@ -0,0 +1,45 @@
+# This file renders mail templates into their subject, text and html parts.
+# Compiled templates are cached for the lifetime of the process and loaded once at startup (see MailingConfig).
+
+import functools
+import os
+
+from django.template.loader import get_template
+
+from mail_templated import EmailMessage
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+@functools.lru_cache(maxsize=None)
+def get_mail_template(template_name):
+    return get_template(template_name)
+
+
+def warm_templates():
+    'Compile all mail templates of this module, so that the first mails do not have to wait for it.'
+
+    for template_name in sorted(os.listdir(TEMPLATE_DIR)):
+        if template_name.endswith('.tpl'):
+            get_mail_template(template_name)
+
+
+def render_message(template_name, context, from_email, to):
+    'Return a rendered EmailMessage of the template.'
+
+    message = EmailMessage(template_name, context, from_email, to)
+    message.template = get_mail_template(template_name)
+    message.render()
+
+    return message
+
+
+def get_parts(message):
+    'Return the subject, the text and the html part of a rendered message.'
+
+    html = None
+    for content, mimetype in message.alternatives:
+        if mimetype == 'text/html':
+            html = content
+
+    return message.subject, message.body, html
@@ -0,0 +1,135 @@
+# This file implements the full-text search of sent mails (MailModel), used by the admin.
+# The mail bodies are stored compressed, therefore the searchable text is indexed in a separate table when a mail is
+# stored: An FTS5 table on SQLite, or a tsvector column with a GIN index on PostgreSQL (see migration 0012).
+# The SQLite table is contentless, so it does not store the text a second time.
+
+from django.conf import settings
+from django.db import connection
+
+TABLE = 'mailing_mailsearch'
+
+CREATE_SQL = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE mailing_mailsearch USING fts5(to_email, from_email, subject, message, content='')"
+    ],
+    'postgresql': [
+        'CREATE TABLE mailing_mailsearch ('
+        'mail_id integer PRIMARY KEY '
+        'REFERENCES mailing_mailmodel (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+        'document tsvector NOT NULL)',
+        'CREATE INDEX mailing_mailsearch_document_idx ON mailing_mailsearch USING gin (document)'
+    ]
+}
+
+DROP_SQL = 'DROP TABLE IF EXISTS mailing_mailsearch'
+
+
+def is_supported():
+    return connection.vendor in CREATE_SQL
+
+
+def get_values(mail, message=None):
+    if message is None:
+        message = mail.get_message()
+
+    return [mail.to_email or '', mail.from_email or '', mail.subject or '', message or '']
+
+
+def index_mail(mail, message=None):
+    'Add a mail to the search index. Pass the uncompressed message if it is known already.'
+
+    if not is_supported():
+        return
+
+    values = get_values(mail, message)
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                'INSERT INTO mailing_mailsearch (rowid, to_email, from_email, subject, message) '
+                'VALUES (%s, %s, %s, %s, %s)',
+                [mail.pk] + values
+            )
+        else:
+            cursor.execute(
+                'INSERT INTO mailing_mailsearch (mail_id, document) VALUES (%s, to_tsvector(%s, %s)) '
+                'ON CONFLICT (mail_id) DO UPDATE SET document = EXCLUDED.document',
+                [mail.pk, settings.MAIL_SEARCH_CONFIG, ' '.join(values)]
+            )
+
+
+def remove_mail(mail, message=None):
+    """Remove a mail from the search index, if it was indexed. Deleted mails are removed by a receiver in
+    mailing.models; call this before deleting mails whose uncompressed messages are known already."""
+
+    if connection.vendor != 'sqlite':
+        # PostgreSQL removes the entry with the mail.
+        return
+
+    with connection.cursor() as cursor:
+        # Removing an entry which does not exist corrupts the index, e.g. for mails stored before it was built.
+        cursor.execute('SELECT 1 FROM mailing_mailsearch WHERE rowid = %s', [mail.pk])
+
+        if cursor.fetchone() is None:
+            return
+
+        # A contentless FTS5 table removes an entry by the values it was indexed with.
+        cursor.execute(
+            "INSERT INTO mailing_mailsearch (mailing_mailsearch, rowid, to_email, from_email, subject, message) "
+            "VALUES ('delete', %s, %s, %s, %s, %s)",
+            [mail.pk] + get_values(mail, message)
+        )
+
+
+def clear_index():
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute("INSERT INTO mailing_mailsearch (mailing_mailsearch) VALUES ('delete-all')")
+        else:
+            cursor.execute('TRUNCATE mailing_mailsearch')
+
+
+def get_fts5_query(search_term):
+    'Quote every word of the search term, so that FTS5 does not interpret operators. Words may be prefixes.'
+
+    words = search_term.split()
+    return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+
+
+def get_tsquery(search_term):
+    """Quote every word of the search term as a lexeme of to_tsquery, so that PostgreSQL does not interpret operators.
+    Words may be prefixes, like with get_fts5_query (plainto_tsquery only matches whole words)."""
+
+    words = search_term.split()
+    return ' & '.join("'{}':*".format(word.replace('\\', '\\\\').replace("'", "''")) for word in words)
+
+
+def search(search_term, limit=None):
+    'Return the ids of the newest mails matching all words of the search term, best matches first.'
+
+    limit = limit or settings.MAIL_SEARCH_MAX_RESULTS
+    candidates = max(limit, settings.MAIL_SEARCH_CANDIDATES)
+
+    if not search_term.split():
+        return []
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                'SELECT rowid FROM ('
+                'SELECT rowid, bm25(mailing_mailsearch) AS score FROM mailing_mailsearch '
+                'WHERE mailing_mailsearch MATCH %s ORDER BY rowid DESC LIMIT %s'
+                ') ORDER BY score LIMIT %s',
+                [get_fts5_query(search_term), candidates, limit]
+            )
+        else:
+            cursor.execute(
+                'SELECT mail_id FROM ('
+                'SELECT mail_id, ts_rank(document, query) AS score '
+                'FROM mailing_mailsearch, to_tsquery(%s, %s) query '
+                'WHERE document @@ query ORDER BY mail_id DESC LIMIT %s'
+                ') candidates ORDER BY score DESC LIMIT %s',
+                [settings.MAIL_SEARCH_CONFIG, get_tsquery(search_term), candidates, limit]
+            )
+
+        return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,148 @@
+# This file implements sending many mails at once over a pool of open connections to the mail server.
+# Opening an SMTP connection includes the TLS handshake and the login, which takes longer than sending a message.
+# Therefore, connections are kept open and used for many messages, by multiple worker threads in parallel.
+
+import queue
+import smtplib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+
+# Errors of the mail server rejecting a single message. The connection can still be used afterwards.
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class ConnectionPool:
+    """Keeps open connections (email backends) to one mail server, of which at most max_connections
+    are used at the same time."""
+
+    def __init__(self, max_connections, **backend_kwargs):
+        self.backend_kwargs = backend_kwargs
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def acquire(self):
+        'Wait for a free slot and return an idle connection, or None if a new one has to be opened.'
+
+        self._slots.acquire()
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return None
+
+    def connect(self):
+        connection = get_connection(fail_silently=False, **self.backend_kwargs)
+        connection.open()
+        return connection
+
+    def release(self, connection):
+        if connection is not None:
+            self._idle.put(connection)
+
+        self._slots.release()
+
+    def discard(self, connection):
+        if connection is None:
+            return
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class MailSender:
+    """
+    Sends lists of messages using parallel workers, which share one connection pool per mail server.
+    A connection which fails is replaced by a new one and the failed message is retried once.
+
+    The sender should be kept for the lifetime of a worker process, so that connections are reused across
+    batches. Call close() afterwards.
+    """
+
+    def __init__(self, workers=None, connections_per_host=None, messages_per_task=None):
+        self.workers = workers or settings.MAIL_SENDER_WORKERS
+        self.connections_per_host = connections_per_host or settings.MAIL_SENDER_CONNECTIONS_PER_HOST
+        self.messages_per_task = messages_per_task or settings.MAIL_SENDER_MESSAGES_PER_TASK
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mail-sender')
+
+    def get_pool(self, connection_kwargs=None):
+        'Return the pool of the mail server given by the email backend arguments (e.g. host and port).'
+
+        connection_kwargs = connection_kwargs or {}
+        key = tuple(sorted(connection_kwargs.items()))
+
+        with self._pools_lock:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(self.connections_per_host, **connection_kwargs)
+
+            return self._pools[key]
+
+    def _send_task(self, pool, messages):
+        results = []
+        connection = pool.acquire()
+
+        try:
+            for message in messages:
+                error = None
+
+                for attempt in range(2):
+                    try:
+                        if connection is None:
+                            connection = pool.connect()
+
+                        connection.send_messages([message])
+                        error = None
+                        break
+                    except MESSAGE_ERRORS as e:
+                        error = e
+                        break
+                    except Exception as e:
+                        # The connection failed (e.g. the server closed an idle connection), reconnect and retry.
+                        error = e
+                        pool.discard(connection)
+                        connection = None
+
+                results.append(error)
+        finally:
+            pool.release(connection)
+
+        return results
+
+    def send(self, messages, connection_kwargs=None):
+        'Send the messages and return a list containing the exception or None for each message.'
+
+        pool = self.get_pool(connection_kwargs)
+        size = self.messages_per_task
+
+        tasks = [
+            self._executor.submit(self._send_task, pool, messages[i:i + size])
+            for i in range(0, len(messages), size)
+        ]
+
+        results = []
+        for task in tasks:
+            results.extend(task.result())
+
+        return results
+
+    def close(self):
+        self._executor.shutdown()
+
+        with self._pools_lock:
+            for pool in self._pools.values():
+                pool.close()
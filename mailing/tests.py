@@ -1,7 +1,35 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from datetime import timedelta
+
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import call_command
+from django.db import connection
 from django.http import JsonResponse
 from django.test import TestCase
+from django.utils import timezone
 from django.views import View
 
+from io import StringIO
+from smtplib import SMTPServerDisconnected
+from unittest import mock
+
+from user.models import EmailAddress, User
+from user.rate_limit import MemoryBackend, RateLimiter, TokenBucket
+
+from .campaigns import queue_batch, run_campaign
+from .compression import compress, decompress, get_dictionary
+from .models import Campaign, MailDictionary, MailModel, OutboxMail
+from .outbox import process_batch
+from .rendering import get_mail_template
+from .search import get_fts5_query, get_tsquery, remove_mail, search
+from .sender import MailSender
 from .views import send_mail
 
 
@@ -10,6 +38,306 @@ class MailModelTest(TestCase):
         send_mail('multipart-default.tpl', 'simon@pra.st')
 
 
+class OutboxTest(TestCase):
+    def test_send_mail_is_queued(self):
+        user = User.objects.create_user(email='outbox@simonprast.com', password='test-password')
+        send_mail('multipart-default.tpl', 'outbox@simonprast.com', context={'user': user})
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMail.objects.get().user, user)
+
+        call_command('send_outbox', stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Hello {}'.format(user.username))
+        self.assertFalse(OutboxMail.objects.exists())
+
+        mail_object = MailModel.objects.get()
+        self.assertEqual(mail_object.user, user)
+        self.assertEqual(mail_object.subject, mail.outbox[0].subject)
+        self.assertEqual(mail_object.get_message(), mail.outbox[0].body)
+        self.assertEqual(mail_object.get_html_message(), mail.outbox[0].alternatives[0][0])
+
+    def test_templates_are_compiled_once(self):
+        send_mail('multipart-default.tpl', 'simon@pra.st')
+        send_mail('multipart-default.tpl', 'simon@pra.st')
+
+        # The template was loaded at startup.
+        with mock.patch('mailing.rendering.get_template') as get_template:
+            self.assertEqual(process_batch(), (2, 0))
+
+        get_template.assert_not_called()
+        self.assertGreater(get_mail_template.cache_info().hits, 0)
+
+    def test_failed_mail_is_retried_and_dead_lettered(self):
+        send_mail('multipart-default.tpl', 'simon@pra.st')
+
+        with self.settings(MAIL_OUTBOX_MAX_ATTEMPTS=2), \
+                mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=ConnectionError):
+            self.assertEqual(process_batch(), (0, 1))
+
+            outbox_mail = OutboxMail.objects.get()
+            self.assertEqual(outbox_mail.attempts, 1)
+            self.assertGreater(outbox_mail.next_attempt_at, timezone.now())
+
+            # The mail is not due yet.
+            self.assertEqual(process_batch(), (0, 0))
+
+            OutboxMail.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+            self.assertEqual(process_batch(), (0, 1))
+
+        self.assertEqual(OutboxMail.objects.get().status, OutboxMail.DEAD)
+        self.assertEqual(process_batch(), (0, 0))
+        self.assertFalse(MailModel.objects.exists())
+
+    def test_claimed_mail_is_skipped(self):
+        send_mail('multipart-default.tpl', 'simon@pra.st')
+        OutboxMail.objects.update(claimed_until=timezone.now() + timedelta(minutes=1))
+
+        self.assertEqual(process_batch(), (0, 0))
+
+        # Claims of stopped workers expire.
+        OutboxMail.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(process_batch(), (1, 0))
+
+
+class CompressionTest(TestCase):
+    def test_round_trip(self):
+        dictionary = get_dictionary()
+        text = 'Hallo Simon!\n\nvielen Dank für deine Registrierung bei Kanbon.'
+
+        self.assertEqual(decompress(compress(text, dictionary), dictionary), text)
+        self.assertIsNone(compress(None, dictionary))
+        self.assertEqual(get_dictionary(), dictionary)
+
+    def test_sent_mail_is_compressed(self):
+        user = User.objects.create_user(email='compress@simonprast.com', password='test-password')
+        send_mail('registration-german.tpl', 'compress@simonprast.com', context={'user': user, 'token_1': '123'})
+        process_batch()
+
+        mail_object = MailModel.objects.get()
+        self.assertIsNone(mail_object.html_message)
+        self.assertLess(len(mail_object.html_message_data), len(mail_object.get_html_message()) / 10)
+        self.assertIn('123', mail_object.get_message())
+
+    def test_compress_stored_mails(self):
+        MailModel.objects.create(to_email='simon@pra.st', message='Plain message', html_message='<p>Plain</p>')
+        call_command('compress_mails', stdout=StringIO())
+
+        mail_object = MailModel.objects.get()
+        self.assertIsNone(mail_object.message)
+        self.assertEqual(mail_object.get_message(), 'Plain message')
+        self.assertEqual(mail_object.get_html_message(), '<p>Plain</p>')
+
+    def test_old_dictionaries_stay_readable(self):
+        old_dictionary = MailDictionary.objects.create(digest='old', data=b'Old template skeleton')
+        MailModel.objects.create(
+            to_email='simon@pra.st', dictionary=old_dictionary, message_data=compress('Old template', old_dictionary)
+        )
+
+        self.assertNotEqual(get_dictionary(), old_dictionary)
+        self.assertEqual(MailModel.objects.get().get_message(), 'Old template')
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        for name, token in (('Anna', '111'), ('Simon', '222'), ('Simone', '333')):
+            email = '{}@simonprast.com'.format(name.lower())
+            user = User.objects.create_user(email=email, password='test-password', first_name=name)
+            send_mail('registration-german.tpl', email, context={'user': user, 'token_1': token})
+
+        process_batch()
+
+    def get_id(self, to_email):
+        return MailModel.objects.get(to_email=to_email).pk
+
+    def test_search(self):
+        self.assertEqual(search('anna@simonprast.com'), [self.get_id('anna@simonprast.com')])
+        self.assertEqual(search('Registrierung 222'), [self.get_id('simon@simonprast.com')])
+        # Words are matched as prefixes.
+        self.assertEqual(set(search('simo')), set(MailModel.objects.values_list('pk', flat=True)))
+        self.assertEqual(search('simon" OR "anna'), [])
+
+    def test_query_builders(self):
+        # SQLite and PostgreSQL both match every word as a prefix and do not interpret operators.
+        self.assertEqual(get_fts5_query('simo "Kan OR'), '"simo"* """Kan"* "OR"*')
+        self.assertEqual(get_tsquery("simo O'Kan | a\\"), "'simo':* & 'O''Kan':* & '|':* & 'a\\\\':*")
+
+    def test_remove_and_rebuild(self):
+        mail_object = MailModel.objects.get(to_email='anna@simonprast.com')
+        remove_mail(mail_object)
+        self.assertEqual(search('111'), [])
+
+        call_command('index_mails', batch_size=2, stdout=StringIO())
+        self.assertEqual(search('111'), [mail_object.pk])
+        self.assertEqual(len(search('Kanbon')), 3)
+
+    def test_admin_search(self):
+        admin_user = User.objects.create_superuser('admin', email='admin@simonprast.com', password='test-password')
+        self.client.force_login(admin_user, backend='user.auth_backends.authentication.AuthenticationBackend')
+
+        response = self.client.get('/admin/mailing/mailmodel/', {'q': '333'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([mail.to_email for mail in response.context['cl'].result_list], ['simone@simonprast.com'])
+
+    def test_admin_delete(self):
+        admin_user = User.objects.create_superuser('admin', email='admin@simonprast.com', password='test-password')
+        self.client.force_login(admin_user, backend='user.auth_backends.authentication.AuthenticationBackend')
+
+        self.client.post('/admin/mailing/mailmodel/', {
+            'action': 'delete_selected',
+            '_selected_action': [self.get_id('anna@simonprast.com')],
+            'post': 'yes'
+        })
+
+        self.assertFalse(MailModel.objects.filter(to_email='anna@simonprast.com').exists())
+        self.assertEqual(search('111'), [])
+        self.assertEqual(len(search('Kanbon')), 2)
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        for i in range(3):
+            send_mail('registration-german.tpl', 'archive-{}@simonprast.com'.format(i), context={'token_1': str(i)})
+
+        process_batch()
+
+        self.old_ids = list(MailModel.objects.order_by('id').values_list('id', flat=True)[:2])
+        MailModel.objects.filter(pk=self.old_ids[0]).update(date=timezone.now() - timedelta(days=400))
+        MailModel.objects.filter(pk=self.old_ids[1]).update(date=timezone.now() - timedelta(days=500))
+
+        self.archive_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archive_root.cleanup)
+
+    def read_archives(self):
+        lines = []
+
+        for name in sorted(os.listdir(self.archive_root.name)):
+            with gzip.open(os.path.join(self.archive_root.name, name), 'rt') as archive_file:
+                lines.extend(json.loads(line) for line in archive_file)
+
+        return lines
+
+    def test_archive_old_mails(self):
+        with self.settings(MAIL_RETENTION_DAYS=365, MAIL_ARCHIVE_ROOT=self.archive_root.name):
+            call_command('archive_mails', batch_size=1, stdout=StringIO())
+
+        archived = self.read_archives()
+        self.assertEqual(sorted(mail['id'] for mail in archived), self.old_ids)
+        self.assertIn('/0', archived[0]['message'] + archived[1]['message'])
+        self.assertEqual(len(os.listdir(self.archive_root.name)), 2)
+
+        self.assertEqual(MailModel.objects.count(), 1)
+        self.assertEqual(len(search('Kanbon')), 1)
+
+    def test_archive_unindexed_mails(self):
+        # The mail was stored before the search index was built.
+        remove_mail(MailModel.objects.get(pk=self.old_ids[0]))
+
+        with self.settings(MAIL_RETENTION_DAYS=365, MAIL_ARCHIVE_ROOT=self.archive_root.name):
+            call_command('archive_mails', stdout=StringIO())
+
+        self.assertEqual(MailModel.objects.count(), 1)
+
+        # The statistics of the index, from which the ranks are calculated, are correct.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT bm25(mailing_mailsearch) FROM mailing_mailsearch WHERE mailing_mailsearch MATCH 'Kanbon'"
+            )
+            self.assertIsNotNone(cursor.fetchone()[0])
+
+    def test_purge_old_mails(self):
+        with self.settings(MAIL_ARCHIVE_ROOT=self.archive_root.name):
+            call_command('archive_mails', days=450, purge=True, stdout=StringIO())
+
+        self.assertEqual(self.read_archives(), [])
+        self.assertEqual(MailModel.objects.count(), 2)
+        self.assertFalse(MailModel.objects.filter(pk=self.old_ids[1]).exists())
+
+
+class CampaignTest(TestCase):
+    def setUp(self):
+        for i in range(5):
+            User.objects.create_user(email='campaign-{}@simonprast.com'.format(i), password='test-password')
+
+        EmailAddress.objects.exclude(email_address='campaign-3@simonprast.com').update(verified=True)
+
+        self.campaign = Campaign.objects.create(
+            name='Newsletter', template='multipart-default.tpl', segment='verified', context={'issue': 1}
+        )
+
+    def test_run_campaign(self):
+        call_command('run_campaign', self.campaign.pk, batch_size=2, stdout=StringIO())
+
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.status, Campaign.DONE)
+        self.assertEqual(self.campaign.queued, 4)
+        self.assertEqual(
+            sorted(OutboxMail.objects.values_list('to_email', flat=True)),
+            ['campaign-{}@simonprast.com'.format(i) for i in (0, 1, 2, 4)]
+        )
+
+        outbox_mail = OutboxMail.objects.get(to_email='campaign-0@simonprast.com')
+        self.assertEqual(outbox_mail.context, {'issue': 1, 'email': 'campaign-0@simonprast.com'})
+        self.assertEqual(outbox_mail.user.primary_email.email_address, 'campaign-0@simonprast.com')
+
+        # Running a finished campaign again does not queue any mails.
+        call_command('run_campaign', self.campaign.pk, stdout=StringIO())
+        self.assertEqual(OutboxMail.objects.count(), 4)
+
+    def test_interrupted_campaign_resumes(self):
+        self.assertEqual(queue_batch(self.campaign.pk, 3), 3)
+
+        with mock.patch.object(OutboxMail.objects, 'bulk_create', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                queue_batch(self.campaign.pk, 3)
+
+        self.assertEqual(OutboxMail.objects.count(), 3)
+        self.assertEqual(queue_batch(self.campaign.pk, 3), 1)
+        self.assertEqual(OutboxMail.objects.values('to_email').distinct().count(), 4)
+
+    def test_rate_limit(self):
+        limiter = RateLimiter('test-campaign', TokenBucket(2, 0.01), backend=MemoryBackend())
+        sleep = mock.Mock(wraps=time.sleep)
+
+        with self.settings(MAIL_CAMPAIGN_BATCH_SIZE=2):
+            self.assertEqual(run_campaign(self.campaign, limiter=limiter, sleep=sleep), 4)
+
+        # The first batch is allowed by the full bucket, the following ones wait for new tokens.
+        self.assertTrue(sleep.called)
+        self.assertTrue(all(0 < call.args[0] <= 0.02 for call in sleep.call_args_list))
+
+
+class FlakyEmailBackend(LocmemEmailBackend):
+    # Every connection fails after sending two messages, like a server closing connections.
+    opened = 0
+
+    def open(self):
+        FlakyEmailBackend.opened += 1
+        self.sent = 0
+
+    def send_messages(self, messages):
+        if self.sent == 2:
+            raise SMTPServerDisconnected()
+
+        self.sent += 1
+        return super().send_messages(messages)
+
+
+class MailSenderTest(TestCase):
+    def test_connections_are_reused_and_replaced(self):
+        FlakyEmailBackend.opened = 0
+        messages = [EmailMessage('Subject {}'.format(i), 'Body', to=['simon@pra.st']) for i in range(6)]
+
+        sender = MailSender(workers=1, connections_per_host=1, messages_per_task=6)
+        results = sender.send(messages, connection_kwargs={'backend': 'mailing.tests.FlakyEmailBackend'})
+        sender.close()
+
+        self.assertEqual(results, [None] * 6)
+        self.assertEqual([message.subject for message in mail.outbox], ['Subject {}'.format(i) for i in range(6)])
+        self.assertEqual(FlakyEmailBackend.opened, 3)
+
+
 class MailTestView(View):
     def get(self, request):
         mail_data = send_mail('multipart-default.tpl', 'simon@pra.st')
@@ -1,38 +1,22 @@
-from mail_templated import EmailMessage
-
 from user.models import EmailAddress
 
-from .models import MailModel
+from .outbox import enqueue
+
 
+# sendMail stores an email in the outbox, from where it is sent by the send_outbox command.
+def send_mail(template, to_email, from_email=None, context=None):
+    context = dict(context or {})
 
-# sendMail sends an email and saves it into the database.
-def send_mail(template, to_email, from_email=None, context={}):
     if EmailAddress.objects.filter(email_address=to_email, verified=True).exists() and 'user' not in context:
         email_object = EmailAddress.objects.get(email_address=to_email, verified=True)
         user = email_object.user
-
-        context.update({'user': user})
-    elif 'user' in context:
-        user = context['user']
     else:
-        user = None
-
-    message = EmailMessage(
-        template,
-        context,
-        from_email,
-        [to_email]
-    )
+        user = context.get('user', None)
 
-    message.send()
+    # The user is referenced by the outbox entry and added to the context again when sending.
+    context.pop('user', None)
 
-    MailModel.objects.create(
-        user=user,
-        to_email=to_email,
-        from_email=from_email,
-        template=template,
-        context=context
-    )
+    enqueue(template, to_email, from_email=from_email, context=context, user=user)
 
     return {
         'user': {
@@ -3,7 +3,7 @@ from django.contrib import admin
 from django.contrib.auth.models import Group
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
-from .models import EmailAddress, EmailToken, EmailTokenSpamBlock, PhoneNumber, SystemMessage, User
+from .models import EmailAddress, PhoneNumber, SystemMessage, User, UserGroup
 
 
 class UserCreationForm(forms.ModelForm):
@@ -77,15 +77,6 @@ class UserAdmin(BaseUserAdmin):
                 )
             }
         ),
-        (
-            'Contact data anti-spam', {
-                'fields': (
-                    'last_phone_request',
-                    'last_phone_code_request',
-                    'last_email_request'
-                )
-            }
-        ),
         (
             'Permissions', {
                 'fields': (
@@ -155,28 +146,6 @@ class EmailAddressAdmin(admin.ModelAdmin):
 admin.site.register(EmailAddress, EmailAddressAdmin)
 
 
-class EmailTokenAdmin(admin.ModelAdmin):
-    list_display = (
-        'token',
-        'email_address',
-        'user',
-        'created_at'
-    )
-
-
-admin.site.register(EmailToken, EmailTokenAdmin)
-
-
-class EmailTokenSpamBlockAdmin(admin.ModelAdmin):
-    list_display = (
-        'email_address',
-        'last_email_code_request'
-    )
-
-
-admin.site.register(EmailTokenSpamBlock, EmailTokenSpamBlockAdmin)
-
-
 # Add PhoneNumberAdmin
 class PhoneNumberAdmin(admin.ModelAdmin):
     list_display = (
@@ -201,3 +170,16 @@ class SystemMessageAdmin(admin.ModelAdmin):
 
 
 admin.site.register(SystemMessage, SystemMessageAdmin)
+
+
+# Add UserGroupAdmin
+class UserGroupAdmin(admin.ModelAdmin):
+    list_display = (
+        'name',
+        'owner',
+        'created_at'
+    )
+    filter_horizontal = ('members',)
+
+
+admin.site.register(UserGroup, UserGroupAdmin)
@@ -0,0 +1,117 @@
+# Brute-force protection for the login mutation.
+# Failed login attempts are tracked in memory per IP address, per subnet and per identifier (username, email
+# address or phone number). Once more attempts failed than allowed, further attempts are rejected with an
+# exponentially growing delay - before any authentication backend hashes the given password.
+
+import ipaddress
+import time
+
+import graphql_jwt
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from graphql_jwt.exceptions import JSONWebTokenError
+
+from ..rate_limit import MemoryBackend
+
+
+class LoginThrottle:
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+    @property
+    def free_attempts(self):
+        return settings.LOGIN_THROTTLE_FREE_ATTEMPTS
+
+    def get_keys(self, request, identifier):
+        'Return the tracking keys (kind, key) of a login attempt.'
+
+        keys = []
+        ip = request.META.get(settings.LOGIN_THROTTLE_IP_HEADER, '').split(',')[0].strip()
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            address = None
+
+        if address:
+            prefix = 24 if address.version == 4 else 64
+            subnet = ipaddress.ip_network('{}/{}'.format(address, prefix), strict=False)
+
+            keys.append(('ip', 'login:ip:{}'.format(address)))
+            keys.append(('subnet', 'login:subnet:{}'.format(subnet)))
+
+        if identifier:
+            # Email addresses are stored lowercase, therefore attempts are tracked case-insensitive.
+            keys.append(('identifier', 'login:identifier:{}'.format(identifier.strip().lower())))
+
+        return keys
+
+    def check(self, request, identifier, now=None):
+        'Return the seconds until the next login attempt is allowed (0 if allowed).'
+
+        now = time.time() if now is None else now
+        retry_after = 0.0
+
+        for kind, key in self.get_keys(request, identifier):
+            state = self.backend.get(key)
+
+            if state and state[1] > now:
+                retry_after = max(retry_after, state[1] - now)
+
+        return retry_after
+
+    def register_failure(self, request, identifier, now=None):
+        now = time.time() if now is None else now
+
+        for kind, key in self.get_keys(request, identifier):
+            free_attempts = self.free_attempts[kind]
+
+            def fail(state):
+                failures = (state[0] if state else 0) + 1
+                blocked_until = now
+
+                # Double the delay with every failure beyond the free attempts.
+                if failures > free_attempts:
+                    exponent = min(failures - free_attempts - 1, 32)
+                    delay = min(settings.LOGIN_THROTTLE_BASE_DELAY * 2 ** exponent, settings.LOGIN_THROTTLE_MAX_DELAY)
+                    blocked_until = now + delay
+
+                return (failures, blocked_until), None
+
+            # Failures are forgotten once no attempt failed for LOGIN_THROTTLE_RESET_AFTER seconds.
+            ttl = settings.LOGIN_THROTTLE_RESET_AFTER + settings.LOGIN_THROTTLE_MAX_DELAY
+            self.backend.update(key, fail, ttl)
+
+    def register_success(self, request, identifier):
+        # Only reset the identifier, so that logging into one account does not reset the limits of an IP address.
+        for kind, key in self.get_keys(request, identifier):
+            if kind == 'identifier':
+                self.backend.delete(key)
+
+
+login_throttle = LoginThrottle()
+
+
+class ObtainJSONWebToken(graphql_jwt.ObtainJSONWebToken):
+    """Obtain JSON Web Token mutation, rejecting throttled attempts before the credentials are checked."""
+
+    @classmethod
+    def mutate(cls, root, info, **kwargs):
+        request = info.context
+        identifier = kwargs.get(get_user_model().USERNAME_FIELD)
+
+        retry_after = login_throttle.check(request, identifier)
+        if retry_after:
+            raise JSONWebTokenError('Too many failed login attempts. Seconds remaining: ' + str(retry_after))
+
+        try:
+            result = super(ObtainJSONWebToken, cls).mutate(root, info, **kwargs)
+        except JSONWebTokenError:
+            login_throttle.register_failure(request, identifier)
+            raise
+
+        login_throttle.register_success(request, identifier)
+
+        return result
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from user.models import EmailAddress
+
+
+class Command(BaseCommand):
+    help = 'Clears expired email verification codes in bounded batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Email objects updated per query.')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to pause between two batches.')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expired = EmailAddress.objects.filter(verification_expires_at__lte=now)
+        cleared = 0
+
+        # Update the expired objects batch by batch, so that no query locks a large part of the table.
+        while True:
+            batch = list(expired.values_list('pk', flat=True)[:options['batch_size']])
+
+            if not batch:
+                break
+
+            cleared += EmailAddress.objects.filter(pk__in=batch).update(
+                verification_nonce=None,
+                verification_expires_at=None,
+                verification_attempts=0
+            )
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write('Cleared {} expired email verification codes.'.format(cleared))
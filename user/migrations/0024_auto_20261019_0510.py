@@ -0,0 +1,28 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0023_auto_20210829_1202'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='EmailTokenSpamBlock',
+        ),
+        migrations.RemoveField(
+            model_name='user',
+            name='last_email_request',
+        ),
+        migrations.RemoveField(
+            model_name='user',
+            name='last_phone_code_request',
+        ),
+        migrations.RemoveField(
+            model_name='user',
+            name='last_phone_request',
+        ),
+    ]
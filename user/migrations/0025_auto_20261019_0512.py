@@ -0,0 +1,26 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0024_auto_20261019_0510'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaddress',
+            name='verification_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='emailaddress',
+            name='verification_nonce',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.DeleteModel(
+            name='EmailToken',
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.2 on 2026-10-19 05:13
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_verification_expires_at(apps, schema_editor):
+    # Keep verification codes issued before this migration valid until they expire.
+    EmailAddress = apps.get_model('user', 'EmailAddress')
+
+    for email_object in EmailAddress.objects.filter(verification_nonce__isnull=False, verified=False):
+        issued_at = datetime.datetime.fromtimestamp(email_object.verification_nonce, tz=timezone.utc)
+        email_object.verification_expires_at = issued_at + datetime.timedelta(
+            seconds=settings.EMAIL_VERIFICATION_TIMEOUT
+        )
+        email_object.save(update_fields=['verification_expires_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0025_auto_20261019_0512'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaddress',
+            name='verification_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(set_verification_expires_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='emailaddress',
+            index=models.Index(fields=['email_address', 'verification_expires_at'], name='user_emaila_email_a_5d2cb3_idx'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 import phonenumbers
 import secrets
+import time
 
 from datetime import timedelta
 
@@ -9,6 +10,7 @@ from django.core.validators import validate_email
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.db import models
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
 
 from uuid import uuid4
 
@@ -117,11 +119,6 @@ class User(AbstractBaseUser):
     city = models.CharField(max_length=255, null=True, blank=True)
     country = models.CharField(max_length=255, null=True, blank=True)
 
-    # Anti-Spam
-    last_phone_request = models.DateTimeField(null=True, blank=True)
-    last_phone_code_request = models.DateTimeField(null=True, blank=True)
-    last_email_request = models.DateTimeField(null=True, blank=True)
-
     objects = UserManager()
 
     USERNAME_FIELD = 'username'
@@ -139,8 +136,6 @@ class User(AbstractBaseUser):
             primary=primary
         )
 
-        email_object.save()
-
         return email_object
 
     # Remove a mail address from the user account.
@@ -264,6 +259,20 @@ class SystemMessage(models.Model):
         return True if self.code == 0 else False
 
 
+class UserGroup(models.Model):
+    """
+    A named group of users, e.g. a team with which documents are shared (see file.acl).
+    """
+
+    name = models.CharField(max_length=150)
+    owner = models.ForeignKey(User, related_name='owned_groups', on_delete=models.CASCADE)
+    members = models.ManyToManyField(User, related_name='user_groups', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
 class PhoneNumber(models.Model):
     # User reference
     user = models.ForeignKey(
@@ -415,6 +424,27 @@ class EmailManager(models.Manager):
     def get_primary_addresses(self):
         return EmailAddress.objects.filter(primary=True)
 
+    def get_by_verification_code(self, email_address, code):
+        """Return the unverified email object with given address the verification code was issued for.
+        If no object matches, a failed attempt is counted on all objects with this address, so that the
+        code can only be guessed EMAIL_VERIFICATION_MAX_ATTEMPTS times."""
+
+        # The expiration is part of the query, so that it is answered by the (email_address, expires_at) index.
+        email_objects = EmailAddress.objects.filter(
+            email_address=email_address,
+            verified=False,
+            verification_expires_at__gt=timezone.now(),
+            verification_attempts__lt=settings.EMAIL_VERIFICATION_MAX_ATTEMPTS
+        )
+
+        for email_object in email_objects:
+            if constant_time_compare(email_object.get_verification_code(), code):
+                return email_object
+
+        email_objects.update(verification_attempts=models.F('verification_attempts') + 1)
+
+        return None
+
 
 class EmailAddress(models.Model):
     user = models.ForeignKey(
@@ -426,8 +456,19 @@ class EmailAddress(models.Model):
     verified = models.BooleanField(default=False, null=True, blank=True)
     primary = models.BooleanField(default=True, null=True, blank=True)
 
+    # Verification codes are not stored, but derived from the object, the nonce and the SECRET_KEY.
+    # The nonce is the timestamp at which the current code was issued.
+    verification_nonce = models.BigIntegerField(null=True, blank=True)
+    verification_expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    verification_attempts = models.PositiveSmallIntegerField(default=0)
+
     objects = EmailManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['email_address', 'verification_expires_at'])
+        ]
+
     def __str__(self):
         return self.email_address
 
@@ -444,11 +485,40 @@ class EmailAddress(models.Model):
         self.save()
         return True
 
+    def start_verification(self):
+        'Issue a new verification code, invalidating the previous one, and return it.'
+
+        self.verification_nonce = int(time.time())
+        self.verification_expires_at = timezone.now() + timedelta(seconds=settings.EMAIL_VERIFICATION_TIMEOUT)
+        self.verification_attempts = 0
+
+        EmailAddress.objects.filter(pk=self.pk).update(
+            verification_nonce=self.verification_nonce,
+            verification_expires_at=self.verification_expires_at,
+            verification_attempts=self.verification_attempts
+        )
+
+        return self.get_verification_code()
+
+    def get_verification_code(self):
+        'Derive the 6-digit verification code from the object, the nonce and the SECRET_KEY.'
+
+        value = '{}:{}:{}'.format(self.pk, self.email_address, self.verification_nonce)
+        digest = salted_hmac('user.EmailAddress.verification', value, algorithm='sha256').digest()
+
+        # Dynamic truncation of the HMAC to a 6-digit number, as done for HOTP codes (RFC 4226).
+        offset = digest[-1] & 0x0f
+        number = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7fffffff
+
+        return str(number % 1000000).zfill(6)
+
     def verify(self):
         'Set the verified status of an email object to True.'
         # Handled at verification.views.handle_verify
 
         self.verified = True
+        self.verification_nonce = None
+        self.verification_expires_at = None
         self.save()
 
         # Delete all email addresses on another account.
@@ -466,68 +536,8 @@ class EmailAddress(models.Model):
             self.set_primary()
 
 
+# Referenced by historical migrations of the removed EmailToken model.
 def generate_token():
     token = secrets.randbelow(999999)
     token = str(token).zfill(6)
     return token
-
-
-class EmailToken(models.Model):
-    user = models.ForeignKey(
-        User, on_delete=models.CASCADE
-    )
-    email_object = models.ForeignKey(
-        EmailAddress, on_delete=models.CASCADE
-    )
-    email_address = models.CharField(
-        max_length=320, null=True, blank=True
-    )
-    token = models.CharField(
-        max_length=6, default=generate_token
-    )
-    created_at = models.DateTimeField(
-        auto_now_add=True
-    )
-
-    def save(self, *args, **kwargs):
-        self.email_address = self.email_object.email_address
-        super(EmailToken, self).save(*args, **kwargs)
-
-    def is_valid(self):
-        return True if (timezone.now() - self.created_at).seconds < 600 else False
-
-
-class EmailTokenSpamBlock(models.Model):
-    email_address = models.CharField(max_length=320, null=True, blank=True)
-    last_email_code_request = models.DateTimeField(null=True, blank=True)
-
-    @classmethod
-    def request_allowed(cls, email_address, until_timedelta=timedelta(seconds=5)):
-        if not EmailTokenSpamBlock.objects.filter(email_address=email_address).exists():
-            cls.block(email_address, until_timedelta)
-            return True
-        else:
-            obj = EmailTokenSpamBlock.objects.get(email_address=email_address)
-            blocked_until = obj.last_email_code_request
-
-            if timezone.now() > blocked_until:
-                obj.delete()
-                cls.block(email_address, until_timedelta)
-                return True
-
-            return False
-
-    @staticmethod
-    def block(email_address, until_timedelta):
-        blocked_until = timezone.now() + until_timedelta
-
-        EmailTokenSpamBlock.objects.create(
-            email_address=email_address,
-            last_email_code_request=blocked_until
-        )
-
-    @staticmethod
-    def time_remaining(email_address):
-        obj = EmailTokenSpamBlock.objects.get(email_address=email_address)
-        difference = (obj.last_email_code_request - timezone.now()).total_seconds()
-        return difference
@@ -0,0 +1,311 @@
+# This file implements the rate limiting used for anti-spam protection.
+# Limits are tracked per scope (e.g. 'verify-email') and identifier (e.g. an email address or a user's id) in a
+# pluggable backend, so that checking or setting a limit does not have to write any rows to the database.
+#
+# Two policies are available:
+# - SlidingWindow: allows a number of hits within any time window of the given length
+# - TokenBucket: allows bursts up to a capacity, with one token refilling every refill_time seconds
+#   (TokenBucket(1, 300) equals a cooldown of five minutes between two hits)
+#
+# Two backends are available, selected through settings.RATE_LIMIT_BACKEND:
+# - MemoryBackend: process-local storage, suitable for development and single-process deployments
+# - CacheBackend: shared storage using a Django cache (e.g. memcached or redis) configured in settings.CACHES
+
+import hashlib
+import math
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class LockTimeout(Exception):
+    'The state of a key could not be updated, as another process held its lock for too long.'
+
+
+class MemoryBackend:
+    """Stores rate limit state in a dictionary of the current process.
+    All operations are atomic, as they are guarded by a lock."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        entry = self._data.get(key)
+
+        if entry is None:
+            return None
+
+        value, expires = entry
+        if expires <= now:
+            del self._data[key]
+            return None
+
+        return value
+
+    def _set(self, key, value, ttl, now):
+        if key not in self._data and len(self._data) >= self.max_entries:
+            self._cull(now)
+
+        self._data[key] = (value, now + ttl)
+
+    def _cull(self, now):
+        # Remove all expired entries. If the storage is still full, drop the oldest third of all entries.
+        for key in [key for key, (value, expires) in self._data.items() if expires <= now]:
+            del self._data[key]
+
+        if len(self._data) >= self.max_entries:
+            for key in list(self._data)[:self.max_entries // 3 or 1]:
+                del self._data[key]
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.time())
+
+    def incr(self, key, ttl, amount=1):
+        with self._lock:
+            now = time.time()
+            value = (self._get(key, now) or 0) + amount
+            self._set(key, value, ttl, now)
+            return value
+
+    def update(self, key, func, ttl):
+        """Atomically replaces the value stored at key by the first item returned by func(value).
+        The second item returned by func is passed through to the caller."""
+
+        with self._lock:
+            now = time.time()
+            value, result = func(self._get(key, now))
+            self._set(key, value, ttl, now)
+            return result
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class CacheBackend:
+    """Stores rate limit state in a Django cache shared by all processes.
+    Counters rely on the atomic add() and incr() operations of the cache."""
+
+    # Amount of attempts to acquire the lock of a key in update(), 5 milliseconds apart.
+    LOCK_ATTEMPTS = 100
+
+    def __init__(self, alias=None):
+        self.cache = caches[alias or getattr(settings, 'RATE_LIMIT_CACHE', 'default')]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def incr(self, key, ttl, amount=1):
+        # add() only succeeds if the key does not exist yet, therefore only one process creates the counter.
+        if self.cache.add(key, amount, math.ceil(ttl)):
+            return amount
+
+        try:
+            return self.cache.incr(key, amount)
+        except ValueError:
+            # The key expired between add() and incr().
+            self.cache.add(key, amount, math.ceil(ttl))
+            return amount
+
+    def update(self, key, func, ttl):
+        """Replaces the value stored at key like MemoryBackend.update, holding a lock stored in the cache.
+        Raises LockTimeout if the lock could not be acquired."""
+
+        lock_key = key + ':lock'
+        # The lock expires after a second, afterwards another process may hold it. It is only released by its owner.
+        token = uuid.uuid4().hex
+
+        for _ in range(self.LOCK_ATTEMPTS):
+            if self.cache.add(lock_key, token, 1):
+                break
+            time.sleep(0.005)
+        else:
+            raise LockTimeout('The lock of {} is held by another process.'.format(key))
+
+        try:
+            value, result = func(self.cache.get(key))
+            self.cache.set(key, value, math.ceil(ttl))
+            return result
+        finally:
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+class SlidingWindow:
+    """Allows up to limit hits within any window of the given amount of seconds.
+
+    The window is approximated using the counters of the current and the previous fixed window,
+    weighting the previous counter by the part of it still covered by the sliding window."""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+
+    def _counters(self, backend, key, now):
+        index = int(now // self.window)
+        elapsed = now - index * self.window
+        previous = backend.get('{}:{}'.format(key, index - 1)) or 0
+        return index, elapsed, previous
+
+    def _retry_after(self, current, previous, elapsed):
+        # Seconds until the estimated amount of hits allows one more hit.
+        if current + 1 <= self.limit:
+            if previous == 0:
+                return 0.0
+            needed = self.window * (1 - (self.limit - 1 - current) / previous)
+            return max(needed - elapsed, 0.0)
+
+        needed = self.window * (1 - (self.limit - 1) / current)
+        return self.window - elapsed + max(needed, 0.0)
+
+    def hit(self, backend, key, now, cost=1):
+        index, elapsed, previous = self._counters(backend, key, now)
+        current_key = '{}:{}'.format(key, index)
+        current = backend.incr(current_key, self.window * 2, amount=cost)
+
+        if previous * (1 - elapsed / self.window) + current <= self.limit:
+            return True, 0.0
+
+        # Rejected hits are not counted, so that clients retrying while blocked do not extend their block.
+        current = backend.incr(current_key, self.window * 2, amount=-cost)
+        return False, self._retry_after(current, previous, elapsed)
+
+    def check(self, backend, key, now):
+        index, elapsed, previous = self._counters(backend, key, now)
+        current = backend.get('{}:{}'.format(key, index)) or 0
+        return self._retry_after(current, previous, elapsed)
+
+    def reset(self, backend, key, now):
+        index = int(now // self.window)
+        backend.delete('{}:{}'.format(key, index))
+        backend.delete('{}:{}'.format(key, index - 1))
+
+
+class TokenBucket:
+    """Allows bursts of up to capacity hits. One token is refilled every refill_time seconds."""
+
+    def __init__(self, capacity, refill_time):
+        self.capacity = capacity
+        self.refill_time = refill_time
+
+    @property
+    def ttl(self):
+        # Time until an empty bucket is full again, afterwards the state equals a missing key.
+        return self.capacity * self.refill_time
+
+    def _tokens(self, state, now):
+        if state is None:
+            return self.capacity
+
+        tokens, timestamp = state
+        return min(self.capacity, tokens + (now - timestamp) / self.refill_time)
+
+    def hit(self, backend, key, now, cost=1):
+        def consume(state):
+            tokens = self._tokens(state, now)
+
+            if tokens >= cost:
+                return (tokens - cost, now), (True, 0.0)
+
+            return (tokens, now), (False, (cost - tokens) * self.refill_time)
+
+        try:
+            return backend.update(key, consume, self.ttl)
+        except LockTimeout:
+            # Too many concurrent hits for the identifier, none of which is allowed without counting it.
+            return False, 1.0
+
+    def check(self, backend, key, now, cost=1):
+        tokens = self._tokens(backend.get(key), now)
+        return max((cost - tokens) * self.refill_time, 0.0)
+
+    def reset(self, backend, key, now):
+        backend.delete(key)
+
+
+_backend = None
+
+
+def get_backend():
+    'Return the backend configured by settings.RATE_LIMIT_BACKEND, shared by all limiters.'
+    global _backend
+
+    if _backend is None:
+        backend_class = import_string(getattr(settings, 'RATE_LIMIT_BACKEND', 'user.rate_limit.MemoryBackend'))
+        _backend = backend_class()
+
+    return _backend
+
+
+class RateLimiter:
+    """Applies a policy to identifiers within a scope.
+
+    Besides the policy, an identifier can be blocked explicitly for a given amount of seconds,
+    e.g. to apply a shorter or longer anti-spam period depending on the outcome of a request."""
+
+    def __init__(self, scope, policy, backend=None):
+        self.scope = scope
+        self.policy = policy
+        self._backend = backend
+
+    @property
+    def backend(self):
+        return self._backend or get_backend()
+
+    def _key(self, identifier):
+        # Hash the identifier, as cache keys must not contain spaces or exceed 250 characters (memcached).
+        digest = hashlib.sha1(str(identifier).encode()).hexdigest()
+        return 'rl:{}:{}'.format(self.scope, digest)
+
+    def _blocked_for(self, key, now):
+        blocked_until = self.backend.get(key + ':block')
+        return blocked_until - now if blocked_until and blocked_until > now else 0.0
+
+    def hit(self, identifier, now=None, cost=1):
+        """Count a hit (or cost hits at once) for the identifier.
+        Returns a tuple (allowed, retry_after) where retry_after is given in seconds."""
+
+        now = time.time() if now is None else now
+        key = self._key(identifier)
+
+        blocked_for = self._blocked_for(key, now)
+        if blocked_for:
+            return False, blocked_for
+
+        return self.policy.hit(self.backend, key, now, cost=cost)
+
+    def check(self, identifier, now=None):
+        'Return the seconds until the next hit is allowed for the identifier, without counting a hit.'
+
+        now = time.time() if now is None else now
+        key = self._key(identifier)
+
+        return self._blocked_for(key, now) or self.policy.check(self.backend, key, now)
+
+    def block(self, identifier, seconds, now=None):
+        'Block the identifier for exactly the given amount of seconds, replacing any previous state.'
+
+        now = time.time() if now is None else now
+        key = self._key(identifier)
+
+        self.policy.reset(self.backend, key, now)
+        self.backend.update(key + ':block', lambda value: (now + seconds, None), seconds)
+
+    def reset(self, identifier, now=None):
+        'Remove any state of the identifier, e.g. to refund a hit of a request which failed validation.'
+
+        now = time.time() if now is None else now
+        key = self._key(identifier)
+
+        self.policy.reset(self.backend, key, now)
+        self.backend.delete(key + ':block')
@@ -1,30 +1,41 @@
 import graphene
 
-from datetime import timedelta
-
 from django.contrib.auth.password_validation import validate_password
 from django.core import exceptions
 from django.core.validators import validate_email
-from django.utils import timezone
 
 from graphene_django import DjangoObjectType
 
-from graphql_jwt import ObtainJSONWebToken, Refresh, Revoke, Verify
+from graphql_jwt import Refresh, Revoke, Verify
 from graphql_jwt.decorators import login_required, staff_member_required
 
 from api.helpers import ErrorType
 
+from .auth_backends.login_throttle import ObtainJSONWebToken
 from .auth_backends.revoke_refresh_token import RevokeAll
 
 from .ban_codes import ban_codes
 
-from .models import EmailAddress, EmailToken, EmailTokenSpamBlock, PhoneNumber, User
+from .models import EmailAddress, PhoneNumber, User
+
+from .rate_limit import RateLimiter, TokenBucket
 
 from .twilio_verify import send_code, verify_code
 
 from .views import initialize_verification_process
 
 
+# Anti-spam limiters, see user.rate_limit.
+# Requesting email verification codes per user: one request every 5 minutes.
+email_request_limiter = RateLimiter('email-request', TokenBucket(1, 5 * 60))
+# Verifying email codes per email address: one attempt every 5 seconds.
+email_verify_limiter = RateLimiter('email-verify', TokenBucket(1, 5))
+# Requesting phone verification codes per user: one request every 2 minutes.
+phone_request_limiter = RateLimiter('phone-request', TokenBucket(1, 2 * 60))
+# Checking phone verification codes per user: one attempt every 5 seconds.
+phone_verify_limiter = RateLimiter('phone-verify', TokenBucket(1, 5))
+
+
 def get_email_object(user, email_address):
     if EmailAddress.objects.filter(user=user, email_address=email_address).exists():
         return EmailAddress.objects.get(user=user, email_address=email_address)
@@ -360,11 +371,10 @@ class RequestVerifyEmail(graphene.Mutation):
 
                 return RequestVerifyEmail(ok=False, error=error)
 
-        # Check for anti-spam protection
-        if info.context.user.last_email_request and info.context.user.last_email_request > timezone.now():
-            # Calculate second-difference between now and last_email_request.
-            difference = (info.context.user.last_email_request - timezone.now()).total_seconds()
-
+        # Check for anti-spam protection.
+        # The hit is counted right away, so that concurrent requests cannot pass the check at the same time.
+        allowed, difference = email_request_limiter.hit(info.context.user.pk)
+        if not allowed:
             error = ErrorType(
                 message='Your request is currently blocked (anti-spam). Seconds remaining: ' + str(difference),
                 code=1
@@ -378,6 +388,9 @@ class RequestVerifyEmail(graphene.Mutation):
             try:
                 validate_email(email_address)
             except exceptions.ValidationError:
+                # Refund the anti-spam hit, as no email was sent.
+                email_request_limiter.reset(info.context.user.pk)
+
                 error = ErrorType(
                     message='Given email address is invalid.',
                     code=5
@@ -389,8 +402,7 @@ class RequestVerifyEmail(graphene.Mutation):
             # Therefore there is no need to filter for other accounts.
             if EmailAddress.objects.filter(email_address=email_address, verified=True).exists():
                 # Set the anti-spam time to now +20 seconds
-                info.context.user.last_email_request = timezone.now() + timedelta(seconds=20)
-                info.context.user.save()
+                email_request_limiter.block(info.context.user.pk, 20)
 
                 error = ErrorType(
                     message='This email address is already verified on another account.',
@@ -402,11 +414,9 @@ class RequestVerifyEmail(graphene.Mutation):
             # At this point, the email address isn't verified on any account and can be added to the user.
             email_object = info.context.user.add_email_address(email_address)
 
+        # The anti-spam hit counted above blocks further requests for 5 minutes.
         initialize_verification_process(info.context.user, email_object)
 
-        # Set the anti-spam to now +10 minutes.
-        info.context.user.last_email_request = timezone.now() + timedelta(minutes=5)
-
         return RequestVerifyEmail(ok=True, email_object=email_object)
 
 
@@ -429,8 +439,8 @@ class VerifyEmail(graphene.Mutation):
         # It is to be checked...
         # - if anti-spam hits
         # - if the email address is already verified
-        # - if there is a EmailToken object with the given email address and token
-        # - if the token is valid or expired
+        # - if the token was issued for an unverified email object with the given email address
+        # - if the token is valid or expired (or was guessed too often)
         # - to remove the email from all other accounts after sucessfully verifying it
         # - to ban other users if they have no other email address left
 
@@ -455,9 +465,8 @@ class VerifyEmail(graphene.Mutation):
             return VerifyEmail(ok=False, error=error)
 
         # Check for anti-spam protection.
-        if not EmailTokenSpamBlock.request_allowed(email_address):
-            time_remaining = EmailTokenSpamBlock.time_remaining(email_address)
-
+        allowed, time_remaining = email_verify_limiter.hit(email_address)
+        if not allowed:
             error = ErrorType(
                 message='Your request is currently blocked (anti-spam). Seconds remaining: ' + str(time_remaining),
                 code=1
@@ -465,8 +474,10 @@ class VerifyEmail(graphene.Mutation):
 
             return VerifyEmail(ok=False, error=error)
 
-        # Check if there is a EmailToken object with the given email address and token.
-        if not EmailToken.objects.filter(token=token, email_address=email_address).exists():
+        # Check if the token was issued for an email object with the given email address.
+        email_object = EmailAddress.objects.get_by_verification_code(email_address, token)
+
+        if not email_object:
             error = ErrorType(
                 message='No verification process found for this email + token combination.',
                 code=5
@@ -474,15 +485,12 @@ class VerifyEmail(graphene.Mutation):
 
             return VerifyEmail(ok=False, error=error)
 
-        token_object = EmailToken.objects.get(token=token, email_address=email_address)
-
         # Set the anti-spam protection of verification request to now +10 seconds.
-        token_object.user.last_email_request = timezone.now() + timedelta(seconds=10)
-        token_object.user.save()
+        email_request_limiter.block(email_object.user_id, 10)
 
-        token_object.email_object.verify()
+        email_object.verify()
 
-        return VerifyEmail(ok=True, email_object=token_object.email_object)
+        return VerifyEmail(ok=True, email_object=email_object)
 
 
 # Use AddPhoneNumber to associate a new phone number with a user.
@@ -539,12 +547,9 @@ class AddPhoneNumber(graphene.Mutation):
             return AddPhoneNumber(ok=False, error=error)
 
         # When is the next request allowed?
-        # Check if user.last_phone_request time is in the future.
-        # last_phone_request stores the time at which the next request is allowed.
-        if info.context.user.last_phone_request and info.context.user.last_phone_request > timezone.now():
-            # Calculate second-difference between now and last_phone_request.
-            difference = (info.context.user.last_phone_request - timezone.now()).total_seconds()
-
+        # check() returns the seconds until the next request is allowed, without counting a request.
+        difference = phone_request_limiter.check(info.context.user.pk)
+        if difference:
             # Check if the phone number already exists on the User.
             if PhoneNumber.objects.filter(user=info.context.user, phone_number=phone_number).exists():
                 phone_object = PhoneNumber.objects.get(user=info.context.user, phone_number=phone_number)
@@ -592,13 +597,23 @@ class AddPhoneNumber(graphene.Mutation):
                 )
 
             # Set the anti-spam threshold to now +20 seconds.
-            info.context.user.last_phone_request = timezone.now() + timedelta(seconds=20)
-            info.context.user.save()
+            phone_request_limiter.block(info.context.user.pk, 20)
 
             return AddPhoneNumber(ok=False, error=error)
 
         # The phone number is not already on any account and verified at this point.
 
+        # Set the anti-spam threshold to now +2 minutes.
+        # The hit is counted atomically, so that only one of multiple concurrent requests passes.
+        allowed, difference = phone_request_limiter.hit(info.context.user.pk)
+        if not allowed:
+            error = ErrorType(
+                message='Your request is currently blocked (anti-spam). Seconds remaining: ' + str(difference),
+                code=1
+            )
+
+            return AddPhoneNumber(ok=False, error=error)
+
         # Check if the phone number is already on the user's account.
         if PhoneNumber.objects.filter(user=info.context.user, phone_number=phone_number).exists():
             phone_object = PhoneNumber.objects.get(user=info.context.user, phone_number=phone_number)
@@ -606,10 +621,6 @@ class AddPhoneNumber(graphene.Mutation):
             # Add new phone number object to user.
             phone_object = info.context.user.add_phone_number(phone_number)
 
-        # Set the anti-spam threshold to now +2 minutes.
-        info.context.user.last_phone_request = timezone.now() + timedelta(minutes=2)
-        info.context.user.save()
-
         # Send a verification code to the user.
         status, err = send_code(phone_number, channel)
 
@@ -685,12 +696,9 @@ class CheckPhoneNumber(graphene.Mutation):
 
             return CheckPhoneNumber(ok=False, error=error)
 
-        # Check if the last_phone_code_request time is in the future.
-        # last_phone_code_request stores the time at which the next request is allowed.
-        if info.context.user.last_phone_code_request and info.context.user.last_phone_code_request > timezone.now():
-            # Calculate second-difference between now and last_phone_code_request.
-            difference = (info.context.user.last_phone_code_request - timezone.now()).total_seconds()
-
+        # Check if the next verification attempt is allowed, without counting an attempt.
+        difference = phone_verify_limiter.check(info.context.user.pk)
+        if difference:
             error = ErrorType(
                 message='Your request is currently blocked (anti-spam). Seconds remaining: ' + str(difference),
                 code=1
@@ -729,8 +737,14 @@ class CheckPhoneNumber(graphene.Mutation):
             return CheckPhoneNumber(ok=False, error=error)
 
         # Set the anti-spam threshold to now +5 seconds.
-        info.context.user.last_phone_code_request = timezone.now() + timedelta(seconds=5)
-        info.context.user.save()
+        allowed, difference = phone_verify_limiter.hit(info.context.user.pk)
+        if not allowed:
+            error = ErrorType(
+                message='Your request is currently blocked (anti-spam). Seconds remaining: ' + str(difference),
+                code=1
+            )
+
+            return CheckPhoneNumber(ok=False, error=error)
 
         status, err = verify_code(phone_number, code)
 
@@ -743,8 +757,7 @@ class CheckPhoneNumber(graphene.Mutation):
 
             # If a number is successfully verified, the user can immediately add a new number.
             # Set the anti-spam threshold to now +5 seconds.
-            info.context.user.last_phone_request = timezone.now() + timedelta(seconds=5)
-            info.context.user.save()
+            phone_request_limiter.block(info.context.user.pk, 5)
 
             return CheckPhoneNumber(ok=True, phone_object=phone_object)
 
@@ -1,12 +1,23 @@
 import json
 
-# from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
+
+from io import StringIO
+
+from unittest import mock
 
 from graphene_django.utils.testing import GraphQLTestCase
 
 from pprint import pprint
 
-from .models import EmailToken, User
+from .auth_backends.authentication import AuthenticationBackend
+from .auth_backends.login_throttle import login_throttle
+from .models import EmailAddress, User
+from .rate_limit import CacheBackend, LockTimeout, MemoryBackend, RateLimiter, SlidingWindow, TokenBucket
 
 
 # class TestUserCreation(TestCase):
@@ -69,10 +80,10 @@ class RegisterTestCase(GraphQLTestCase):
         self.assertResponseNoErrors(mutation_create_user)
 
         new_user = User.objects.get(pk=content['data']['registerUser']['user']['id'])
-        user_email_token = EmailToken.objects.get(user=new_user)
+        user_email_token = new_user.primary_email.get_verification_code()
 
         pmessage('The email verification token created')
-        pprint(vars(user_email_token))
+        pprint(user_email_token)
 
         pmessage('The email object before verifciation')
         pprint(vars(new_user.primary_email))
@@ -89,7 +100,7 @@ class RegisterTestCase(GraphQLTestCase):
                     }}
                 }}
             }}
-            '''.format(email=self.REGISTER_MAIL, token=user_email_token.token)
+            '''.format(email=self.REGISTER_MAIL, token=user_email_token)
         )
 
         content_verify_mail = json.loads(response_verify_mail.content)
@@ -100,6 +111,207 @@ class RegisterTestCase(GraphQLTestCase):
         pprint(vars(new_user.primary_email))
 
 
+class EmailVerificationCodeTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='verify@simonprast.com', password='test-password')
+        self.email_object = self.user.primary_email
+
+    def wrong_code(self, code):
+        return str((int(code) + 1) % 1000000).zfill(6)
+
+    def test_code_matches_email_object(self):
+        code = self.email_object.start_verification()
+
+        self.assertEqual(len(code), 6)
+        self.assertEqual(
+            EmailAddress.objects.get_by_verification_code('verify@simonprast.com', code), self.email_object
+        )
+        self.assertIsNone(EmailAddress.objects.get_by_verification_code('other@simonprast.com', code))
+
+    def test_new_code_invalidates_previous_code(self):
+        code = self.email_object.start_verification()
+        self.email_object.verification_nonce -= 1
+        previous_code = self.email_object.get_verification_code()
+
+        self.assertNotEqual(code, previous_code)
+        self.assertIsNone(EmailAddress.objects.get_by_verification_code('verify@simonprast.com', previous_code))
+
+    def test_expired_code(self):
+        code = self.email_object.start_verification()
+
+        EmailAddress.objects.filter(pk=self.email_object.pk).update(verification_expires_at=timezone.now())
+        self.assertIsNone(EmailAddress.objects.get_by_verification_code('verify@simonprast.com', code))
+
+    def test_sweep_expired_codes(self):
+        self.email_object.start_verification()
+        other_email_object = self.user.add_email_address('verify-2@simonprast.com')
+        other_email_object.start_verification()
+
+        EmailAddress.objects.filter(pk=self.email_object.pk).update(verification_expires_at=timezone.now())
+        call_command('sweep_email_verifications', batch_size=1, stdout=StringIO())
+
+        self.email_object.refresh_from_db()
+        other_email_object.refresh_from_db()
+        self.assertIsNone(self.email_object.verification_nonce)
+        self.assertIsNotNone(other_email_object.verification_nonce)
+
+    def test_attempts_are_limited(self):
+        code = self.email_object.start_verification()
+
+        with self.settings(EMAIL_VERIFICATION_MAX_ATTEMPTS=3):
+            for _ in range(3):
+                self.assertIsNone(
+                    EmailAddress.objects.get_by_verification_code('verify@simonprast.com', self.wrong_code(code))
+                )
+
+            self.assertIsNone(EmailAddress.objects.get_by_verification_code('verify@simonprast.com', code))
+
+
+class RateLimitTestCase(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def backends(self):
+        return [MemoryBackend(), CacheBackend('default')]
+
+    def test_cooldown(self):
+        for backend in self.backends():
+            limiter = RateLimiter('test-cooldown', TokenBucket(1, 10), backend=backend)
+
+            self.assertEqual(limiter.hit('a', now=1000), (True, 0.0))
+            self.assertEqual(limiter.hit('a', now=1004), (False, 6.0))
+            self.assertEqual(limiter.check('a', now=1004), 6.0)
+            # Other identifiers are not affected.
+            self.assertEqual(limiter.hit('b', now=1004), (True, 0.0))
+            self.assertEqual(limiter.hit('a', now=1010), (True, 0.0))
+
+    def test_token_bucket_burst(self):
+        for backend in self.backends():
+            limiter = RateLimiter('test-burst', TokenBucket(3, 10), backend=backend)
+
+            for _ in range(3):
+                self.assertTrue(limiter.hit('a', now=1000)[0])
+
+            self.assertEqual(limiter.hit('a', now=1000), (False, 10.0))
+            self.assertTrue(limiter.hit('a', now=1010)[0])
+
+    def test_sliding_window(self):
+        for backend in self.backends():
+            limiter = RateLimiter('test-window', SlidingWindow(2, 10), backend=backend)
+
+            self.assertTrue(limiter.hit('a', now=1001)[0])
+            self.assertTrue(limiter.hit('a', now=1002)[0])
+
+            allowed, retry_after = limiter.hit('a', now=1005)
+            self.assertFalse(allowed)
+            self.assertAlmostEqual(retry_after, 10.0)
+
+            # Half of the previous window is still covered by the sliding window, which counts as one hit.
+            self.assertTrue(limiter.hit('a', now=1015)[0])
+
+            allowed, retry_after = limiter.hit('a', now=1016)
+            self.assertFalse(allowed)
+            self.assertAlmostEqual(retry_after, 4.0)
+
+            self.assertTrue(limiter.hit('a', now=1020)[0])
+
+    def test_block_and_reset(self):
+        for backend in self.backends():
+            limiter = RateLimiter('test-block', TokenBucket(1, 300), backend=backend)
+
+            limiter.hit('a')
+            limiter.block('a', 20)
+            self.assertAlmostEqual(limiter.check('a'), 20, delta=1)
+
+            limiter.reset('a')
+            self.assertEqual(limiter.check('a'), 0.0)
+
+    def test_cache_backend_lock(self):
+        backend = CacheBackend('default')
+        backend.LOCK_ATTEMPTS = 2
+        limiter = RateLimiter('test-lock', TokenBucket(1, 10), backend=backend)
+        lock_key = limiter._key('a') + ':lock'
+
+        # Another process holds the lock, which is neither ignored nor released.
+        caches['default'].add(lock_key, 'other', 1)
+        self.assertEqual(limiter.hit('a', now=1000), (False, 1.0))
+        self.assertEqual(caches['default'].get(lock_key), 'other')
+
+        with self.assertRaises(LockTimeout):
+            backend.update(limiter._key('a'), lambda value: (1, None), 10)
+
+        caches['default'].delete(lock_key)
+        self.assertEqual(limiter.hit('a', now=1000), (True, 0.0))
+        self.assertIsNone(caches['default'].get(lock_key))
+
+    def test_memory_backend_size_limit(self):
+        backend = MemoryBackend(max_entries=10)
+
+        for i in range(100):
+            backend.incr(str(i), 60)
+
+        self.assertLessEqual(len(backend._data), 10)
+
+
+class LoginThrottleTestCase(TestCase):
+    LOGIN_MUTATION = '''
+        mutation login($username: String!, $password: String!) {
+            login(username: $username, password: $password) {
+                token
+            }
+        }
+    '''
+
+    def setUp(self):
+        login_throttle.backend._data.clear()
+        User.objects.create_user(email='throttle@simonprast.com', password='correct-password')
+
+    def login(self, password, ip='203.0.113.7'):
+        from .schema import schema
+
+        request = RequestFactory().post('/graphql', REMOTE_ADDR=ip)
+        request.user = AnonymousUser()
+
+        return schema.execute(
+            self.LOGIN_MUTATION,
+            variables={'username': 'throttle@simonprast.com', 'password': password},
+            context_value=request
+        )
+
+    def test_throttled_attempts_skip_authentication(self):
+        free_attempts = 5
+
+        with self.settings(LOGIN_THROTTLE_FREE_ATTEMPTS={'ip': 10, 'subnet': 50, 'identifier': free_attempts}):
+            for _ in range(free_attempts + 1):
+                result = self.login('wrong-password')
+                self.assertIn('valid credentials', str(result.errors[0]))
+
+            with mock.patch.object(AuthenticationBackend, 'authenticate') as authenticate:
+                result = self.login('correct-password', ip='198.51.100.1')
+
+            self.assertIn('Too many failed login attempts', str(result.errors[0]))
+            authenticate.assert_not_called()
+
+    def test_backoff_per_ip_and_subnet(self):
+        request = RequestFactory().post('/graphql', REMOTE_ADDR='203.0.113.7')
+        neighbour = RequestFactory().post('/graphql', REMOTE_ADDR='203.0.113.8')
+        free_attempts = {'ip': 2, 'subnet': 3, 'identifier': 100}
+
+        with self.settings(LOGIN_THROTTLE_FREE_ATTEMPTS=free_attempts, LOGIN_THROTTLE_BASE_DELAY=1):
+            for i in range(2):
+                login_throttle.register_failure(request, 'user{}'.format(i), now=1000)
+            self.assertEqual(login_throttle.check(request, 'other', now=1000), 0)
+
+            login_throttle.register_failure(request, 'user3', now=1000)
+            self.assertEqual(login_throttle.check(request, 'other', now=1000), 1)
+            self.assertEqual(login_throttle.check(neighbour, 'other', now=1000), 0)
+
+            # The fourth failure exceeds the subnet's free attempts and doubles the delay of the IP address.
+            login_throttle.register_failure(request, 'user4', now=1000)
+            self.assertEqual(login_throttle.check(request, 'other', now=1000), 2)
+            self.assertEqual(login_throttle.check(neighbour, 'other', now=1000), 1)
+
+
 def pheader(msg):
     print('\n##############################################################')
     print(msg)